@@ -2,31 +2,46 @@
 #
 # Scan through a digital rf recording
 #
+# The ionograms store the power of the range gates (output="power"), or the
+# complex spectrum (output="complex", see twochan_calc_ionograms.py).
+#
 import numpy as np
-import digital_rf as drf
-from mpi4py import MPI
 import glob
-import scipy.signal as ss
 import scipy.constants as c
 import h5py
+import chirp_archiver as ca
 import chirp_config as cc
-import chirp_det as cd
-import matplotlib.pyplot as plt
+import chirp_daily as cdl
+import chirp_index as ci
+import chirp_norm as cn
+import chirp_reader as cr
+import chirp_scheduler as csch
+import chirp_spectrogram as cs
+import chirp_storage as cst
+import chirp_util as cu
 import time
 import os
 import sys
 import traceback
-import shutil
-import multiprocessing as mp
-from pathlib import Path
 
 # c library
 import chirp_lib as cl
-from detect_chirps import get_metadata
+from chirp_util import get_metadata
+
+# set by init_mpi(), so that the ionogram writer can be used without
+# mpi (e.g., by reprocess_ionograms.py)
+MPI = None
+comm = None
+size = 1
+rank = 0
 
-comm = MPI.COMM_WORLD
-size = comm.Get_size()
-rank = comm.Get_rank()
+
+def init_mpi():
+    global MPI, comm, size, rank
+    from mpi4py import MPI
+    comm = MPI.COMM_WORLD
+    size = comm.Get_size()
+    rank = comm.Get_rank()
 
 
 def get_m_per_Hz(rate):
@@ -40,254 +55,438 @@ def get_m_per_Hz(rate):
     return (dt * c.c)
 
 
-def spectrogram(x, window=1024, step=512, wf=ss.hann(1024)):
-    n_spec = int((len(x) - window) / step)
-    S = np.zeros([n_spec, window])
-    for i in range(n_spec):
-        S[i, ] = np.abs(np.fft.fftshift(
-            np.fft.fft(wf * x[(i * step):(i * step + window)])))**2.0
-
-    # normalize scale to float16
-    S = 5e4 * S / np.nanmax(S)
-    return (S)
-
-
-def copy_data_files(conf, copy_q, move_q):
+def ionogram_steps(conf, rate, sample_rate, dec):
     """
-    When directed by the copy queue, copy files from a digital_rf location to
-    another location (temp location) and direct another process via the move
-    queue to move the files to a different location (permanent location).
+    FFT length and step of the ionogram in downconverted samples.
     """
-    # Prepare the staging directory
-    staging_path = Path(conf.data_staging_dir, str(rank))
-    staging_path.mkdir(parents=True, exist_ok=True)
+    sr_dec = sample_rate / dec
+    ds = get_m_per_Hz(rate)
+    fftlen = int(sr_dec * ds / conf.range_resolution / 2.0) * 2
+    fft_step = int((conf.frequency_resolution / rate) * sr_dec)
+    return (fftlen, fft_step)
 
-    # Process filenames from the queue until a stop
-    while True:
-        filename = copy_q.get()
 
-        # We have received the end of the list, stop
-        if filename == "":
-            try:
-                shutil.rmtree(staging_path)
-            except OSError as why:
-                print("Error: failed to delete staging path: " +
-                      str(staging_path) + "; Reason: " + str(why))
-            break
+def sweep_plan(conf, rate, sample_rate, center_freq, dec, step=1000):
+    """
+    Downconverted samples k0...k0+n_out-1 of a sweep that cover the
+    analysis band. Sample k is dec*k raw samples after the start of the sweep.
+    k0 is a multiple of the ionogram fft step, so that the frequency bins
+    are the same as when analyzing the whole sweep.
+    """
+    f_min, f_max = conf.analysis_band(sample_rate, center_freq)
+    fftlen, fft_step = ionogram_steps(conf, rate, sample_rate, dec)
+    sr_dec = sample_rate / dec
+    k0 = (int(f_min * sr_dec / rate) // fft_step) * fft_step
+    k1 = int(f_max * sr_dec / rate)
+    n_out = ((k1 - k0) // step + 1) * step
+    return (k0, n_out)
 
-        # We need to create a string to the time directory that holds the IQ file
-        # Example: <conf.data_dir>/<conf.channel>/2021-05-04T17-00-00/rf@1620150628.000.h5
-        t0 = filename.split("/")[-1][3:].split(".")[0]
-        time_dir = cd.unix2drfdirname(t0)
 
-        data_filename_path = Path(
-            conf.data_dir, conf.channel, time_dir, filename)
+def group_soundings(soundings, sample_rate, min_analysis_freq, max_analysis_freq, max_group_size=6):
+    """
+    Group soundings that are in the analysis band at the same time,
+    so that they can be downconverted with one read of the raw data.
+    soundings is a list of dicts with i0 (start sample) and rate.
+    """
+    soundings = sorted(soundings, key=lambda s: s["i0"] + sample_rate * min_analysis_freq / s["rate"])
+    groups = []
+    group_end = 0
+    for s in soundings:
+        s_start = s["i0"] + int(sample_rate * min_analysis_freq / s["rate"])
+        s_end = s["i0"] + int(sample_rate * max_analysis_freq / s["rate"])
+        if len(groups) > 0 and s_start < group_end and len(groups[-1]) < max_group_size:
+            groups[-1].append(s)
+            group_end = max(group_end, s_end)
+        else:
+            groups.append([s])
+            group_end = s_end
+    return (groups)
+
+
+# ionogram outputs: power of the range gates, or complex spectrum
+outputs = ["power", "complex"]
+
+
+class ionogram_writer:
+    def __init__(self, conf, t0, rate, sample_rate, dec, cid, ch, n_z, k0=0, ofname=None,
+                 output="power"):
+        """
+        Ionogram file that is written row by row as the chirp downconverted
+        signal (n_z samples, starting k0 samples after the start of the
+        sweep) arrives. Readers can follow the file (h5py swmr mode) and
+        the "complete" flag is set when all rows have been written.
+        ofname overrides the file name in output_dir, and then the caller
+        indexes the file.
+        output="power" stores the power of the range gates, normalized when
+        the ionogram is complete. output="complex" stores the complex
+        spectrum, all of it unless zoom_ionograms, and the range indices
+        (ridx) of the range gates.
+        """
+        if output not in outputs:
+            raise ValueError("unknown ionogram output %s" % (output))
+        self.conf = conf
+        self.output = output
+        self.t0 = t0
+        self.rate = rate
+        self.cid = cid
+        self.register = ofname is None
+        self.n_rows = 0
+        self.n_z = 0
+        self.ho = None
+
+        sr_dec = sample_rate / dec
+        ds = get_m_per_Hz(rate)
+        fftlen, fft_step = ionogram_steps(conf, rate, sample_rate, dec)
+        self.freq_step = rate * fft_step / sr_dec
+        self.freq0 = rate * k0 / sr_dec
+
+        range_gates = ds * np.fft.fftshift(np.fft.fftfreq(fftlen, d=1.0 / sr_dec))
+        self.ridx = np.where((range_gates > conf.min_range) &
+                             (range_gates < conf.max_range_extent))[0]
+
+        bins = None
+        if conf.zoom_ionograms:
+            # only compute the range gates that are stored
+            bins = self.ridx
+        self.stream = cs.spectrogram_stream(window=fftlen, step=fft_step,
+                                            output=output,
+                                            n_workers=conf.n_downconversion_threads, bins=bins)
+        if conf.zoom_ionograms or output == "power":
+            # S only has the range gates in ridx
+            n_cols = len(self.ridx)
+        else:
+            n_cols = fftlen
+        dtype = np.float32
+        if output == "complex":
+            dtype = np.complex64
 
         try:
-            shutil.copy2(str(data_filename_path), str(staging_path))
-        except OSError as why:
-            print("Error: failed to copy; Src: " + str(data_filename_path) +
-                  "; Dst: " + str(staging_path) + "; Reason: " + str(why))
-
-        # Signal to the move process to move the copied file
-        move_q.put(str(Path(staging_path, filename)))
+            self.ofname = ofname
+            if ofname is None:
+                dname = "%s/%s" % (conf.output_dir, cu.unix2dirname(t0))
+                if not os.path.exists(dname):
+                    os.mkdir(dname)
+                self.ofname = "%s/lfm_ionogram-%03d-%1.2f.h5" % (dname, cid, t0)
+            print("Writing to %s" % self.ofname)
+            ho = h5py.File(self.ofname, "w", libver="latest")
+            # ionogram frequency-range
+            ho.create_dataset("S", shape=(0, n_cols), maxshape=(None, n_cols),
+                              dtype=dtype, chunks=(16, n_cols))
+            # frequency bins
+            ho.create_dataset("freqs", shape=(0,), maxshape=(None,),
+                              dtype=np.float64, chunks=(1024,))
+            if output == "complex":
+                if conf.zoom_ionograms:
+                    ho["ridx"] = np.arange(len(self.ridx))
+                else:
+                    ho["ridx"] = self.ridx          # range indices
+            ho["rate"] = rate    # chirp-rate
+            ho["ranges"] = range_gates[self.ridx]
+            ho["t0"] = t0
+            ho["id"] = cid
+            ho["sr"] = float(sr_dec)  # ionogram sample-rate
+            if conf.save_raw_voltage:
+                ho.create_dataset("z", shape=(n_z,), dtype=np.complex64)
+            ho["ch"] = ch            # channel name
+            ho["complete"] = False
+            ho.swmr_mode = True
+            self.ho = ho
+        except:
+            traceback.print_exc(file=sys.stdout)
+            print("error writing file")
+
+    def push(self, zd):
+        """
+        Add chirp downconverted samples and write the rows that are complete.
+        """
+        if self.ho is None:
+            return
+        try:
+            if self.conf.save_raw_voltage:
+                self.ho["z"][self.n_z:(self.n_z + len(zd))] = zd
+                self.ho["z"].flush()
+            self.n_z += len(zd)
+
+            S = self.stream.push(np.conj(zd))
+            if S is None:
+                return
+            if self.output == "power" and not self.conf.zoom_ionograms:
+                S = S[:, self.ridx]
+            n0 = self.n_rows
+            n1 = n0 + S.shape[0]
+            self.ho["S"].resize((n1, S.shape[1]))
+            self.ho["S"][n0:n1, :] = S
+            self.ho["freqs"].resize((n1,))
+            self.ho["freqs"][n0:n1] = self.freq0 + self.freq_step * np.arange(n0, n1)
+            self.ho["S"].flush()
+            self.ho["freqs"].flush()
+            self.n_rows = n1
+        except:
+            traceback.print_exc(file=sys.stdout)
+            print("error writing file")
+            self.ho.close()
+            self.ho = None
+
+    def close(self):
+        """
+        Flag the ionogram complete and close the file.
+        """
+        if self.ho is None:
+            return
+        try:
+            if self.n_rows > 0 and self.output == "power":
+                # normalize scale to float16
+                S = self.ho["S"][()]
+                self.ho["S"][:, :] = 5e4 * S / np.nanmax(S)
+                if self.conf.normalized_ionograms:
+                    self.ho["S_norm"] = cn.normalize(S, axis=1, method=self.conf.noise_floor_method)
+            self.ho["complete"][()] = True
+            self.ho.close()
+            self.ho = None
+        except:
+            traceback.print_exc(file=sys.stdout)
+            print("error writing file")
+            return
+
+        if (self.conf.ionogram_format != "float32" or
+                self.conf.raw_voltage_format != "complex64" or
+                self.conf.compression is not None):
+            # rows are written as float32 while the ionogram is formed
+            try:
+                cst.compact(self.ofname,
+                            ionogram_format=self.conf.ionogram_format,
+                            raw_voltage_format=self.conf.raw_voltage_format,
+                            compression=self.conf.compression)
+            except:
+                traceback.print_exc(file=sys.stdout)
+                print("error compacting %s, it is stored as float32" % (self.ofname))
+        if self.register:
+            ci.register(self.conf, "ionogram", self.ofname,
+                        t0=self.t0, chirp_rate=self.rate, cid=self.cid)
+        if self.conf.daily_archive:
+            try:
+                cdl.add_ionogram(self.conf, self.ofname)
+            except:
+                traceback.print_exc(file=sys.stdout)
+                print("error adding %s to the daily archive" % (self.ofname))
 
 
-def move_data_files(conf, move_q):
-    """ 
-    When directed by the move queue, move files from one location to another.
+def save_ionogram(conf, zd, t0, rate, sample_rate, dec, cid, ch, k0=0, output="power"):
     """
-    while True:
-        file_with_path = move_q.get()
-
-        # We have received the end of the list, stop
-        if file_with_path == "":
-            break
-
-        # Determine if we move or delete the files
-        if conf.save_chirp_iq:
-            t0 = file_with_path.split("/")[-1][3:].split(".")[0]
-            output_path = Path(conf.output_dir, cd.unix2dirname(t0), "raw_iq")
-            output_path.mkdir(parents=True, exist_ok=True)
-
-            try:
-                shutil.move(file_with_path, str(output_path))
-            except OSError as why:
-                # print("Error: failed to move; Src: " + file_with_path +
-                #      "; Dst: " + str(output_path) + "; Reason: " + str(why))
-                pass
-        else:
-            Path(file_with_path).unlink()
+    Calculate the ionogram from the chirp downconverted signal and store it.
+    zd starts k0 downconverted samples after the start of the sweep.
+    """
+    iw = ionogram_writer(conf, t0, rate, sample_rate, dec, cid, ch, len(zd), k0=k0,
+                         output=output)
+    iw.push(zd)
+    iw.close()
 
 
-def chirp_downconvert(conf,
-                      t0,
+def downconvert_group(conf,
+                      soundings,
                       data,
-                      i0,
                       ch,
-                      rate,
                       dec=2500,
-                      realtime_req=None,
-                      cid=0,
-                      copy_q=None):
-
+                      archiver=None,
+                      output="power"):
+    """
+    Chirp downconvert several soundings that overlap in time
+    with a single read of the raw data, and store their ionograms.
+    soundings is a list of dicts with t0, i0, rate, id and optionally
+    realtime_req (seconds of data that we need to keep up with).
+    The raw voltage that is read is archived with archiver (chirp_archiver.iq_archiver).
+    output is the ionogram output, "power" or "complex" (ionogram_writer).
+    """
     cput0 = time.time()
-    sleep_time = 0.0
 
     sample_rate, center_freq = get_metadata(data, ch)
-    max_analysis_freq = center_freq + sample_rate / 2
 
-    dur = max_analysis_freq / rate
-    if realtime_req == None:
-        realtime_req = dur
-    idx = 0
     step = 1000
-    n_windows = int(dur * sample_rate / (step * dec)) + 1
 
-    cdc = cl.chirp_downconvert(f0=-center_freq,
-                               rate=rate,
-                               dec=dec,
-                               dt=1.0 / sample_rate,
-                               n_threads=conf.n_downconversion_threads)
-
-    zd_len = n_windows * step
-    zd = np.zeros(zd_len, dtype=np.complex64)
-
-    z_out = np.zeros(step, dtype=np.complex64)
-    n_out = step
-
-    data_filename_hist = []
-    for fi in range(n_windows):
-        missing = False
-        try:
-            if conf.realtime:
-                bounds = data.get_bounds(ch)
-                while ((i0 + idx + step * dec + cdc.filter_len * dec) + int(sample_rate)) > bounds[1]:
-                    # wait for more data to be acquired
-                    # as the tail of the buffer doesn't have he data we
-                    # need yet
-                    time.sleep(1.0)
-                    sleep_time += 1.0
-                    bounds = d.get_bounds(ch)
-
-            z_a = data.read_vector_c81d(
-                i0 + idx, step * dec + cdc.filter_len * dec, ch)
-
-            # Phase shift and add the second channel
-            # z_b = d.read_vector_c81d(
-            #    i0+idx, step*dec+cdc.filter_len*dec, "chb")
-            # z_b = z_b * np.exp(1j * (np.pi / 2))
-            # z = z_a + z_b
-            z = z_a
-        except:
-            # z=np.zeros(step*dec+cdc.filter_len*dec,dtype=np.complex64)
-            missing = True
-
-        # we can skip this heavy step if there is missing data
-        if not missing:
-            """
-            # Get the name of each unique data file that is used to process the sounder
-            data_filename = int((i0+idx)/sample_rate)
-            if len(data_filename_hist) == 0 or data_filename not in data_filename_hist:
-                # print("Rank", rank, "; Reading file:", data_filename)
-                cid_formatted = ".%03d.h5" % (cid)
-                data_filename_full = "rf@" + str(data_filename) + cid_formatted
-
-                copy_q.put(data_filename_full)
-
-                data_filename_hist.append(data_filename)
-            """
-            cdc.consume(z, z_out, n_out)
+    first_cpu = -1
+    if conf.pin_downconversion_threads:
+        first_cpu = rank * conf.n_downconversion_threads
+
+    cdm = cl.chirp_downconvert_multi(dec=dec,
+                                     dt=1.0 / sample_rate,
+                                     n_threads=conf.n_downconversion_threads,
+                                     first_cpu=first_cpu,
+                                     kernel=conf.dechirp_kernel,
+                                     filter=conf.decimation_filter)
+    n_targets = len(soundings)
+    zds = []
+    k0s = []
+    n_totals = []
+    pos = []
+    n_done = []
+    writers = []
+    realtime_end = 0
+    for s in soundings:
+        # only the part of the sweep that is in the analysis band
+        k0, n_out = sweep_plan(conf, s["rate"], sample_rate, center_freq, dec, step)
+        cdc = cdm.add_target(-center_freq, s["rate"])
+        cdc.advance_time(dec * k0)
+        if conf.streaming_ionograms:
+            # write the ionogram rows as they are formed,
+            # only the samples of one read are kept in memory
+            zds.append(np.zeros(step, dtype=np.complex64))
+            writers.append(ionogram_writer(conf, s["t0"], s["rate"], sample_rate,
+                                           dec, s["id"], ch, n_out, k0=k0,
+                                           output=output))
         else:
-            # step chirp time forward
-            cdc.advance_time(dec * step)
-            z_out[:] = 0.0
-
-        zd[(fi * step):(fi * step + step)] = z_out
-
-        idx += dec * step
-
-    dr = conf.range_resolution
-    df = conf.frequency_resolution
-    sr_dec = sample_rate / dec
-    ds = get_m_per_Hz(rate)
-    fftlen = int(sr_dec * ds / dr / 2.0) * 2
-    fft_step = int((df / rate) * sr_dec)
-
-    S = spectrogram(np.conj(zd), window=fftlen,
-                    step=fft_step, wf=ss.hann(fftlen))
-
-    freqs = rate * np.arange(S.shape[0]) * fft_step / sr_dec
-    range_gates = ds * np.fft.fftshift(np.fft.fftfreq(fftlen, d=1.0 / sr_dec))
-
-    ridx = np.where(np.abs(range_gates) < conf.max_range_extent)[0]
+            zds.append(np.zeros(n_out, dtype=np.complex64))
+        k0s.append(k0)
+        n_totals.append(n_out)
+        pos.append(int(s["i0"]) + dec * k0)
+        n_done.append(0)
+        realtime_req = s.get("realtime_req", None)
+        if realtime_req == None:
+            realtime_req = n_out * dec / sample_rate
+        realtime_end = max(realtime_end, pos[-1] / sample_rate + realtime_req)
+    realtime_req = realtime_end - min(pos) / sample_rate
+
+    # each read covers step output samples of the earliest target
+    block = step * dec
+    read_len = block + cdm.filter_len * dec
+
+    # plan the reads. this doesn't depend on the data,
+    # so the reader can read ahead.
+    plan = []
+    while True:
+        todo = [t for t in range(n_targets) if n_done[t] < n_totals[t]]
+        if len(todo) == 0:
+            break
+        i_read = min([pos[t] for t in todo])
+        offsets = [pos[t] - i_read for t in range(n_targets)]
+        n_outs = [0] * n_targets
+        for t in todo:
+            if offsets[t] < block:
+                n_outs[t] = min(n_totals[t] - n_done[t],
+                                (block - offsets[t] + dec - 1) // dec)
+        plan.append((i_read, offsets, n_outs, list(n_done)))
+        for t in todo:
+            pos[t] += dec * n_outs[t]
+            n_done[t] += n_outs[t]
+
+    reader = cr.window_reader(data,
+                              ch,
+                              [p[0] for p in plan],
+                              read_len,
+                              n_buffers=conf.n_read_buffers,
+                              realtime=conf.realtime,
+                              sample_rate=sample_rate)
 
     try:
-        dname = "%s/%s" % (conf.output_dir, cd.unix2dirname(t0))
-        if not os.path.exists(dname):
-            os.mkdir(dname)
-        ofname = "%s/lfm_ionogram-%03d-%1.2f.h5" % (dname, cid, t0)
-        print("Writing to %s" % ofname)
-        ho = h5py.File(ofname, "w")
-        ho["S"] = S[:, ridx]          # ionogram frequency-range
-        ho["freqs"] = freqs  # frequency bins
-        ho["rate"] = rate    # chirp-rate
-        ho["ranges"] = range_gates[ridx]
-        ho["t0"] = t0
-        ho["id"] = cid
-        ho["sr"] = float(sr_dec)  # ionogram sample-rate
-        if conf.save_raw_voltage:
-            ho["z"] = zd
-        ho["ch"] = ch            # channel name
-        ho.close()
-    except:
-        traceback.print_exc(file=sys.stdout)
-        print("error writing file")
+        for i_read, offsets, n_outs, n_done in plan:
+            z, missing = reader.get()
+            if conf.streaming_ionograms:
+                z_outs = zds
+            else:
+                z_outs = [zds[t][n_done[t]:n_totals[t]] for t in range(n_targets)]
+
+            # we can skip this heavy step if there is missing data
+            if not missing:
+                if archiver is not None:
+                    archiver.archive(i_read / sample_rate, (i_read + read_len) / sample_rate)
+                cdm.consume(z, offsets, z_outs, n_outs)
+            else:
+                # step chirp time forward, the output is zero
+                for t in range(n_targets):
+                    cdm.targets[t].advance_time(dec * n_outs[t])
+                    z_outs[t][0:n_outs[t]] = 0.0
+            for t in range(len(writers)):
+                if n_outs[t] > 0:
+                    writers[t].push(z_outs[t][0:n_outs[t]])
+    finally:
+        reader.close()
+    sleep_time = reader.sleep_time
+
+    for t, s in enumerate(soundings):
+        if conf.streaming_ionograms:
+            writers[t].close()
+        else:
+            save_ionogram(conf, zds[t], s["t0"], s["rate"],
+                          sample_rate, dec, s["id"], ch, k0=k0s[t], output=output)
 
     cput1 = time.time()
     cpu_time = cput1 - cput0 - sleep_time
-    print("Done processed %1.2f s in %1.2f s, speed %1.2f * realtime" %
-          (realtime_req, cpu_time, realtime_req / cpu_time))
+    print("Done processed %d sounding(s) %1.2f s in %1.2f s, speed %1.2f * realtime" %
+          (n_targets, realtime_req, cpu_time, realtime_req / cpu_time))
     sys.stdout.flush()
 
 
-def analyze_all(conf, data):
-    fl = glob.glob("%s/*/par-*.h5" % (conf.output_dir))
-    n_ionograms = len(fl)
+def chirp_downconvert(conf,
+                      t0,
+                      data,
+                      i0,
+                      ch,
+                      rate,
+                      dec=2500,
+                      realtime_req=None,
+                      cid=0,
+                      archiver=None,
+                      output="power"):
+    downconvert_group(conf,
+                      [{"t0": t0, "i0": i0, "rate": rate, "id": cid,
+                        "realtime_req": realtime_req}],
+                      data,
+                      ch,
+                      dec=dec,
+                      archiver=archiver,
+                      output=output)
+
+
+def analyze_all(conf, data, output="power"):
     sample_rate, center_freq = get_metadata(data, conf.channel)
+    min_analysis_freq, max_analysis_freq = conf.analysis_band(sample_rate, center_freq)
+
+    soundings = None
+    if rank == 0:
+        soundings = []
+        for f in ci.find_files(conf, "parameter"):
+            h = h5py.File(f, "r")
+            chirp_rate = float(np.copy(h[("chirp_rate")]))
+            t0 = float(np.copy(h[("t0")]))
+            h.close()
+            soundings.append({"t0": t0,
+                              "i0": np.int64(t0 * sample_rate),
+                              "rate": chirp_rate,
+                              "id": 0})
+    soundings = comm.bcast(soundings, root=0)
+
+    if conf.group_soundings:
+        groups = group_soundings(soundings, sample_rate, min_analysis_freq,
+                                 max_analysis_freq, conf.max_group_size)
+    else:
+        groups = [[s] for s in soundings]
 
     # mpi scan through the whole dataset
-    for ionogram_idx in range(rank, n_ionograms, size):
-        h = h5py.File(fl[ionogram_idx], "r")
-        chirp_rate = np.copy(h[("chirp_rate")])
-        t0 = np.copy(h[("t0")])
-        i0 = np.int64(t0 * sample_rate)
-        print("calculating i0=%d chirp_rate=%1.2f kHz/s t0=%1.6f" %
-              (i0, chirp_rate / 1e3, t0))
-        h.close()
+    for group_idx in range(rank, len(groups), size):
+        for s in groups[group_idx]:
+            print("calculating i0=%d chirp_rate=%1.2f kHz/s t0=%1.6f" %
+                  (s["i0"], s["rate"] / 1e3, s["t0"]))
 
-        chirp_downconvert(conf,
-                          t0,
+        downconvert_group(conf,
+                          groups[group_idx],
                           data,
-                          i0,
                           conf.channel,
-                          chirp_rate,
-                          dec=2500)
+                          dec=2500,
+                          output=output)
 
 
-def analyze_realtime(conf, data):
+def analyze_realtime(conf, data, output="power"):
     """ 
     Realtime analysis using analytic timing
     We allocate one MPI process for each sounder to be on the safe side.
+    See analyze_realtime_shared for scheduling all sounders on all processes.
 
     TODO: load chirp timing information dynamically
-          and use a process pool to calculate as many chirp ionograms 
-          as there are computational resources.
     """
     st = conf.sounder_timings[rank]
     n_sounders = len(st)
     ch = conf.channel
     sample_rate, center_freq = get_metadata(data, ch)
+    min_analysis_freq, max_analysis_freq = conf.analysis_band(sample_rate, center_freq)
 
     while True:
         bounds = data.get_bounds(ch)
@@ -299,16 +498,22 @@ def analyze_realtime(conf, data):
         best_wait_time = 1e6
         best_t0 = 0
         best_id = 0
+        next_t0s = []
+        # times when the sweeps enter the analysis band
+        band_t0s = []
         for s_idx in range(n_sounders):
             rep = np.float128(st[s_idx]["rep"])
             chirpt = np.float128(st[s_idx]["chirpt"])
             chirp_rate = st[s_idx]["chirp-rate"]
             cid = st[s_idx]["id"]
 
+            band_dt = min_analysis_freq / chirp_rate
             try_t0 = rep * np.floor(t0 / rep) + chirpt
-            while try_t0 < t0:
+            while try_t0 + band_dt < t0:
                 try_t0 += rep
-            wait_time = try_t0 - t0
+            wait_time = try_t0 + band_dt - t0
+            next_t0s.append(try_t0)
+            band_t0s.append(try_t0 + band_dt)
 
             if wait_time < best_wait_time:
                 best_sounder = s_idx
@@ -322,27 +527,145 @@ def analyze_realtime(conf, data):
         print("Rank %d chirp id %d analyzing chirp-rate %1.2f kHz/s chirpt %1.4f rep %1.2f" %
               (rank, best_id, chirp_rate / 1e3, chirpt, rep))
         i0 = int(next_t0 * sample_rate)
-        realtime_req = sample_rate / chirp_rate
-        print("Buffer extent %1.2f-%1.2f launching next chirp at %1.2f %s" % (bounds[0] / sample_rate,
-                                                                              bounds[1] /
-                                                                              sample_rate,
-                                                                              next_t0,
-                                                                              cd.unix2datestr(next_t0)))
-
-        chirp_downconvert(conf,
-                          next_t0,
+        best_band_t0 = band_t0s[best_sounder]
+        realtime_req = (max_analysis_freq - min_analysis_freq) / chirp_rate
+        print("Buffer extent %1.2f-%1.2f launching next chirp at %1.2f %s in band at %1.2f" % (bounds[0] / sample_rate,
+                                                                                               bounds[1] /
+                                                                                               sample_rate,
+                                                                                               next_t0,
+                                                                                               cu.unix2datestr(next_t0),
+                                                                                               best_band_t0))
+
+        soundings = [{"t0": next_t0, "i0": i0, "rate": chirp_rate,
+                      "id": best_id, "realtime_req": realtime_req}]
+        if conf.group_soundings:
+            # add the other sounders of this process that enter the band during this sweep
+            order = np.argsort(np.array(band_t0s, dtype=np.float64))
+            for s_idx in order:
+                if len(soundings) >= conf.max_group_size:
+                    break
+                if s_idx == best_sounder or band_t0s[s_idx] >= best_band_t0 + realtime_req:
+                    continue
+                s_t0 = float(next_t0s[s_idx])
+                s_rate = st[s_idx]["chirp-rate"]
+                print("Rank %d chirp id %d chirp-rate %1.2f kHz/s overlaps, analyzing at %1.2f" %
+                      (rank, st[s_idx]["id"], s_rate / 1e3, s_t0))
+                soundings.append({"t0": s_t0, "i0": int(s_t0 * sample_rate), "rate": s_rate,
+                                  "id": st[s_idx]["id"],
+                                  "realtime_req": (max_analysis_freq - min_analysis_freq) / s_rate})
+
+        downconvert_group(conf,
+                          soundings,
                           data,
-                          i0,
                           conf.channel,
-                          chirp_rate,
-                          realtime_req=realtime_req,
                           dec=conf.decimation,
-                          cid=best_id)
+                          output=output)
+
+
+def analyze_realtime_shared(conf, data, output="power"):
+    """
+    Realtime analysis using analytic timing. Rank 0 schedules the soundings
+    of all sounders, regardless of which rank they are listed for, to any
+    free rank, earliest deadline first (chirp_scheduler). With one process,
+    rank 0 also calculates the ionograms.
+    """
+    job_tag = 1
+    done_tag = 2
+    ch = conf.channel
+
+    if rank > 0:
+        while True:
+            soundings = comm.recv(source=0, tag=job_tag)
+            try:
+                downconvert_group(conf,
+                                  soundings,
+                                  data,
+                                  ch,
+                                  dec=conf.decimation,
+                                  output=output)
+            except:
+                traceback.print_exc(file=sys.stdout)
+                print("error calculating ionograms")
+            comm.send(rank, dest=0, tag=done_tag)
+
+    sample_rate, center_freq = get_metadata(data, ch)
+    min_analysis_freq, max_analysis_freq = conf.analysis_band(sample_rate, center_freq)
+    sounders = [s for st in conf.sounder_timings for s in st]
+    max_group_size = 1
+    if conf.group_soundings:
+        max_group_size = conf.max_group_size
+
+    workers = list(range(1, size))
+    if len(workers) == 0:
+        workers = [0]
+    sched = csch.sounding_schedule(sounders,
+                                   sample_rate,
+                                   min_analysis_freq,
+                                   max_analysis_freq,
+                                   len(workers),
+                                   max_group_size=max_group_size)
+    while True:
+        while comm.Iprobe(source=MPI.ANY_SOURCE, tag=done_tag):
+            w_rank = comm.recv(source=MPI.ANY_SOURCE, tag=done_tag)
+            bounds = data.get_bounds(ch)
+            sched.done(workers.index(w_rank), bounds[1] / sample_rate)
+
+        # the time of the newest data in the ringbuffer
+        bounds = data.get_bounds(ch)
+        now = bounds[1] / sample_rate
+        sched.update(now, bounds[0] / sample_rate, now)
+
+        for w, soundings in sched.dispatch(now):
+            for s in soundings:
+                print("Rank %d chirp id %d chirp-rate %1.2f kHz/s t0 %1.2f in band at %1.2f %s" %
+                      (workers[w], s["id"], s["rate"] / 1e3, s["t0"], s["band_t0"],
+                       cu.unix2datestr(s["t0"])))
+            if workers[w] == 0:
+                try:
+                    downconvert_group(conf,
+                                      soundings,
+                                      data,
+                                      ch,
+                                      dec=conf.decimation,
+                                      output=output)
+                except:
+                    traceback.print_exc(file=sys.stdout)
+                    print("error calculating ionograms")
+                bounds = data.get_bounds(ch)
+                sched.done(w, bounds[1] / sample_rate)
+            else:
+                comm.send(soundings, dest=workers[w], tag=job_tag)
+            print("Scheduler %s" % (sched.status()))
+            sys.stdout.flush()
+        time.sleep(0.5)
+
+
+def claim_par_file(fname):
+    """
+    Mark a parameter file as analyzed by this process, by creating
+    fname.done exclusively. Returns False if another process already did.
+    """
+    try:
+        fd = os.open("%s.done" % (fname), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return (False)
+    os.close(fd)
+    ho = h5py.File("%s.done" % (fname), "w")
+    ho["t_an"] = time.time()
+    ho.close()
+    return (True)
+
+
+# (t0, chirp_rate) of the parameter files that haven't been analyzed yet
+par_files = {}
+# parameter files that have been analyzed (or given up on) by any process
+done_par_files = set()
 
 
 def get_next_chirp_par_file(conf, data):
     """ 
-    wait until we encounter a parameter file with remaining time 
+    wait until we encounter a parameter file with remaining time,
+    and claim it. returns (file name, t0, chirp_rate)
     """
     # find the next sounder that can be measured
     while True:
@@ -356,121 +679,121 @@ def get_next_chirp_par_file(conf, data):
                 bounds[0]) / np.float128(sample_rate))
             print("nan bounds for ringbuffer. trying again")
             time.sleep(1)
-
-        # todo: look at today and yesterday. only looking
-        # at today will result in a few lost ionograms
-        # when the day is changing
-        dname = "%s/%s" % (conf.output_dir,
-                           cd.unix2dirname(conf.output_dir_time))
-        fl = glob.glob("%s/par*.h5" % (dname))
-        fl.sort()
-
-        if len(fl) > 0:
-            for fi in range(len(fl)):
-                ftry = fl[len(fl) - fi - 1]
-
-                # proceed if this hasn't already been analyzed.
-                if not os.path.exists("%s.done" % (ftry)):
+        buffer_t1 = float(bounds[1] / sample_rate)
+        max_analysis_freq = conf.analysis_band(sample_rate, center_freq)[1]
+
+        # look at today and yesterday, as the sweeps in the
+        # buffer may have started before the day changed
+        fl = []
+        for day_t in [buffer_t1 - 24 * 3600.0, buffer_t1]:
+            dname = "%s/%s" % (conf.output_dir, cu.unix2dirname(day_t))
+            fl += glob.glob("%s/par*.h5" % (dname))
+        fl = sorted(set(fl))
+        # forget files that are no longer looked at
+        done_par_files.intersection_update(fl)
+
+        for ftry in reversed(fl):
+            # proceed if this hasn't already been analyzed.
+            if ftry in done_par_files:
+                continue
+            if os.path.exists("%s.done" % (ftry)):
+                done_par_files.add(ftry)
+                par_files.pop(ftry, None)
+                continue
+
+            if ftry not in par_files:
+                try:
                     h5file = h5py.File(ftry, "r")
-                    t0 = float(np.copy(h5file[("t0")]))
-                    i0 = np.int64(t0 * sample_rate)
-                    chirp_rate = float(np.copy(h5file[("chirp_rate")]))
+                    par_files[ftry] = (float(np.copy(h5file[("t0")])),
+                                       float(np.copy(h5file[("chirp_rate")])))
                     h5file.close()
-                    t1 = conf.maximum_analysis_frequency / chirp_rate + t0
-
-                    tnow = time.time()
-
-                    # if the beginning of the buffer is before the end of the chirp,
-                    # start analyzing as there is at least some of the the ionogram
-                    # still in the buffer. the start of the buffer is
-                    # before the the chirp ends
-                    # t0 ---- t1
-                    #      bt0-------bt1
-                    if buffer_t0 < t1:
-                        # if not already analyzed, analyze it
-                        if not os.path.exists("%s.done" % (ftry)):
-                            ho = h5py.File("%s.done" % (ftry), "w")
-                            ho["t_an"] = time.time()
-                            ho.close()
-                            print("Rank %d analyzing %s time left in sweep %1.2f s" % (
-                                rank, ftry, t1 - tnow))
-                            return (ftry)
-                    else:
-                        # we haven't analyzed this one, but we no longer
-                        # can, because it is not in the buffer
-                        print("Not able to analyze %s (%1.2f kHz/s), because it is no longer in the buffer. Buffer start at %1.2f and chirp ends at %1.2f" %
-                              (ftry, chirp_rate / 1e3, buffer_t0, t1))
-                        ho = h5py.File("%s.done" % (ftry), "w")
-                        ho["t_an"] = time.time()
-                        ho.close()
-                        time.sleep(0.01)
+                except:
+                    # still being written
+                    continue
+            t0, chirp_rate = par_files[ftry]
+            t1 = max_analysis_freq / chirp_rate + t0
+
+            tnow = time.time()
+
+            # if the beginning of the buffer is before the end of the chirp,
+            # start analyzing as there is at least some of the the ionogram
+            # still in the buffer. the start of the buffer is
+            # before the the chirp ends
+            # t0 ---- t1
+            #      bt0-------bt1
+            if buffer_t0 < t1:
+                # if not already analyzed by another process, analyze it
+                if claim_par_file(ftry):
+                    print("Rank %d analyzing %s time left in sweep %1.2f s" % (
+                        rank, ftry, t1 - tnow))
+                    done_par_files.add(ftry)
+                    par_files.pop(ftry, None)
+                    return (ftry, t0, chirp_rate)
+            elif claim_par_file(ftry):
+                # we haven't analyzed this one, but we no longer
+                # can, because it is not in the buffer
+                print("Not able to analyze %s (%1.2f kHz/s), because it is no longer in the buffer. Buffer start at %1.2f and chirp ends at %1.2f" %
+                      (ftry, chirp_rate / 1e3, buffer_t0, t1))
+            done_par_files.add(ftry)
+            par_files.pop(ftry, None)
 
         # didn't find anything. let's wait.
         time.sleep(1)
 
 
-def analyze_parfiles(conf, data):
+def analyze_parfiles(conf, data, output="power"):
     """ 
     Realtime analysis using newly found parameter files.
     """
     ch = conf.channel
     sample_rate, center_freq = get_metadata(data, ch)
 
-    while True:
+    # copy the raw voltage off the ringbuffer
+    archiver = None
+    if conf.save_chirp_iq:
+        archiver = ca.iq_archiver(conf)
 
-        ftry = get_next_chirp_par_file(conf, data)
+    while True:
 
-        h5file = h5py.File(ftry, "r")
-        t0 = float(np.copy(h5file[("t0")]))
+        ftry, t0, chirp_rate = get_next_chirp_par_file(conf, data)
         i0 = np.int64(t0 * sample_rate)
-        chirp_rate = float(np.copy(h5file[("chirp_rate")]))
-        h5file.close()
-
-        # Spawn a separate process to copy the files off the ring buffer and place them
-        # into the raw IQ staging directory
-        copy_q = mp.Queue()
-        move_q = mp.Queue()
-        proc_copy = mp.Process(target=copy_data_files,
-                               args=(conf, copy_q, move_q))
-        proc_copy.start()
-        proc_move = mp.Process(target=move_data_files, args=(conf, move_q))
-        proc_move.start()
 
         chirp_downconvert(conf,
                           t0,
-                          d,
+                          data,
                           i0,
                           conf.channel,
                           chirp_rate,
                           dec=conf.decimation,
                           cid=0,
-                          copy_q=copy_q)
-
-        # Indicate to the processes that we are done
-        copy_q.put("")
-        move_q.put("")
-        proc_copy.join()
-        proc_move.join()
+                          archiver=archiver,
+                          output=output)
 
         time.sleep(0.1)
 
 
-if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        conf = cc.chirp_config(sys.argv[1])
+def main(argv, output="power"):
+    """
+    Calculate ionograms as configured in argv[1] (serendipitous, realtime
+    or batch).
+    """
+    if len(argv) == 2:
+        conf = cc.chirp_config(argv[1])
     else:
         conf = cc.chirp_config()
+    conf.make_output_dir()
+    init_mpi()
+    import digital_rf as drf
+    prog = os.path.basename(argv[0])
 
     # analyze serendpituous par files immediately after a chirp is detected
     if conf.serendipitous:
-        # avoid having two processes snag the same sounder at the start
-        time.sleep(rank * 2)
         while True:
             try:
                 data = drf.DigitalRFReader(conf.data_dir)
-                analyze_parfiles(conf, data)
+                analyze_parfiles(conf, data, output=output)
             except:
-                print("error in calc_ionograms.py. trying to restart")
+                print("error in %s. trying to restart" % (prog))
                 traceback.print_exc(file=sys.stdout)
                 sys.stdout.flush()
                 time.sleep(1)
@@ -478,11 +801,18 @@ if __name__ == "__main__":
         while True:
             try:
                 data = drf.DigitalRFReader(conf.data_dir)
-                analyze_realtime(conf, data)
+                if conf.realtime_scheduler == "shared":
+                    analyze_realtime_shared(conf, data, output=output)
+                else:
+                    analyze_realtime(conf, data, output=output)
             except:
-                print("error in calc_ionograms.py. trying to restart")
+                print("error in %s. trying to restart" % (prog))
                 sys.stdout.flush()
                 time.sleep(1)
     else:  # batch analyze
         data = drf.DigitalRFReader(conf.data_dir)
-        analyze_all(conf, data)
+        analyze_all(conf, data, output=output)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
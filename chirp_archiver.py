@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# Archive the raw voltage files of analyzed soundings from the ringbuffer
+# to output_dir/<day>/raw_iq.
+#
+# One long-lived process per analysis process takes requests over a queue.
+# Files are hard linked into the archive when the ringbuffer and the
+# output directory are on the same file system (no data is copied, and
+# the ringbuffer can still delete its own link). Otherwise the file is
+# copied in the kernel with copy_file_range or sendfile. Files that are
+# requested by several overlapping soundings are archived once.
+#
+import errno
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import traceback
+
+import numpy as n
+
+import chirp_util as cu
+
+
+def iq_fname(conf, t):
+    """
+    The digital rf file (one second long) with data at unix second t.
+    """
+    t = int(t)
+    return ("%s/%s/%s/rf@%d.000.h5" % (conf.data_dir, conf.channel, cu.unix2drfdirname(t), t))
+
+
+def archive_dname(conf, t):
+    return ("%s/%s/raw_iq" % (conf.output_dir, cu.unix2dirname(int(t))))
+
+
+def copy_file(src, dst):
+    """
+    Copy src to dst in the kernel if possible.
+    """
+    with open(src, "rb") as fi, open(dst, "wb") as fo:
+        size = os.fstat(fi.fileno()).st_size
+        done = 0
+        try:
+            while done < size:
+                m = os.copy_file_range(fi.fileno(), fo.fileno(), size - done)
+                if m == 0:
+                    break
+                done += m
+        except (AttributeError, OSError):
+            # no copy_file_range (python < 3.8 or file system support)
+            try:
+                while done < size:
+                    m = os.sendfile(fo.fileno(), fi.fileno(), done, size - done)
+                    if m == 0:
+                        break
+                    done += m
+            except (AttributeError, OSError):
+                fi.seek(done)
+                fo.seek(done)
+                shutil.copyfileobj(fi, fo)
+
+
+def archive_file(src, dst):
+    """
+    Hard link src to dst, or copy it if it is on another file system.
+    Returns False if dst already exists.
+    """
+    if os.path.exists(dst):
+        return (False)
+    try:
+        os.link(src, dst)
+        return (True)
+    except FileExistsError:
+        return (False)
+    except OSError as e:
+        if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP]:
+            raise
+    # copy to a temporary name, so that a partial file is never archived
+    tmp = "%s.tmp%d" % (dst, os.getpid())
+    try:
+        copy_file(src, tmp)
+        os.rename(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return (True)
+
+
+def archive_files(conf, q):
+    """
+    Archive the files of the unix seconds in queue q, until None.
+    """
+    while True:
+        t = q.get()
+        if t is None:
+            break
+        src = iq_fname(conf, t)
+        if not os.path.exists(src):
+            # not recorded, or already removed from the ringbuffer
+            continue
+        try:
+            dname = archive_dname(conf, t)
+            os.makedirs(dname, exist_ok=True)
+            archive_file(src, "%s/%s" % (dname, os.path.basename(src)))
+        except:
+            print("error archiving %s" % (src))
+            traceback.print_exc(file=sys.stdout)
+
+
+class iq_archiver:
+    def __init__(self, conf):
+        """
+        Start the archiving process.
+        """
+        self.conf = conf
+        self.q = mp.Queue()
+        # seconds already requested, for soundings that overlap
+        self.requested = set()
+        self.proc = mp.Process(target=archive_files, args=(conf, self.q), daemon=True)
+        self.proc.start()
+
+    def archive(self, t0, t1):
+        """
+        Archive the raw voltage between unix seconds t0 and t1.
+        """
+        for t in range(int(n.floor(t0)), int(n.ceil(t1))):
+            if t not in self.requested:
+                self.requested.add(t)
+                self.q.put(t)
+        # forget old requests
+        if len(self.requested) > 100000:
+            self.requested = set([t for t in self.requested if t >= t0 - 3600])
+
+    def close(self):
+        """
+        Archive the remaining requests and stop the process.
+        """
+        self.q.put(None)
+        self.proc.join()
@@ -20,15 +20,34 @@ class chirp_config:
                        "threshold_snr": "13.0",
                        "max_simultaneous_detections": "5",
                        "min_detections": "3",
+                       "min_refined_detections": "2",
+                       "refined_timing_window": "0.02",
+                       "fine_chirp_search": "false",
+                       "merge_detections": "true",
+                       "detection_merge_dt": "0.02",
+                       "detection_merge_horizon": "5.0",
                        "step": "1",
                        "n_samples_per_block": "5000000",
                        "minimum_frequency_spacing": "0.2e6",
                        "chirp_rates": "[50e3,100e3,125e3,500.0084e3]",
+                       "chirp_rate_step": "null",
                        "chirp_rep_times": "[300.0,300.0,300.0,60.0]",
                        "output_dir": '"./chirp2"',
                        "range_resolution": "2e3",
                        "frequency_resolution": "50e3",
                        "max_range_extent": "2000e3",
+                       "min_range": "null",
+                       "zoom_ionograms": "false",
+                       "streaming_ionograms": "false",
+                       "ionogram_format": '"float32"',
+                       "raw_voltage_format": '"complex64"',
+                       "compression": "null",
+                       "daily_archive": "false",
+                       "spectrum_summary": "false",
+                       "spectrum_summary_bins": "1024",
+                       "spectrum_summary_interval": "10.0",
+                       "minimum_analysis_frequency": "null",
+                       "maximum_analysis_frequency": "null",
                        "plot_timings": "false",
                        "realtime": "false",
                        "decimation": "1250",
@@ -37,9 +56,24 @@ class chirp_config:
                        "serendipitous": "false",
                        "sounder_timings": '[{"chirp-rate":500.0084e3,"rep":60.0,"chirpt":54.0016,"id":5}]',
                        "n_downconversion_threads": "4",
+                       "pin_downconversion_threads": "false",
+                       "dechirp_kernel": '"recurrence"',
+                       "decimation_filter": '"sinc"',
+                       "group_soundings": "true",
+                       "max_group_size": "6",
+                       "n_read_buffers": "3",
+                       "n_plot_processes": "2",
+                       "plot_mode": '"full"',
+                       "plot_format": '"png"',
+                       "plot_size": "[1200, 900]",
+                       "thumbnail_size": "null",
+                       "noise_floor_method": '"exact"',
+                       "normalized_ionograms": "false",
+                       "realtime_scheduler": '"static"',
                        "output_dir_time": "0",
-                       "data_staging_dir": "/dev/shm/hf25_tmp",
-                       "save_chirp_iq": "true"}
+                       "save_chirp_iq": "false",
+                       "use_index": "true",
+                       "index_file": '""'}
 
         if fname != None:
             if os.path.exists(fname):
@@ -53,6 +87,22 @@ class chirp_config:
         self.debug_timings = json.loads(c["config"]["debug_timings"])
         self.serendipitous = json.loads(c["config"]["serendipitous"])
         self.min_detections = int(json.loads(c["config"]["min_detections"]))
+        # detections with precise timing (chirp_time_std below a third of the
+        # refined timing window) can confirm a sounder with fewer hits, if
+        # they agree within the refined timing window (s)
+        self.min_refined_detections = int(
+            json.loads(c["config"]["min_refined_detections"]))
+        self.refined_timing_window = json.loads(
+            c["config"]["refined_timing_window"])
+        # refine detected frequency with a local fine resolution dechirp
+        self.fine_chirp_search = json.loads(c["config"]["fine_chirp_search"])
+        # merge detections of the same chirp (same chirp-rate, chirp-time within
+        # detection_merge_dt s). a merged detection is written when no hit has
+        # been found for detection_merge_horizon s of data, after the sweep
+        self.merge_detections = json.loads(c["config"]["merge_detections"])
+        self.detection_merge_dt = json.loads(c["config"]["detection_merge_dt"])
+        self.detection_merge_horizon = json.loads(
+            c["config"]["detection_merge_horizon"])
         self.sounder_timings = json.loads(c["config"]["sounder_timings"])
         self.decimation = json.loads(c["config"]["decimation"])
         self.chirp_rep_times = json.loads(c["config"]["chirp_rep_times"])
@@ -61,12 +111,76 @@ class chirp_config:
         self.data_dir = json.loads(c["config"]["data_dir"])
         self.n_downconversion_threads = json.loads(
             c["config"]["n_downconversion_threads"])
+        # pin the downconversion threads of each mpi process to their own cpus
+        self.pin_downconversion_threads = json.loads(
+            c["config"]["pin_downconversion_threads"])
+        # "recurrence" (vectorized) or "table" (scalar phasor table lookup)
+        self.dechirp_kernel = json.loads(c["config"]["dechirp_kernel"])
+        # "sinc" (windowed sinc at the full sample rate) or
+        # "multistage" (cic + compensating fir)
+        self.decimation_filter = json.loads(c["config"]["decimation_filter"])
+        # downconvert soundings that overlap in time with one read of the data
+        self.group_soundings = json.loads(c["config"]["group_soundings"])
+        self.max_group_size = json.loads(c["config"]["max_group_size"])
+        # input windows read ahead while downconverting
+        self.n_read_buffers = json.loads(c["config"]["n_read_buffers"])
+        # processes plotting ionograms in plot_ionograms.py
+        self.n_plot_processes = json.loads(c["config"]["n_plot_processes"])
+        # "full" (pcolormesh) or "fast" (color lookup table, see chirp_render)
+        self.plot_mode = json.loads(c["config"]["plot_mode"])
+        # "png" or "webp" (needs PIL)
+        self.plot_format = json.loads(c["config"]["plot_format"])
+        # plot size in pixels [width, height]
+        self.plot_size = json.loads(c["config"]["plot_size"])
+        # thumbnail size in pixels, e.g., [240, 180], or null for no thumbnails
+        self.thumbnail_size = json.loads(c["config"]["thumbnail_size"])
+        # median over range of each frequency: "exact" or "subsample" (see chirp_norm)
+        self.noise_floor_method = json.loads(c["config"]["noise_floor_method"])
+        # also store the noise normalized ionogram (S_norm), so that the
+        # plotting and cropping programs don't normalize again
+        self.normalized_ionograms = json.loads(c["config"]["normalized_ionograms"])
+        # "static" (sounder_timings[rank] on each rank) or
+        # "shared" (rank 0 schedules all sounders to any free rank)
+        self.realtime_scheduler = json.loads(c["config"]["realtime_scheduler"])
         self.max_range_extent = json.loads(c["config"]["max_range_extent"])
+        # range gates stored are min_range < r < max_range_extent
+        # (null is -max_range_extent)
+        self.min_range = json.loads(c["config"]["min_range"])
+        if self.min_range is None:
+            self.min_range = -self.max_range_extent
+        # only compute the stored range gates (zoom fft)
+        self.zoom_ionograms = json.loads(c["config"]["zoom_ionograms"])
+        # write the ionogram rows during the sweep instead of at the end
+        self.streaming_ionograms = json.loads(c["config"]["streaming_ionograms"])
+        # storage of the ionogram files (see chirp_storage):
+        # S as "float32", "float16", "log_uint16" or "log_uint8",
+        # z as "complex64" or "int16", compressed with null, "lzf" or "gzip"
+        self.ionogram_format = json.loads(c["config"]["ionogram_format"])
+        self.raw_voltage_format = json.loads(c["config"]["raw_voltage_format"])
+        self.compression = json.loads(c["config"]["compression"])
+        # also append each ionogram to a daily archive per sounder (see chirp_daily)
+        self.daily_archive = json.loads(c["config"]["daily_archive"])
+        # average the spectrum of the detected blocks into spectrum_summary_bins
+        # frequency bins and spectrum_summary_interval s (see chirp_spectrum)
+        self.spectrum_summary = json.loads(c["config"]["spectrum_summary"])
+        self.spectrum_summary_bins = json.loads(c["config"]["spectrum_summary_bins"])
+        self.spectrum_summary_interval = json.loads(c["config"]["spectrum_summary_interval"])
+        # frequencies of the sweeps that are analyzed
+        # (null is the band of the recording, see analysis_band)
+        self.minimum_analysis_frequency = json.loads(
+            c["config"]["minimum_analysis_frequency"])
+        self.maximum_analysis_frequency = json.loads(
+            c["config"]["maximum_analysis_frequency"])
         self.n_samples_per_block = json.loads(
             c["config"]["n_samples_per_block"])
         self.sample_rate = json.loads(c["config"]["sample_rate"])
         self.center_freq = json.loads(c["config"]["center_freq"])
         self.chirp_rates = json.loads(c["config"]["chirp_rates"])
+        # step (Hz/s) of chirp_rates if they are a grid covering sounders of
+        # unknown chirp-rate, null if the sounders have the listed rates. the
+        # chirp-time uncertainty includes a rate error of half the step, at
+        # least the rate resolution (sample_rate/n_samples_per_block)^2
+        self.chirp_rate_step = json.loads(c["config"]["chirp_rate_step"])
         self.range_resolution = json.loads(c["config"]["range_resolution"])
         self.frequency_resolution = json.loads(
             c["config"]["frequency_resolution"])
@@ -74,19 +188,12 @@ class chirp_config:
         self.step = json.loads(c["config"]["step"])
         self.output_dir = json.loads(c["config"]["output_dir"])
         self.output_dir_time = json.loads(c["config"]["output_dir_time"])
-        if c["config"]["realtime"] == 'true':
-            self.data_staging_dir = json.loads(c["config"]["data_staging_dir"])
+        # archive the raw voltage of the soundings found with serendipitous analysis
+        # (copies several GB per sounding if the files can't be hard linked)
         self.save_chirp_iq = json.loads(c["config"]["save_chirp_iq"])
-
-        try:
-            os.mkdir(self.output_dir)
-        except:
-            pass
-
-        if not os.path.exists(self.output_dir):
-            print("Output directory %s doesn't exists and cannot be created" %
-                  (self.output_dir))
-            exit(0)
+        # sqlite index of all products (empty name: output_dir/index.sqlite)
+        self.use_index = json.loads(c["config"]["use_index"])
+        self.index_file = json.loads(c["config"]["index_file"])
 
         if (self.output_dir_time == 0):
             self.output_dir_time = time.time()
@@ -104,14 +211,58 @@ class chirp_config:
             c["config"]["max_simultaneous_detections"])
         # the smallest normalized snr that is detected
         self.threshold_snr = json.loads(c["config"]["threshold_snr"])
+        # made when first used (see fvec)
+        self._fvec = None
+
+    @property
+    def fvec(self):
+        """
+        Frequencies (Hz) of the fftshifted bins of the detector FFT.
+        """
+        if self._fvec is None:
+            self._fvec = n.fft.fftshift(n.fft.fftfreq(self.n_samples_per_block,
+                                                      d=1.0 / float(self.sample_rate))) + self.center_freq
+        return (self._fvec)
+
+    def make_output_dir(self):
+        """
+        Create output_dir. Called by the programs that write into it,
+        the others don't need it to exist.
+        """
+        try:
+            os.mkdir(self.output_dir)
+        except:
+            pass
+
+        if not os.path.exists(self.output_dir):
+            print("Output directory %s doesn't exists and cannot be created" %
+                  (self.output_dir))
+            exit(0)
 
-        self.fvec = n.fft.fftshift(n.fft.fftfreq(self.n_samples_per_block,
-                                                 d=1.0 / float(self.sample_rate))) + self.center_freq
+    def analysis_band(self, sample_rate=None, center_freq=None):
+        """
+        The frequency interval (f_min, f_max) of the sweeps that is analyzed,
+        limited to the band of the recording.
+        """
+        if sample_rate is None:
+            sample_rate = self.sample_rate
+        if center_freq is None:
+            center_freq = self.center_freq
+        f_min = max(0.0, center_freq - sample_rate / 2.0)
+        f_max = center_freq + sample_rate / 2.0
+        if self.minimum_analysis_frequency is not None:
+            f_min = max(f_min, self.minimum_analysis_frequency)
+        if self.maximum_analysis_frequency is not None:
+            f_max = min(f_max, self.maximum_analysis_frequency)
+        return (f_min, f_max)
 
     def __str__(self):
         out = "Configuration\n"
         for e in dir(self):
-            if not callable(getattr(self, e)) and not e.startswith("__"):
+            # leave out the lazily derived arrays
+            if e.startswith("_") or isinstance(getattr(type(self), e, None), property):
+                continue
+            if not callable(getattr(self, e)):
                 out += "%s = %s\n" % (e, getattr(self, e))
         return (out)
 
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+#
+# Daily archive of ionograms. All ionograms of one sounder during one day
+# are appended to output_dir/<day>/iono_archive-<id>.h5, instead of being
+# read from thousands of lfm_ionogram-*.h5 files.
+#
+# Each record has the metadata (t0, id, rate, sr, ch) and the arrays
+# (S, freqs, ranges and ridx if present). The arrays are concatenated
+# into extendable datasets, with the start and shape of each record, so
+# any record can be read without reading the others. S is stored in the
+# format of chirp_storage. Records are found by t0 with an in-memory
+# index that is built when the archive is opened.
+#
+# Writers (several mpi ranks) are serialized with flock on a lock file
+# next to the archive.
+#
+# Convert existing ionogram files into daily archives:
+#   python chirp_daily.py config.ini
+# and also remove the converted files:
+#   python chirp_daily.py config.ini --remove
+#
+import argparse
+import fcntl
+import os
+import sys
+import traceback
+
+import h5py
+import numpy as n
+
+import chirp_config as cc
+import chirp_index as ci
+import chirp_storage as cst
+import chirp_util as cu
+
+# arrays of each record, in addition to S
+array_fields = ["freqs", "ranges", "ridx"]
+scalar_fields = ["t0", "id", "rate", "sr"]
+
+
+def archive_fname(conf, t0, cid):
+    return ("%s/%s/iono_archive-%03d.h5" % (conf.output_dir, cu.unix2dirname(t0), cid))
+
+
+def time_key(t0):
+    # ionogram files are named with t0 at this precision
+    return ("%1.2f" % (t0))
+
+
+class daily_archive:
+    def __init__(self, fname, mode="r"):
+        """
+        Open an archive for reading ("r") or appending ("a").
+        """
+        self.fname = fname
+        self.lock = open("%s.lock" % (fname), "a")
+        if mode == "r":
+            fcntl.flock(self.lock, fcntl.LOCK_SH)
+        else:
+            fcntl.flock(self.lock, fcntl.LOCK_EX)
+        try:
+            self.h = h5py.File(fname, mode)
+        except:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+            self.lock.close()
+            raise
+        self.index = {}
+        if "t0" in self.h.keys():
+            for i, t0 in enumerate(self.h["t0"][()]):
+                self.index[time_key(t0)] = i
+
+    def __len__(self):
+        return (len(self.index))
+
+    def lookup(self, t0):
+        """
+        The record number of the ionogram starting at t0, or None.
+        """
+        return (self.index.get(time_key(t0)))
+
+    def times(self):
+        if "t0" not in self.h.keys():
+            return (n.zeros(0))
+        return (n.copy(self.h["t0"]))
+
+    def create(self, rec, fmt, compression):
+        h = self.h
+        D, fmt, attrs = cst.encode_S(rec["S"], fmt)
+        h.attrs["S_format"] = fmt
+        h.create_dataset("S", shape=(0,), maxshape=(None,), dtype=D.dtype,
+                         **extendable_args(compression, 1024 * 1024))
+        h.create_dataset("S_start", shape=(0,), maxshape=(None,), dtype=n.int64, chunks=(1024,))
+        h.create_dataset("S_shape", shape=(0, D.ndim), maxshape=(None, D.ndim),
+                         dtype=n.int64, chunks=(1024, D.ndim))
+        for k in ["S_scale", "S_offset"]:
+            h.create_dataset(k, shape=(0,), maxshape=(None,), dtype=n.float64, chunks=(1024,))
+        for k in array_fields:
+            if k in rec.keys():
+                dtype = n.asarray(rec[k]).dtype
+                h.create_dataset(k, shape=(0,), maxshape=(None,), dtype=dtype,
+                                 **extendable_args(compression, 65536))
+                h.create_dataset("%s_start" % (k), shape=(0,), maxshape=(None,),
+                                 dtype=n.int64, chunks=(1024,))
+                h.create_dataset("%s_len" % (k), shape=(0,), maxshape=(None,),
+                                 dtype=n.int64, chunks=(1024,))
+        for k in scalar_fields:
+            dtype = n.int64 if k == "id" else n.float64
+            h.create_dataset(k, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(1024,))
+        h.create_dataset("ch", shape=(0,), maxshape=(None,),
+                         dtype=h5py.string_dtype(), chunks=(1024,))
+
+    def append(self, rec, fmt="float32", compression=None):
+        """
+        Append an ionogram record (dict with S, freqs, ranges, t0, id, rate,
+        sr, ch and optionally ridx). S is stored in format fmt (chirp_storage).
+        Returns the record number. An ionogram already in the archive isn't added again.
+        """
+        i = self.lookup(rec["t0"])
+        if i is not None:
+            return (i)
+        h = self.h
+        if "t0" not in h.keys():
+            self.create(rec, fmt, compression)
+        i = h["t0"].shape[0]
+
+        D, fmt, attrs = cst.encode_S(rec["S"], h.attrs["S_format"].replace("complex_", ""))
+        s0 = h["S"].shape[0]
+        h["S"].resize((s0 + D.size,))
+        h["S"][s0:(s0 + D.size)] = D.ravel()
+        append_value(h["S_start"], s0)
+        append_value(h["S_shape"], D.shape)
+        append_value(h["S_scale"], attrs.get("scale", n.nan))
+        append_value(h["S_offset"], attrs.get("offset", n.nan))
+
+        for k in array_fields:
+            if k not in h.keys():
+                continue
+            a = n.asarray(rec.get(k, n.zeros(0)), dtype=h[k].dtype)
+            a0 = h[k].shape[0]
+            h[k].resize((a0 + len(a),))
+            h[k][a0:(a0 + len(a))] = a
+            append_value(h["%s_start" % (k)], a0)
+            append_value(h["%s_len" % (k)], len(a))
+        for k in scalar_fields:
+            append_value(h[k], rec[k])
+        append_value(h["ch"], rec["ch"])
+        self.index[time_key(rec["t0"])] = i
+        return (i)
+
+    def get(self, i):
+        """
+        Record number i as a dict, with S restored.
+        """
+        h = self.h
+        rec = {}
+        shape = tuple(h["S_shape"][i])
+        s0 = h["S_start"][i]
+        D = h["S"][s0:(s0 + int(n.prod(shape)))].reshape(shape)
+        rec["S"] = cst.decode(D, h.attrs["S_format"],
+                              {"scale": h["S_scale"][i], "offset": h["S_offset"][i]})
+        for k in array_fields:
+            if k in h.keys():
+                a0 = h["%s_start" % (k)][i]
+                rec[k] = h[k][a0:(a0 + h["%s_len" % (k)][i])]
+        for k in scalar_fields:
+            rec[k] = h[k][i]
+        rec["ch"] = h["ch"][i]
+        if isinstance(rec["ch"], bytes):
+            rec["ch"] = rec["ch"].decode()
+        return (rec)
+
+    def close(self):
+        self.h.close()
+        fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.lock.close()
+
+
+def extendable_args(compression, chunk_len):
+    """
+    Chunking (needed to extend a dataset) and compression of a 1d dataset.
+    """
+    args = cst.filter_args(compression, (chunk_len,), chunk_len)
+    args["chunks"] = (chunk_len,)
+    return (args)
+
+
+def append_value(ds, v):
+    i = ds.shape[0]
+    ds.resize((i + 1,) + ds.shape[1:])
+    ds[i] = v
+
+
+def read_ionogram_file(fname):
+    """
+    An ionogram file as a record for the daily archive,
+    or None if it isn't complete.
+    """
+    h = h5py.File(fname, "r", swmr=True)
+    try:
+        if "complete" in h.keys() and not bool(n.copy(h["complete"])):
+            return (None)
+        rec = {"S": cst.read(h, "S")}
+        for k in array_fields:
+            if k in h.keys():
+                rec[k] = n.copy(h[k])
+        for k in scalar_fields:
+            rec[k] = n.copy(h[k])[()]
+        rec["ch"] = h["ch"][()]
+        if isinstance(rec["ch"], bytes):
+            rec["ch"] = rec["ch"].decode()
+    finally:
+        h.close()
+    return (rec)
+
+
+def add_ionogram(conf, fname):
+    """
+    Append the ionogram file fname to its daily archive.
+    """
+    rec = read_ionogram_file(fname)
+    if rec is None:
+        return (False)
+    da = daily_archive(archive_fname(conf, rec["t0"], rec["id"]), "a")
+    try:
+        da.append(rec, conf.ionogram_format, conf.compression)
+    finally:
+        da.close()
+    return (True)
+
+
+def convert(conf, remove=False):
+    """
+    Append all ionogram files in output_dir to the daily archives.
+    """
+    n_added = 0
+    open_archives = {}
+    try:
+        for f in ci.find_files(conf, "ionogram"):
+            try:
+                rec = read_ionogram_file(f)
+                if rec is None:
+                    print("%s is not complete. Skipping" % (f))
+                    continue
+                afname = archive_fname(conf, rec["t0"], rec["id"])
+                if afname not in open_archives:
+                    open_archives[afname] = daily_archive(afname, "a")
+                open_archives[afname].append(rec, conf.ionogram_format, conf.compression)
+                n_added += 1
+                if remove:
+                    open_archives[afname].h.flush()
+                    os.remove(f)
+                    idx = ci.get_index(conf)
+                    if idx is not None:
+                        idx.remove(f)
+            except:
+                print("Couldn't archive %s" % (f))
+                traceback.print_exc(file=sys.stdout)
+            # don't keep archives of previous days open
+            if len(open_archives) > 64:
+                for a in open_archives.values():
+                    a.close()
+                open_archives = {}
+    finally:
+        for a in open_archives.values():
+            a.close()
+    return (n_added)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(
+        description="Append ionogram files to daily archives")
+    p.add_argument("config", nargs="?", default=None)
+    p.add_argument("--remove", action="store_true",
+                   help="remove the ionogram files that were archived")
+    args = p.parse_args()
+
+    conf = cc.chirp_config(args.config)
+    print("archived %d ionograms" % (convert(conf, args.remove)))
@@ -3,42 +3,69 @@
 # data format agnostic generic chirp detector
 # juha vierinen 2020
 #
-import datetime
-import scipy.constants as c
-import h5py
 import numpy as n
-import scipy.signal as ss
-import matplotlib.pyplot as plt
-import time
 import os
-import scipy.fftpack
-fftw = False
-try:
-    import pyfftw
-    fftw = True
-    print("using pyfftw")
-except:
-    print("couldn't load pyfftw, reverting to scipy. performance will suffer")
-    fftw = False
+import chirp_index as ci
+# the time helpers are in chirp_util, also available here
+from chirp_util import unix2date, unix2datestr, unix2dirname, unix2drfdirname
+
+# pyfftw is tried on the first fft (see use_fftw)
+fftw = None
+
+
+def use_fftw():
+    """
+    True if pyfftw can be used. It is only imported when first needed,
+    so that programs that don't do FFTs start faster.
+    """
+    global fftw, pyfftw
+    if fftw is None:
+        try:
+            import pyfftw
+            fftw = True
+            print("using pyfftw")
+        except:
+            print("couldn't load pyfftw, reverting to scipy. performance will suffer")
+            fftw = False
+    return (fftw)
 
 
 def power(x):
     return (x.real**2.0 + x.imag**2.0)
 
 
+def interpolate_peak(a, b, c):
+    """
+    Fractional offset of a spectral peak from the center sample b, given
+    the power of the neighbouring samples a and c. Gaussian interpolation,
+    which is nearly unbiased for hann windowed spectra.
+    """
+    if a <= 0.0 or b <= 0.0 or c <= 0.0:
+        return (0.0)
+    la = n.log(a)
+    lb = n.log(b)
+    lc = n.log(c)
+    den = la - 2.0 * lb + lc
+    if den >= 0.0:
+        return (0.0)
+    return (n.clip(0.5 * (la - lc) / den, -0.5, 0.5))
+
+
 def fft(x):
-    if fftw:
+    if use_fftw():
         # ,planner_effort='FFTW_ESTIMATE'))
         return (pyfftw.interfaces.numpy_fft.fft(x))
     else:
+        import scipy.fftpack
         return (scipy.fftpack.fft(x))
 
 
 def ifft(x):
-    if fftw:
+    if use_fftw():
         # ,planner_effort='FFTW_ESTIMATE'))
         return (pyfftw.interfaces.numpy_fft.ifft(x))
     else:
+        import scipy.fftpack
         return (scipy.fftpack.ifft(x))
 
 
@@ -58,25 +85,22 @@ def debug1(msg):
         print(msg)
 
 
-def unix2date(x):
-    # ATC bug-fix for python3
-    return datetime.datetime.utcfromtimestamp(float(x))
-
-
-def unix2datestr(x):
-    return (unix2date(x).strftime('%Y-%m-%d %H:%M:%S'))
-
-
-def unix2dirname(x):
-    return (unix2date(x).strftime('%Y-%m-%d'))
-
-
-def unix2drfdirname(x):
-    return (unix2date(x).strftime('%Y-%m-%dT%H-00-00'))
+def chirp_rate_error(conf):
+    """
+    How far (Hz/s) the rate of a chirp can be from the filter that detects
+    it: half of conf.chirp_rate_step, and at least the chirp-rate resolution
+    of a block (1/T^2), as filters closer than that can't tell the
+    rates apart.
+    """
+    dr = conf.df**2.0
+    if conf.chirp_rate_step is not None:
+        dr = max(dr, 0.5 * conf.chirp_rate_step)
+    return (dr)
 
 
 class chirp_matched_filter_bank:
     def __init__(self, conf):
+        import scipy.signal as ss
         self.conf = conf
 
         # create chirp signal vectors
@@ -89,6 +113,13 @@ class chirp_matched_filter_bank:
             chirp_vec = n.array(self.wf * n.conj(self.chirpf(cr=cr)))
             self.chirps.append(chirp_vec)
         self.n_chirps = len(self.chirps)
+        self.rate_error = chirp_rate_error(self.conf)
+
+        # long term spectrum from the whitening FFT (see chirp_spectrum)
+        self.spectrum = None
+        if self.conf.spectrum_summary:
+            import chirp_spectrum as csp
+            self.spectrum = csp.spectrum_summary(self.conf)
 
     def chirpf(self, cr=160e3):
         """
@@ -103,13 +134,59 @@ class chirp_matched_filter_bank:
             n.exp(1j * 2 * n.pi * f0 * tv)
         return (n.array(chirp, dtype=n.complex64))
 
-    def seek(self, z, i0):
+    def refine_frequency(self, mf, mi, x=None):
+        """
+        Sub-bin estimate of the frequency of a matched filter peak.
+        mf power spectrum of the dechirped signal (fftshifted)
+        mi index of the peak
+        x optional windowed and dechirped signal. If given, the estimate
+          is refined further by evaluating the spectrum on a fine grid
+          around the peak.
+        Returns the frequency (Hz) and its standard deviation (Hz).
+        """
+        df = self.conf.df
+        snr = mf[mi]
+        delta = 0.0
+        if mi > 0 and mi < len(mf) - 1:
+            delta = interpolate_peak(mf[mi - 1], mf[mi], mf[mi + 1])
+        f0 = self.conf.fvec[mi] + delta * df
+
+        if x is not None:
+            # local fine resolution dechirp with quarter bin spacing
+            h = 0.25 * df
+            tv = n.arange(len(x), dtype=n.float64) / self.conf.sample_rate
+            fb = f0 - self.conf.center_freq
+            p = [power(n.sum(x * n.exp(-1j * 2.0 * n.pi * (fb + k * h) * tv))) for k in [-1, 0, 1]]
+            f0 = f0 + interpolate_peak(p[0], p[1], p[2]) * h
+
+        # Cramer-Rao bound of a single tone frequency estimate
+        # for the coherent integration length, with a factor 1.5 loss
+        # due to the hann window, plus a small interpolation bias floor
+        f0_std = n.sqrt(1.5 * 12.0 / n.max([snr, 1.0])) * df / (2.0 * n.pi)
+        f0_std = n.sqrt(f0_std**2.0 + (0.02 * df)**2.0)
+        return (f0, f0_std)
+
+    def chirp_time_std(self, cri, t0, chirp_time, f0_std):
+        """
+        Standard deviation (s) of a chirp-time estimated from a block
+        starting at t0 with chirp-rate filter cri.
+        A chirp whose rate differs by dr from the filter peaks at the mean
+        frequency of the block, so the chirp-time is off by dr times the
+        time from the chirp-time to the center of the block, divided by
+        the rate. dr is up to chirp_rate_error.
+        """
+        rate = self.conf.chirp_rates[cri]
+        t_mid = t0 + 0.5 * self.conf.n_samples_per_block / self.conf.sample_rate
+        rate_std = self.rate_error * n.abs(t_mid - chirp_time) / rate
+        return (n.sqrt((f0_std / rate)**2.0 + rate_std**2.0))
+
+    def detect(self, z, i0):
         """
         Look for chirps in data vector
         z data vector
         i0 time of the leading edge of the vector
+        Returns a list of detections (dicts)
         """
-        cput0 = time.time()
         n_samps = len(z)
 
         t0 = i0 / self.conf.sample_rate
@@ -120,6 +197,8 @@ class chirp_matched_filter_bank:
 
         # whiten noise with a regularized filter
         Z = fft(self.wf * z)
+        if self.spectrum is not None:
+            self.spectrum.add(t0, Z)
         z = ifft(Z / (n.abs(Z) + 1e-9))
 
         # matched filter output
@@ -145,9 +224,7 @@ class chirp_matched_filter_bank:
             # store snippet of the spectrum
 
         # detect peaks
-        snrs = []
-        chirp_rates = []
-        frequencies = []
+        detections = []
         for i in range(self.conf.max_simultaneous_detections):
             mi = n.argmax(mf_p)
             # CLEAN detect peaks
@@ -159,41 +236,175 @@ class chirp_matched_filter_bank:
             # clear region around detection
             mf_p[n.max([0, mi - self.conf.mfsi]):n.min([mi + self.conf.mfsi, n_samps - 1])] = 0.0
             # this is the chirp rate we've detected
-            detected_chirp_rate = self.conf.chirp_rates[mf_chirp_rate_idx[mi]]
+            cri = mf_chirp_rate_idx[mi]
+            detected_chirp_rate = self.conf.chirp_rates[cri]
 
             # did we find a chirp?
             if snr_max > self.conf.threshold_snr:
+                # refine the frequency below the fft bin width
+                x = None
+                if self.conf.fine_chirp_search:
+                    x = self.wf * self.chirps[cri] * z
+                f0, f0_std = self.refine_frequency(mf[cri, :], mi, x)
                 # the virtual start time
                 chirp_time = t0 - f0 / detected_chirp_rate
-                debug1("found chirp snr %1.2f chirp-rate %1.2f f0 %1.2f chirp_time %1.4f %s" %
-                       (snr_max, detected_chirp_rate / 1e3, f0 / 1e6, chirp_time, unix2datestr(chirp_time)))
-                snrs.append(snr_max)
-                chirp_rates.append(detected_chirp_rate)
-                frequencies.append(f0)
-
-                dname = "%s/%s" % (self.conf.output_dir,
-                                   unix2dirname(float(i0) / self.conf.sample_rate))
-
-                if not os.path.exists(dname):
-                    print("creating %s" % (dname))
-                    os.mkdir(dname)
-
-                # tbd: make an hour directory
-                ofname = "%s/chirp-%d.h5" % (dname,
-                                             i0)
-                ho = h5py.File(ofname, "w")
-                ho["f0"] = f0
-                ho["i0"] = i0
-                ho["sample_rate"] = self.conf.sample_rate
-                ho["n_samples"] = n_samps
-                ho["chirp_time"] = chirp_time
-                ho["chirp_rate"] = detected_chirp_rate
-                ho["snr"] = snr_max
-                debug1("saving %s" % (ofname))
-                ho.close()
-
-        cput1 = time.time()
-
-        data_dt = (n_samps / float(self.conf.sample_rate))
+                chirp_time_std = self.chirp_time_std(cri, t0, chirp_time, f0_std)
+                debug1("found chirp snr %1.2f chirp-rate %1.2f f0 %1.2f chirp_time %1.6f+/-%1.6f %s" %
+                       (snr_max, detected_chirp_rate / 1e3, f0 / 1e6, chirp_time, chirp_time_std, unix2datestr(chirp_time)))
+                detections.append({"f0": f0,
+                                   "i0": i0,
+                                   "n_samples": n_samps,
+                                   "chirp_time": chirp_time,
+                                   "f0_std": f0_std,
+                                   "chirp_time_std": chirp_time_std,
+                                   "chirp_rate": detected_chirp_rate,
+                                   "snr": snr_max,
+                                   "n_hits": 1})
+        return (detections)
+
+    def seek(self, z, i0):
+        """
+        Look for chirps in data vector and save each detection
+        z data vector
+        i0 time of the leading edge of the vector
+        """
+        detections = self.detect(z, i0)
+        snrs = []
+        chirp_rates = []
+        frequencies = []
+        for di, det in enumerate(detections):
+            save_detection(self.conf, det, di)
+            snrs.append(det["snr"])
+            chirp_rates.append(det["chirp_rate"])
+            frequencies.append(det["f0"])
 
         return (snrs, chirp_rates, frequencies)
+
+    def close(self):
+        """
+        Write the spectrum summary of the last interval.
+        """
+        if self.spectrum is not None:
+            self.spectrum.flush()
+
+
+def save_detection(conf, det, di=0):
+    """
+    Write a detection into a chirp-*.h5 file.
+    di numbers detections that share the same leading edge i0.
+    """
+    import h5py
+    i0 = det["i0"]
+    dname = "%s/%s" % (conf.output_dir,
+                       unix2dirname(float(i0) / conf.sample_rate))
+
+    if not os.path.exists(dname):
+        print("creating %s" % (dname))
+        os.mkdir(dname)
+
+    # tbd: make an hour directory
+    if di == 0:
+        ofname = "%s/chirp-%d.h5" % (dname, i0)
+    else:
+        ofname = "%s/chirp-%d-%d.h5" % (dname, i0, di)
+    ho = h5py.File(ofname, "w")
+    ho["f0"] = det["f0"]
+    ho["i0"] = i0
+    ho["sample_rate"] = conf.sample_rate
+    ho["n_samples"] = det["n_samples"]
+    ho["chirp_time"] = det["chirp_time"]
+    ho["f0_std"] = det["f0_std"]
+    ho["chirp_time_std"] = det["chirp_time_std"]
+    ho["chirp_rate"] = det["chirp_rate"]
+    ho["snr"] = det["snr"]
+    # number of merged detections of this chirp
+    ho["n_hits"] = det["n_hits"]
+    debug1("saving %s" % (ofname))
+    ho.close()
+    ci.register(conf, "detection", ofname, t0=det["chirp_time"],
+                chirp_rate=det["chirp_rate"], f0=det["f0"], snr=det["snr"])
+    return (ofname)
+
+
+class detection_aggregator:
+    def __init__(self, conf):
+        """
+        Merge detections of the same chirp before they are written to disk.
+        Detections with the same chirp-rate and a chirp-time within
+        conf.detection_merge_dt are combined into one record that holds the
+        number of hits, the best SNR and the combined chirp-time.
+        A record is written when no hit of it has been found for
+        conf.detection_merge_horizon seconds of data, so a chirp that is
+        detected during its whole sweep gives one record, written
+        after the sweep ends.
+        """
+        self.conf = conf
+        self.records = []
+        # how many detections have been saved for each leading edge
+        self.n_saved = {}
+
+    def add(self, det):
+        for r in self.records:
+            if n.abs(r["chirp_rate"] - det["chirp_rate"]) < 0.1 and \
+               n.abs(r["chirp_time"] - det["chirp_time"]) < self.conf.detection_merge_dt:
+                r["hits"].append(det)
+                r["t_first"] = n.min([r["t_first"], det["i0"] / self.conf.sample_rate])
+                r["t_last"] = n.max([r["t_last"], det["i0"] / self.conf.sample_rate])
+                self._combine(r)
+                return
+        self.records.append({"chirp_rate": det["chirp_rate"],
+                             "chirp_time": det["chirp_time"],
+                             "t_first": det["i0"] / self.conf.sample_rate,
+                             "t_last": det["i0"] / self.conf.sample_rate,
+                             "hits": [det]})
+
+    def _combine(self, r):
+        t = n.array([h["chirp_time"] for h in r["hits"]])
+        w = 1.0 / n.array([h["chirp_time_std"] for h in r["hits"]])**2.0
+        r["chirp_time"] = n.sum(w * t) / n.sum(w)
+
+    def record(self, r):
+        """
+        The merged detection: leading edge and frequency of the best hit,
+        weighted mean chirp-time, with an uncertainty that includes the
+        spread of the hits. The chirp-rate error is the same for all hits
+        of a chirp, so it isn't reduced by averaging.
+        """
+        hits = r["hits"]
+        best = hits[n.argmax([h["snr"] for h in hits])]
+        t = n.array([h["chirp_time"] for h in hits])
+        t_std = n.array([h["chirp_time_std"] for h in hits])
+        w = 1.0 / t_std**2.0
+        det = dict(best)
+        det["chirp_time"] = r["chirp_time"]
+        det["chirp_time_std"] = n.sqrt((n.sum(w * t_std) / n.sum(w))**2.0 + n.var(t))
+        det["n_hits"] = int(n.sum([h["n_hits"] for h in hits]))
+        return (det)
+
+    def flush(self, t_now=None):
+        """
+        Write records whose last hit is older than the merge horizon
+        at data time t_now, or all records if t_now is None.
+        Returns the number of detections that were written.
+        """
+        keep = []
+        done = []
+        for r in self.records:
+            if t_now is None or r["t_last"] + self.conf.detection_merge_horizon < t_now:
+                done.append(self.record(r))
+            else:
+                keep.append(r)
+        self.records = keep
+
+        # number detections that share a leading edge
+        for det in done:
+            di = self.n_saved.get(det["i0"], 0)
+            save_detection(self.conf, det, di)
+            self.n_saved[det["i0"]] = di + 1
+        if t_now is not None:
+            # the leading edges of the records still being merged are kept
+            t_old = n.min([t_now - 2.0 * self.conf.detection_merge_horizon] +
+                          [r["t_first"] for r in self.records])
+            self.n_saved = {i0: c for i0, c in self.n_saved.items()
+                            if i0 / self.conf.sample_rate > t_old}
+        return (len(done))
@@ -1,8 +1,41 @@
+#ifdef __linux__
+#define _GNU_SOURCE
+#include <sched.h>
+#endif
 #include "chirp_downconvert.h"
+#include <unistd.h>
 #include <stdint.h>
 #include <stdio.h>
 #include <pthread.h>
 #include <stdlib.h>
+#include <string.h>
+#include <math.h>
+
+/* dechirp kernels */
+#define KERNEL_TABLE 0
+#define KERNEL_RECURRENCE 1
+
+/* decimation filters */
+#define FILTER_SINC 0
+#define FILTER_MULTISTAGE 1
+#define CIC_ORDER 6
+
+/* samples advanced per iteration of the recurrence kernel */
+#define N_LANES 16
+/* exact phase re-anchoring interval of the recurrence (samples) */
+#define ANCHOR_LEN 1024
+
+/*
+  Runtime cpu dispatch: gcc compiles the recurrence kernel for avx512,
+  avx2 and the baseline target and picks one when the library is loaded.
+  Elsewhere (e.g., neon on aarch64) the baseline build is vectorized.
+ */
+#if defined(__GNUC__) && !defined(__clang__) && defined(__x86_64__) && defined(__linux__)
+#define DC_TARGET_CLONES __attribute__((target_clones("avx512f","avx2","default")))
+#else
+#define DC_TARGET_CLONES
+#endif
+
 void complex_mul(complex_float *a, complex_float *res)
 {
   float tmp;
@@ -57,11 +90,44 @@ struct arg_struct {
   float *wfun;
   int rank;
   int size;
+  int kernel;
+  /* multi-stage decimation */
+  int filter;
+  int cic_dec;
+  float *fir;
+  int fir_len;
+  int offset;
+  /* several chirps downconverted from the same input */
+  int n_targets;
+  double *chirpts;
+  double *f0s;
+  double *rates;
+  int64_t *in_offsets;
+  int64_t *out_offsets;
+  int *n_outs;
 };
 
-void *consume_one(void *args)
+void consume_range_recurrence(struct arg_struct *a);
+void consume_range_multistage(struct arg_struct *a);
+void consume_range_multi(struct arg_struct *a);
+
+void consume_range(struct arg_struct *a)
 {
-  struct arg_struct *a = args;
+  if(a->n_targets > 0)
+  {
+    consume_range_multi(a);
+    return;
+  }
+  if(a->filter == FILTER_MULTISTAGE)
+  {
+    consume_range_multistage(a);
+    return;
+  }
+  if(a->kernel == KERNEL_RECURRENCE)
+  {
+    consume_range_recurrence(a);
+    return;
+  }
   double chirpt=a->chirpt;
   double dt=a->dt;
   complex_float *sintab=a->sintab;
@@ -108,6 +174,386 @@ void *consume_one(void *args)
     }
     out_buffer[out_idx]=out_sample;
   }
+}
+
+/*
+  Conjugate chirp phase in cycles, exp(-2 pi i (f0 + 0.5 rate t) t).
+  Reduced to [0,1) in double precision.
+ */
+static double chirp_cycles(double t, double f0, double rate)
+{
+  double cyc = (f0+0.5*rate*t)*t;
+  return(cyc - floor(cyc));
+}
+
+/*
+  Dechirp and low-pass filter one output sample with a phasor recurrence.
+  Lane j handles samples j, j+N_LANES, j+2*N_LANES, ... Each lane phasor is
+  advanced by a per lane step phasor, which in turn is advanced by a
+  constant phasor (the phase of a chirp is quadratic in time). The phasors
+  are recomputed exactly every ANCHOR_LEN samples to bound the drift.
+ */
+DC_TARGET_CLONES
+static void dechirp_recurrence(const complex_float *in, const float *wfun, int dec2,
+                               double chirpt, double dt, double f0, double rate,
+                               complex_float *out)
+{
+  float pr[N_LANES], pi[N_LANES], dr[N_LANES], di[N_LANES];
+  float ar[N_LANES], ai[N_LANES];
+  float cr, ci;
+  double step_t = N_LANES*dt;
+  double c_cyc = rate*step_t*step_t;
+  c_cyc = c_cyc - floor(c_cyc);
+  cr = (float)cos(-2.0*M_PI*c_cyc);
+  ci = (float)sin(-2.0*M_PI*c_cyc);
+
+  for(int j=0; j<N_LANES; j++)
+  {
+    ar[j]=0.0f;
+    ai[j]=0.0f;
+  }
+
+  for(int k0=0; k0<dec2; k0+=ANCHOR_LEN)
+  {
+    int k1 = k0+ANCHOR_LEN;
+    if(k1 > dec2)
+      k1 = dec2;
+
+    /* exact phasors at the anchor */
+    for(int j=0; j<N_LANES; j++)
+    {
+      double t = chirpt + (k0+j)*dt;
+      double cyc = chirp_cycles(t, f0, rate);
+      /* phase advance of this lane per iteration */
+      double d_cyc = step_t*(f0 + rate*t + 0.5*rate*step_t);
+      d_cyc = d_cyc - floor(d_cyc);
+      pr[j] = (float)cos(-2.0*M_PI*cyc);
+      pi[j] = (float)sin(-2.0*M_PI*cyc);
+      dr[j] = (float)cos(-2.0*M_PI*d_cyc);
+      di[j] = (float)sin(-2.0*M_PI*d_cyc);
+    }
+
+    int k=k0;
+    for(; k+N_LANES<=k1; k+=N_LANES)
+    {
+      const complex_float *x = in + k;
+      const float *w = wfun + k;
+      for(int j=0; j<N_LANES; j++)
+      {
+        float xr = x[j].re*w[j];
+        float xi = x[j].im*w[j];
+        float tr, ti;
+        ar[j] += xr*pr[j] - xi*pi[j];
+        ai[j] += xr*pi[j] + xi*pr[j];
+        tr = pr[j]*dr[j] - pi[j]*di[j];
+        ti = pr[j]*di[j] + pi[j]*dr[j];
+        pr[j] = tr;
+        pi[j] = ti;
+        tr = dr[j]*cr - di[j]*ci;
+        ti = dr[j]*ci + di[j]*cr;
+        dr[j] = tr;
+        di[j] = ti;
+      }
+    }
+    /* the remaining samples use the current lane phasors directly */
+    for(int j=0; k+j<k1; j++)
+    {
+      float xr = in[k+j].re*wfun[k+j];
+      float xi = in[k+j].im*wfun[k+j];
+      ar[j] += xr*pr[j] - xi*pi[j];
+      ai[j] += xr*pi[j] + xi*pr[j];
+    }
+  }
+  out->re=0.0f;
+  out->im=0.0f;
+  for(int j=0; j<N_LANES; j++)
+  {
+    out->re += ar[j];
+    out->im += ai[j];
+  }
+}
+
+void consume_range_recurrence(struct arg_struct *a)
+{
+  for(int out_idx=a->rank; out_idx<a->n_out; out_idx+=a->size)
+  {
+    dechirp_recurrence(a->in + (long)out_idx*a->dec, a->wfun, a->dec2,
+                       ((double)a->dec*out_idx)*a->dt + a->chirpt, a->dt,
+                       a->f0, a->rate, &a->out_buffer[out_idx]);
+  }
+}
+
+/*
+  Several targets (chirps) share the same input. Output sample o of target
+  t uses the input starting at in_offsets[t] + o*dec, the chirp time
+  chirpts[t] + o*dec*dt, and is stored in out_buffer[out_offsets[t] + o].
+  Each thread handles the outputs that start in its own contiguous part of
+  the input. The input is walked in blocks of dec samples and all targets
+  are processed for each block, so that the input is read from memory once.
+ */
+void consume_range_multi(struct arg_struct *a)
+{
+  long span=0;
+  for(int t=0; t<a->n_targets; t++)
+  {
+    long end = a->in_offsets[t] + (long)a->n_outs[t]*a->dec;
+    if(end > span)
+      span=end;
+  }
+  long c0 = span*a->rank/a->size;
+  long c1 = span*(a->rank+1)/a->size;
+
+  for(long b=c0; b<c1; b+=a->dec)
+  {
+    long b1 = b+a->dec;
+    if(b1 > c1)
+      b1 = c1;
+    for(int t=0; t<a->n_targets; t++)
+    {
+      long off = a->in_offsets[t];
+      /* first output of this target that starts at or after b */
+      long o = b - off;
+      if(o < 0)
+        o = 0;
+      else
+        o = (o + a->dec - 1)/a->dec;
+      for(; o < a->n_outs[t] && off + o*a->dec < b1; o++)
+      {
+        dechirp_recurrence(a->in + off + o*a->dec, a->wfun, a->dec2,
+                           a->chirpts[t] + ((double)a->dec*o)*a->dt, a->dt,
+                           a->f0s[t], a->rates[t],
+                           &a->out_buffer[a->out_offsets[t] + o]);
+      }
+    }
+  }
+}
+
+/*
+  Dechirp n contiguous samples starting at time chirpt with the phasor
+  recurrence, without filtering. Writes the mixed samples into mr, mi.
+ */
+DC_TARGET_CLONES
+static void mix_recurrence(const complex_float *in, int n,
+                           double chirpt, double dt, double f0, double rate,
+                           float *restrict mr, float *restrict mi)
+{
+  float pr[N_LANES], pi[N_LANES], dr[N_LANES], di[N_LANES];
+  float cr, ci;
+  double step_t = N_LANES*dt;
+  double c_cyc = rate*step_t*step_t;
+  c_cyc = c_cyc - floor(c_cyc);
+  cr = (float)cos(-2.0*M_PI*c_cyc);
+  ci = (float)sin(-2.0*M_PI*c_cyc);
+
+  for(int k0=0; k0<n; k0+=ANCHOR_LEN)
+  {
+    int k1 = k0+ANCHOR_LEN;
+    if(k1 > n)
+      k1 = n;
+
+    for(int j=0; j<N_LANES; j++)
+    {
+      double t = chirpt + (k0+j)*dt;
+      double cyc = chirp_cycles(t, f0, rate);
+      double d_cyc = step_t*(f0 + rate*t + 0.5*rate*step_t);
+      d_cyc = d_cyc - floor(d_cyc);
+      pr[j] = (float)cos(-2.0*M_PI*cyc);
+      pi[j] = (float)sin(-2.0*M_PI*cyc);
+      dr[j] = (float)cos(-2.0*M_PI*d_cyc);
+      di[j] = (float)sin(-2.0*M_PI*d_cyc);
+    }
+
+    int k=k0;
+    for(; k+N_LANES<=k1; k+=N_LANES)
+    {
+      for(int j=0; j<N_LANES; j++)
+      {
+        float xr = in[k+j].re;
+        float xi = in[k+j].im;
+        float tr, ti;
+        mr[k+j] = xr*pr[j] - xi*pi[j];
+        mi[k+j] = xr*pi[j] + xi*pr[j];
+        tr = pr[j]*dr[j] - pi[j]*di[j];
+        ti = pr[j]*di[j] + pi[j]*dr[j];
+        pr[j] = tr;
+        pi[j] = ti;
+        tr = dr[j]*cr - di[j]*ci;
+        ti = dr[j]*ci + di[j]*cr;
+        dr[j] = tr;
+        di[j] = ti;
+      }
+    }
+    for(int j=0; k+j<k1; j++)
+    {
+      float xr = in[k+j].re;
+      float xi = in[k+j].im;
+      mr[k+j] = xr*pr[j] - xi*pi[j];
+      mi[k+j] = xr*pi[j] + xi*pr[j];
+    }
+  }
+}
+
+/*
+  Multi-stage decimation: each input sample is dechirped once, then
+  decimated by cic_dec with a cic filter of order CIC_ORDER, and finally by
+  dec/cic_dec with a short compensating fir filter. The cic integrators use
+  wrapping 64 bit integer arithmetic, which is exact as long as the
+  outputs fit (the input is scaled accordingly). The order is high enough
+  that the cic alone attenuates the bands that alias onto the fir passband
+  as much as the sinc filter does (design_multistage in chirp_lib.py).
+
+  Low rate sample m is the cic output at input sample offset + m*cic_dec,
+  and output sample o is sum_j fir[j] c[o*dec/cic_dec + j].
+  Each thread handles a contiguous block of output samples.
+ */
+void consume_range_multistage(struct arg_struct *a)
+{
+  int R = a->cic_dec;
+  int N = CIC_ORDER;
+  int D2 = a->dec/a->cic_dec;
+  int L2 = a->fir_len;
+  int o0 = (int)(((long)a->n_out*a->rank)/a->size);
+  int o1 = (int)(((long)a->n_out*(a->rank+1))/a->size);
+  if(o1 <= o0)
+    return;
+
+  long m_first = (long)o0*D2;
+  long m_last = (long)(o1-1)*D2 + L2 - 1;
+  long n_m = m_last - m_first + 1;
+  long e_first = a->offset + m_first*R;
+  /* start early enough that the comb state is exact at m_first */
+  long q0 = e_first - (long)N*R + 1;
+  long q1 = a->offset + m_last*R;
+
+  /* scale the input so that the cic output fits in 62 bits.
+     the maximum of |x| is found by comparing the float bit patterns
+     without the sign bit, which vectorizes. */
+  const uint32_t *bits = (const uint32_t *)(a->in + q0);
+  uint32_t maxbits = 0;
+  for(long q=0; q<2*(q1-q0+1); q++)
+  {
+    uint32_t b = bits[q] & 0x7fffffffu;
+    maxbits = b > maxbits ? b : maxbits;
+  }
+  float maxabs;
+  memcpy(&maxabs, &maxbits, sizeof(float));
+  if(maxabs == 0.0f)
+  {
+    for(int o=o0; o<o1; o++)
+    {
+      a->out_buffer[o].re=0.0f;
+      a->out_buffer[o].im=0.0f;
+    }
+    return;
+  }
+  double gain = pow((double)R, (double)N);
+  int sexp = (int)floor(61.0 - log2(gain*1.5*maxabs));
+  /* keep the scale representable as a float */
+  if(sexp > 100)
+    sexp = 100;
+  float scale = (float)ldexp(1.0, sexp);
+  double inv_scale = 1.0/(ldexp(1.0, sexp)*gain);
+
+  complex_float *c = (complex_float *)malloc(sizeof(complex_float)*n_m);
+  uint64_t comb_r[CIC_ORDER], comb_i[CIC_ORDER];
+  for(int k=0; k<CIC_ORDER; k++)
+  {
+    comb_r[k]=0;
+    comb_i[k]=0;
+  }
+  float mr[ANCHOR_LEN], mi[ANCHOR_LEN];
+  int64_t xr[ANCHOR_LEN], xi[ANCHOR_LEN];
+  uint64_t r0=0, r1=0, r2=0, r3=0, r4=0, r5=0;
+  uint64_t i0=0, i1=0, i2=0, i3=0, i4=0, i5=0;
+
+  long m = m_first - N + 1;
+  long next_e = e_first - (long)(N-1)*R;
+  for(long qb=q0; qb<=q1; qb+=ANCHOR_LEN)
+  {
+    int nb = ANCHOR_LEN;
+    if(qb + nb > q1 + 1)
+      nb = (int)(q1 + 1 - qb);
+    mix_recurrence(a->in + qb, nb, a->chirpt + qb*a->dt, a->dt, a->f0, a->rate, mr, mi);
+    for(int k=0; k<nb; k++)
+    {
+      xr[k] = (int64_t)(mr[k]*scale);
+      xi[k] = (int64_t)(mi[k]*scale);
+    }
+    int k=0;
+    while(k < nb)
+    {
+      /* integrate up to the next decimation point or the end of the block */
+      int k1 = (int)(next_e - qb) + 1;
+      if(k1 > nb)
+        k1 = nb;
+      for(; k<k1; k++)
+      {
+        r0 += (uint64_t)xr[k];
+        i0 += (uint64_t)xi[k];
+        r1 += r0; r2 += r1; r3 += r2; r4 += r3; r5 += r4;
+        i1 += i0; i2 += i1; i3 += i2; i4 += i3; i5 += i4;
+      }
+      if(qb + k - 1 == next_e)
+      {
+        /* combs */
+        uint64_t vr = r5;
+        uint64_t vi = i5;
+        for(int st=0; st<CIC_ORDER; st++)
+        {
+          uint64_t tr = vr, ti = vi;
+          vr -= comb_r[st];
+          vi -= comb_i[st];
+          comb_r[st] = tr;
+          comb_i[st] = ti;
+        }
+        if(m >= m_first)
+        {
+          c[m-m_first].re = (float)((double)(int64_t)vr*inv_scale);
+          c[m-m_first].im = (float)((double)(int64_t)vi*inv_scale);
+        }
+        m++;
+        next_e += R;
+      }
+    }
+  }
+
+  for(int o=o0; o<o1; o++)
+  {
+    complex_float *co = c + (long)(o-o0)*D2;
+    float yr=0.0f, yi=0.0f;
+    for(int j=0; j<L2; j++)
+    {
+      yr += a->fir[j]*co[j].re;
+      yi += a->fir[j]*co[j].im;
+    }
+    a->out_buffer[o].re=yr;
+    a->out_buffer[o].im=yi;
+  }
+  free(c);
+}
+
+/*
+  Widest vector instruction set available for the recurrence kernel (bits)
+ */
+int simd_width(void)
+{
+#if defined(__GNUC__) && !defined(__clang__) && defined(__x86_64__) && defined(__linux__)
+  __builtin_cpu_init();
+  if(__builtin_cpu_supports("avx512f"))
+    return(512);
+  if(__builtin_cpu_supports("avx2"))
+    return(256);
+  return(128);
+#elif defined(__ARM_NEON) || defined(__SSE2__)
+  return(128);
+#else
+  return(0);
+#endif
+}
+
+void *consume_one(void *args)
+{
+  consume_range((struct arg_struct *)args);
   pthread_exit(NULL);
   return(NULL);
 }
@@ -135,6 +581,9 @@ void consume(double chirpt, double dt, complex_float *sintab, int tabl, complex_
     a[i].wfun=wfun;
     a[i].rank=i;
     a[i].size=n_threads;
+    a[i].kernel=KERNEL_TABLE;
+    a[i].filter=FILTER_SINC;
+    a[i].n_targets=0;
     pthread_create(&proc_threads[i], NULL, consume_one, (void *)&a[i]);
   }
 
@@ -146,3 +595,230 @@ void consume(double chirpt, double dt, complex_float *sintab, int tabl, complex_
   free(a);
   free(proc_threads);
 }
+
+/*
+  Persistent worker pool. 
+  The workers are created once, optionally pinned to cpus, and wait on a
+  barrier for the next job. pool_submit() hands a job to all workers and
+  returns when all of them are done.
+ */
+struct barrier {
+  pthread_mutex_t mutex;
+  pthread_cond_t cond;
+  int count;
+  int n_waiting;
+  unsigned long generation;
+};
+
+void barrier_init(struct barrier *b, int count)
+{
+  pthread_mutex_init(&b->mutex, NULL);
+  pthread_cond_init(&b->cond, NULL);
+  b->count=count;
+  b->n_waiting=0;
+  b->generation=0;
+}
+
+void barrier_wait(struct barrier *b)
+{
+  unsigned long generation;
+  pthread_mutex_lock(&b->mutex);
+  generation=b->generation;
+  b->n_waiting++;
+  if(b->n_waiting == b->count)
+  {
+    b->n_waiting=0;
+    b->generation++;
+    pthread_cond_broadcast(&b->cond);
+  }
+  else
+  {
+    while(generation == b->generation)
+      pthread_cond_wait(&b->cond, &b->mutex);
+  }
+  pthread_mutex_unlock(&b->mutex);
+}
+
+void barrier_destroy(struct barrier *b)
+{
+  pthread_mutex_destroy(&b->mutex);
+  pthread_cond_destroy(&b->cond);
+}
+
+struct pool {
+  int n_threads;
+  int quit;
+  pthread_t *threads;
+  struct arg_struct *a;
+  struct barrier start;
+  struct barrier done;
+  pthread_mutex_t submit_mutex;
+};
+
+struct worker_arg {
+  struct pool *p;
+  int rank;
+  int cpu;
+};
+
+void *pool_worker(void *args)
+{
+  struct worker_arg *w = args;
+  struct pool *p = w->p;
+  int rank = w->rank;
+#ifdef __linux__
+  if(w->cpu >= 0)
+  {
+    cpu_set_t cpuset;
+    CPU_ZERO(&cpuset);
+    CPU_SET(w->cpu, &cpuset);
+    pthread_setaffinity_np(pthread_self(), sizeof(cpu_set_t), &cpuset);
+  }
+#endif
+  free(w);
+  while(1)
+  {
+    barrier_wait(&p->start);
+    if(p->quit)
+      break;
+    consume_range(&p->a[rank]);
+    barrier_wait(&p->done);
+  }
+  return(NULL);
+}
+
+void *pool_init(int n_threads, int first_cpu)
+{
+  /*
+    first_cpu < 0 doesn't pin the threads, otherwise thread i is
+    pinned to cpu (first_cpu+i) modulo the number of cpus
+   */
+  struct pool *p;
+  long n_cpus = sysconf(_SC_NPROCESSORS_ONLN);
+  if(n_cpus < 1)
+    n_cpus=1;
+  p=(struct pool *)malloc(sizeof(struct pool));
+  p->n_threads=n_threads;
+  p->quit=0;
+  p->threads=(pthread_t *)malloc(sizeof(pthread_t)*n_threads);
+  p->a=(struct arg_struct *)malloc(sizeof(struct arg_struct)*n_threads);
+  barrier_init(&p->start, n_threads+1);
+  barrier_init(&p->done, n_threads+1);
+  pthread_mutex_init(&p->submit_mutex, NULL);
+  for(int i=0; i<n_threads; i++)
+  {
+    struct worker_arg *w = (struct worker_arg *)malloc(sizeof(struct worker_arg));
+    w->p=p;
+    w->rank=i;
+    w->cpu=-1;
+    if(first_cpu >= 0)
+      w->cpu=(int)((first_cpu+i) % n_cpus);
+    pthread_create(&p->threads[i], NULL, pool_worker, (void *)w);
+  }
+  return((void *)p);
+}
+
+void pool_submit(void *pool, double chirpt, double dt, complex_float *sintab, int tabl, complex_float *in, complex_float *out_buffer, int n_out, int dec, int dec2, double f0, double rate, float *wfun, int kernel)
+{
+  struct pool *p = pool;
+  pthread_mutex_lock(&p->submit_mutex);
+  for(int i=0; i<p->n_threads; i++)
+  {
+    p->a[i].chirpt=chirpt;
+    p->a[i].dt=dt;
+    p->a[i].sintab=sintab;
+    p->a[i].tabl=tabl;
+    p->a[i].in=in;
+    p->a[i].out_buffer=out_buffer;
+    p->a[i].n_out=n_out;
+    p->a[i].dec=dec;
+    p->a[i].dec2=dec2;
+    p->a[i].f0=f0;
+    p->a[i].rate=rate;
+    p->a[i].wfun=wfun;
+    p->a[i].rank=i;
+    p->a[i].size=p->n_threads;
+    p->a[i].kernel=kernel;
+    p->a[i].filter=FILTER_SINC;
+    p->a[i].n_targets=0;
+  }
+  // release the workers and wait for them to finish
+  barrier_wait(&p->start);
+  barrier_wait(&p->done);
+  pthread_mutex_unlock(&p->submit_mutex);
+}
+
+void pool_submit_multistage(void *pool, double chirpt, double dt, complex_float *in, complex_float *out_buffer, int n_out, int dec, double f0, double rate, int cic_dec, float *fir, int fir_len, int offset)
+{
+  struct pool *p = pool;
+  pthread_mutex_lock(&p->submit_mutex);
+  for(int i=0; i<p->n_threads; i++)
+  {
+    p->a[i].chirpt=chirpt;
+    p->a[i].dt=dt;
+    p->a[i].in=in;
+    p->a[i].out_buffer=out_buffer;
+    p->a[i].n_out=n_out;
+    p->a[i].dec=dec;
+    p->a[i].f0=f0;
+    p->a[i].rate=rate;
+    p->a[i].rank=i;
+    p->a[i].size=p->n_threads;
+    p->a[i].kernel=KERNEL_RECURRENCE;
+    p->a[i].filter=FILTER_MULTISTAGE;
+    p->a[i].cic_dec=cic_dec;
+    p->a[i].fir=fir;
+    p->a[i].fir_len=fir_len;
+    p->a[i].offset=offset;
+    p->a[i].n_targets=0;
+  }
+  barrier_wait(&p->start);
+  barrier_wait(&p->done);
+  pthread_mutex_unlock(&p->submit_mutex);
+}
+
+void pool_submit_multi(void *pool, int n_targets, double *chirpts, double dt, complex_float *in, int64_t *in_offsets, complex_float *out_buffer, int64_t *out_offsets, int *n_outs, int dec, int dec2, double *f0s, double *rates, float *wfun)
+{
+  struct pool *p = pool;
+  pthread_mutex_lock(&p->submit_mutex);
+  for(int i=0; i<p->n_threads; i++)
+  {
+    p->a[i].dt=dt;
+    p->a[i].in=in;
+    p->a[i].out_buffer=out_buffer;
+    p->a[i].dec=dec;
+    p->a[i].dec2=dec2;
+    p->a[i].wfun=wfun;
+    p->a[i].rank=i;
+    p->a[i].size=p->n_threads;
+    p->a[i].kernel=KERNEL_RECURRENCE;
+    p->a[i].filter=FILTER_SINC;
+    p->a[i].n_targets=n_targets;
+    p->a[i].chirpts=chirpts;
+    p->a[i].f0s=f0s;
+    p->a[i].rates=rates;
+    p->a[i].in_offsets=in_offsets;
+    p->a[i].out_offsets=out_offsets;
+    p->a[i].n_outs=n_outs;
+  }
+  barrier_wait(&p->start);
+  barrier_wait(&p->done);
+  pthread_mutex_unlock(&p->submit_mutex);
+}
+
+void pool_destroy(void *pool)
+{
+  struct pool *p = pool;
+  p->quit=1;
+  barrier_wait(&p->start);
+  for(int i=0; i<p->n_threads; i++)
+  {
+    pthread_join(p->threads[i],NULL);
+  }
+  barrier_destroy(&p->start);
+  barrier_destroy(&p->done);
+  pthread_mutex_destroy(&p->submit_mutex);
+  free(p->threads);
+  free(p->a);
+  free(p);
+}
@@ -1,4 +1,18 @@
+#include <stdint.h>
+
 typedef struct complex_float_str {
   float re;
   float im;
 } complex_float;
+
+void consume(double chirpt, double dt, complex_float *sintab, int tabl, complex_float *in, complex_float *out_buffer, int n_out, int dec, int dec2, double f0, double rate, float *wfun, int n_threads);
+
+/* persistent worker pool */
+void *pool_init(int n_threads, int first_cpu);
+void pool_submit(void *pool, double chirpt, double dt, complex_float *sintab, int tabl, complex_float *in, complex_float *out_buffer, int n_out, int dec, int dec2, double f0, double rate, float *wfun, int kernel);
+void pool_submit_multistage(void *pool, double chirpt, double dt, complex_float *in, complex_float *out_buffer, int n_out, int dec, double f0, double rate, int cic_dec, float *fir, int fir_len, int offset);
+void pool_submit_multi(void *pool, int n_targets, double *chirpts, double dt, complex_float *in, int64_t *in_offsets, complex_float *out_buffer, int64_t *out_offsets, int *n_outs, int dec, int dec2, double *f0s, double *rates, float *wfun);
+void pool_destroy(void *pool);
+
+/* widest simd instruction set used by the recurrence kernel (bits) */
+int simd_width(void);
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+#
+# SQLite index of chirp detections, parameter files and ionograms.
+#
+# The writers (detect_chirps.py, find_timings.py, calc_ionograms.py)
+# register each file they produce, so that downstream tools can find
+# their inputs without globbing years of daily directories. Paths are
+# stored relative to output_dir, so the index can be moved with it.
+#
+# The index is only used while it is complete. A writer running with
+# use_index=false marks an existing index incomplete, and so does a
+# listed file that no longer exists. The tools then glob the daily
+# directories until the index is rebuilt.
+#
+# Query example, all ionograms of sounder 5 during two days:
+#   python chirp_index.py config.ini --kind ionogram --id 5 --start 2021-05-04 --end 2021-05-06
+# (while the index isn't complete, this warns and reads the files instead)
+# (Re)build the index from the files already in output_dir:
+#   python chirp_index.py config.ini --rebuild
+#
+import argparse
+import calendar
+import datetime
+import glob
+import os
+import sqlite3
+import sys
+import traceback
+
+import numpy as n
+
+import chirp_config as cc
+
+# product kinds and the file patterns used to find them without an index
+KINDS = {"detection": "chirp*.h5",
+         "parameter": "par-*.h5",
+         "ionogram": "lfm*.h5"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    t0 REAL,
+    chirp_rate REAL,
+    f0 REAL,
+    snr REAL,
+    id INTEGER
+);
+CREATE INDEX IF NOT EXISTS products_kind_t0 ON products (kind, t0);
+CREATE INDEX IF NOT EXISTS products_kind_id_t0 ON products (kind, id, t0);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# one open index per database file and process
+_open_indices = {}
+
+
+def index_fname(conf):
+    if conf.index_file != "":
+        return (conf.index_file)
+    return ("%s/index.sqlite" % (conf.output_dir))
+
+
+class chirp_index:
+    def __init__(self, fname, output_dir=None, new_file=None):
+        """
+        Open (and create if needed) an index database for the
+        products in output_dir (by default the directory of the database).
+        new_file is a product just written by the caller, that it registers.
+        """
+        self.fname = fname
+        if output_dir is None:
+            output_dir = os.path.dirname(os.path.abspath(fname))
+        self.output_dir = os.path.abspath(output_dir)
+        new_db = not os.path.exists(fname)
+        # mpi ranks write concurrently, wait for the lock instead of failing
+        self.db = sqlite3.connect(fname, timeout=60.0)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+        if new_db:
+            # an index created next to existing products is not
+            # complete until it has been rebuilt from the files
+            fl = [f for k in KINDS.keys() for f in glob.glob("%s/*/%s" % (output_dir, KINDS[k]))]
+            if new_file is not None:
+                fl = [f for f in fl if not os.path.samefile(f, new_file)]
+            if len(fl) == 0:
+                self.set_complete(True)
+
+    def is_complete(self):
+        c = self.db.execute("SELECT value FROM meta WHERE key='complete'")
+        row = c.fetchone()
+        return (row is not None and row[0] == "1")
+
+    def set_complete(self, complete=True):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('complete', ?)",
+                        ("1" if complete else "0",))
+        self.db.commit()
+
+    def relpath(self, path):
+        return (os.path.relpath(os.path.abspath(path), self.output_dir))
+
+    def abspath(self, path):
+        # older indices have absolute paths
+        return (os.path.join(self.output_dir, path))
+
+    def add(self, kind, path, t0=None, chirp_rate=None, f0=None, snr=None, cid=None, commit=True):
+        """
+        Record a product file. Adding an already known path replaces the old entry.
+        """
+        if kind not in KINDS:
+            raise ValueError("unknown product kind %s" % (kind))
+        self.db.execute("INSERT OR REPLACE INTO products (kind, path, t0, chirp_rate, f0, snr, id) VALUES (?,?,?,?,?,?,?)",
+                        (kind, self.relpath(path), _float(t0), _float(chirp_rate), _float(f0), _float(snr),
+                         None if cid is None else int(cid)))
+        if commit:
+            self.db.commit()
+
+    def remove(self, path):
+        self.db.execute("DELETE FROM products WHERE path=? OR path=?",
+                        (self.relpath(path), os.path.abspath(path)))
+        self.db.commit()
+
+    def query(self, kind=None, t0=None, t1=None, cid=None, chirp_rate=None, last=None):
+        """
+        Return products as a list of dicts sorted by time, with absolute paths.
+        t0 <= time < t1, chirp_rate is matched within 0.1 Hz/s.
+        last=N returns only the N most recent matches.
+        """
+        conds = []
+        args = []
+        if kind is not None:
+            conds.append("kind=?")
+            args.append(kind)
+        if t0 is not None:
+            conds.append("t0>=?")
+            args.append(float(t0))
+        if t1 is not None:
+            conds.append("t0<?")
+            args.append(float(t1))
+        if cid is not None:
+            conds.append("id=?")
+            args.append(int(cid))
+        if chirp_rate is not None:
+            conds.append("abs(chirp_rate-?)<0.1")
+            args.append(float(chirp_rate))
+        sql = "SELECT kind, path, t0, chirp_rate, f0, snr, id FROM products"
+        if len(conds) > 0:
+            sql += " WHERE " + " AND ".join(conds)
+        if last is not None:
+            sql = "SELECT * FROM (%s ORDER BY t0 DESC LIMIT %d) ORDER BY t0" % (
+                sql, int(last))
+        else:
+            sql += " ORDER BY t0"
+        keys = ["kind", "path", "t0", "chirp_rate", "f0", "snr", "id"]
+        rows = [dict(zip(keys, row)) for row in self.db.execute(sql, args)]
+        for r in rows:
+            r["path"] = self.abspath(r["path"])
+        return (rows)
+
+    def rebuild(self, output_dir):
+        """
+        Scan output_dir for existing products and add them to the index,
+        and remove the files that no longer exist.
+        """
+        for path, in self.db.execute("SELECT path FROM products").fetchall():
+            if not os.path.exists(self.abspath(path)):
+                self.db.execute("DELETE FROM products WHERE path=?", (path,))
+        self.db.commit()
+        n_added = 0
+        for kind in KINDS.keys():
+            fl = glob.glob("%s/*/%s" % (output_dir, KINDS[kind]))
+            fl.sort()
+            for f in fl:
+                try:
+                    self.add(kind, f, commit=False, **read_product_info(kind, f))
+                    n_added += 1
+                except:
+                    print("Couldn't index %s" % (f))
+            self.db.commit()
+        self.set_complete(True)
+        return (n_added)
+
+    def close(self):
+        self.db.close()
+
+
+def _float(x):
+    if x is None:
+        return (None)
+    return (float(x))
+
+
+def read_product_info(kind, fname):
+    """
+    Read the indexed metadata from a product file.
+    """
+    import h5py
+    info = {}
+    h = h5py.File(fname, "r")
+    if kind == "detection":
+        info["t0"] = float(n.copy(h["chirp_time"]))
+        info["chirp_rate"] = float(n.copy(h["chirp_rate"]))
+        info["f0"] = float(n.copy(h["f0"]))
+        if "snr" in h.keys():
+            info["snr"] = float(n.copy(h["snr"]))
+    elif kind == "parameter":
+        info["t0"] = float(n.copy(h["t0"]))
+        info["chirp_rate"] = float(n.copy(h["chirp_rate"]))
+        if "snrs" in h.keys() and h["snrs"].size > 0:
+            info["snr"] = float(n.max(h["snrs"]))
+    elif kind == "ionogram":
+        info["t0"] = float(n.copy(h["t0"]))
+        info["chirp_rate"] = float(n.copy(h["rate"]))
+        if "id" in h.keys():
+            info["cid"] = int(n.copy(h["id"]))
+    h.close()
+    return (info)
+
+
+def get_index(conf, new_file=None):
+    """
+    The index of this configuration, or None if indexing is disabled.
+    """
+    if not conf.use_index:
+        return (None)
+    fname = index_fname(conf)
+    if fname not in _open_indices:
+        _open_indices[fname] = chirp_index(fname, conf.output_dir, new_file)
+    return (_open_indices[fname])
+
+
+def mark_incomplete(conf):
+    """
+    Mark the index of this configuration (if there is one) incomplete,
+    so that the tools don't use it until it is rebuilt.
+    """
+    fname = index_fname(conf)
+    if fname not in _open_indices:
+        if not os.path.exists(fname):
+            return
+        _open_indices[fname] = chirp_index(fname, conf.output_dir)
+    # it can be rebuilt while the writer runs
+    if _open_indices[fname].is_complete():
+        _open_indices[fname].set_complete(False)
+
+
+def register(conf, kind, path, **info):
+    """
+    Add a newly written product file to the index. With use_index=false,
+    an existing index is marked incomplete instead.
+    Indexing errors are reported, but never stop the writer.
+    """
+    try:
+        ci = get_index(conf, path)
+        if ci is not None:
+            ci.add(kind, path, **info)
+        else:
+            mark_incomplete(conf)
+    except:
+        print("error indexing %s" % (path))
+        traceback.print_exc(file=sys.stdout)
+        try:
+            mark_incomplete(conf)
+        except:
+            traceback.print_exc(file=sys.stdout)
+
+
+def find_files(conf, kind, t0=None, t1=None, cid=None, chirp_rate=None, last=None):
+    """
+    List product files sorted by time. Uses the index if there is a complete one,
+    otherwise falls back to globbing the daily directories in output_dir.
+    """
+    if conf.use_index and os.path.exists(index_fname(conf)):
+        ci = get_index(conf)
+        if ci.is_complete():
+            fl = [r["path"] for r in ci.query(kind, t0=t0, t1=t1, cid=cid,
+                                              chirp_rate=chirp_rate, last=last)]
+            missing = [f for f in fl if not os.path.exists(f)]
+            if len(missing) == 0:
+                return (fl)
+            print("%s is missing, the index is out of date. Run chirp_index.py --rebuild" % (missing[0]))
+            mark_incomplete(conf)
+
+    fl = glob.glob("%s/*/%s" % (conf.output_dir, KINDS[kind]))
+    if t0 is None and t1 is None and cid is None and chirp_rate is None:
+        fl.sort()
+        if last is not None:
+            fl = fl[max(0, len(fl) - last):len(fl)]
+        return (fl)
+
+    # filtering needs the metadata of every file
+    return ([r["path"] for r in scan_products(conf, kind, t0=t0, t1=t1, cid=cid,
+                                              chirp_rate=chirp_rate, last=last)])
+
+
+def scan_products(conf, kind=None, t0=None, t1=None, cid=None, chirp_rate=None, last=None):
+    """
+    Products in the daily directories of output_dir, as dicts like
+    chirp_index.query, without the index. Reads the metadata of every file.
+    """
+    kinds = list(KINDS.keys()) if kind is None else [kind]
+    rows = []
+    for k in kinds:
+        for f in glob.glob("%s/*/%s" % (conf.output_dir, KINDS[k])):
+            try:
+                info = read_product_info(k, f)
+            except:
+                print("Couldn't open %s" % (f))
+                continue
+            if t0 is not None and info["t0"] < t0:
+                continue
+            if t1 is not None and info["t0"] >= t1:
+                continue
+            if cid is not None and info.get("cid") != cid:
+                continue
+            if chirp_rate is not None and n.abs(info["chirp_rate"] - chirp_rate) >= 0.1:
+                continue
+            rows.append({"kind": k,
+                         "path": f,
+                         "t0": info["t0"],
+                         "chirp_rate": info.get("chirp_rate"),
+                         "f0": info.get("f0"),
+                         "snr": info.get("snr"),
+                         "id": info.get("cid")})
+    rows.sort(key=lambda r: (r["t0"], r["path"]))
+    if last is not None:
+        rows = rows[max(0, len(rows) - last):len(rows)]
+    return (rows)
+
+
+def parse_date(s):
+    """
+    YYYY-mm-dd or YYYY-mm-ddTHH:MM:SS (UTC) to unix seconds
+    """
+    for fmt in ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"]:
+        try:
+            return (float(calendar.timegm(datetime.datetime.strptime(s, fmt).timetuple())))
+        except ValueError:
+            pass
+    return (float(s))
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(
+        description="Query the index of detections, parameter files and ionograms")
+    p.add_argument("config", nargs="?", default=None)
+    p.add_argument("--rebuild", action="store_true",
+                   help="add all existing files in output_dir to the index")
+    p.add_argument("--kind", choices=list(KINDS.keys()), default=None)
+    p.add_argument("--id", type=int, default=None, help="sounder id")
+    p.add_argument("--rate", type=float, default=None, help="chirp-rate (Hz/s)")
+    p.add_argument("--start", default=None,
+                   help="YYYY-mm-dd[THH:MM:SS] UTC or unix time")
+    p.add_argument("--end", default=None,
+                   help="YYYY-mm-dd[THH:MM:SS] UTC or unix time")
+    p.add_argument("--last", type=int, default=None,
+                   help="only the N most recent")
+    args = p.parse_args()
+
+    conf = cc.chirp_config(args.config)
+    ci = chirp_index(index_fname(conf), conf.output_dir)
+
+    if args.rebuild:
+        print("indexed %d files" % (ci.rebuild(conf.output_dir)))
+    else:
+        t0 = None
+        t1 = None
+        if args.start is not None:
+            t0 = parse_date(args.start)
+        if args.end is not None:
+            t1 = parse_date(args.end)
+        if ci.is_complete():
+            rows = ci.query(args.kind, t0=t0, t1=t1, cid=args.id, chirp_rate=args.rate, last=args.last)
+        else:
+            print("warning: the index of %s is not complete, listing the files instead. Run chirp_index.py --rebuild" %
+                  (conf.output_dir))
+            rows = scan_products(conf, args.kind, t0=t0, t1=t1, cid=args.id, chirp_rate=args.rate, last=args.last)
+        for r in rows:
+            print("%-9s %17.6f %10s %12s %8s %4s %s" % (r["kind"], r["t0"],
+                                                      "-" if r["chirp_rate"] is None else "%1.2f" % (r["chirp_rate"] / 1e3),
+                                                      "-" if r["f0"] is None else "%1.4f" % (r["f0"] / 1e6),
+                                                      "-" if r["snr"] is None else "%1.1f" % (r["snr"]),
+                                                      "-" if r["id"] is None else "%d" % (r["id"]),
+                                                      r["path"]))
@@ -1,8 +1,7 @@
+import atexit
 import ctypes
 import numpy as n
 from numpy import ctypeslib
-import matplotlib.pyplot as plt
-import scipy.signal as ss
 from pathlib import Path
 lib_filepath = Path(__file__).parent.resolve() / Path("libdownconvert.so")
 libdc = ctypes.cdll.LoadLibrary(str(lib_filepath))
@@ -21,6 +20,182 @@ libdc.consume.argtypes = [ctypes.c_double,
                           ctypes.c_double,
                           ctypeslib.ndpointer(n.float32, ndim=1, flags='C'),
                           ctypes.c_int]
+libdc.pool_init.restype = ctypes.c_void_p
+libdc.pool_init.argtypes = [ctypes.c_int, ctypes.c_int]
+libdc.pool_submit.argtypes = [ctypes.c_void_p,
+                              ctypes.c_double,
+                              ctypes.c_double,
+                              ctypeslib.ndpointer(n.complex64, ndim=1, flags='C'),
+                              ctypes.c_int,
+                              ctypeslib.ndpointer(n.complex64, ndim=1, flags='C'),
+                              ctypeslib.ndpointer(n.complex64, ndim=1, flags='C'),
+                              ctypes.c_int,
+                              ctypes.c_int,
+                              ctypes.c_int,
+                              ctypes.c_double,
+                              ctypes.c_double,
+                              ctypeslib.ndpointer(n.float32, ndim=1, flags='C'),
+                              ctypes.c_int]
+libdc.pool_submit_multistage.argtypes = [ctypes.c_void_p,
+                                         ctypes.c_double,
+                                         ctypes.c_double,
+                                         ctypeslib.ndpointer(n.complex64, ndim=1, flags='C'),
+                                         ctypeslib.ndpointer(n.complex64, ndim=1, flags='C'),
+                                         ctypes.c_int,
+                                         ctypes.c_int,
+                                         ctypes.c_double,
+                                         ctypes.c_double,
+                                         ctypes.c_int,
+                                         ctypeslib.ndpointer(n.float32, ndim=1, flags='C'),
+                                         ctypes.c_int,
+                                         ctypes.c_int]
+libdc.pool_submit_multi.argtypes = [ctypes.c_void_p,
+                                    ctypes.c_int,
+                                    ctypeslib.ndpointer(n.float64, ndim=1, flags='C'),
+                                    ctypes.c_double,
+                                    ctypeslib.ndpointer(n.complex64, ndim=1, flags='C'),
+                                    ctypeslib.ndpointer(n.int64, ndim=1, flags='C'),
+                                    ctypeslib.ndpointer(n.complex64, ndim=1, flags='C'),
+                                    ctypeslib.ndpointer(n.int64, ndim=1, flags='C'),
+                                    ctypeslib.ndpointer(n.int32, ndim=1, flags='C'),
+                                    ctypes.c_int,
+                                    ctypes.c_int,
+                                    ctypeslib.ndpointer(n.float64, ndim=1, flags='C'),
+                                    ctypeslib.ndpointer(n.float64, ndim=1, flags='C'),
+                                    ctypeslib.ndpointer(n.float32, ndim=1, flags='C')]
+libdc.pool_destroy.argtypes = [ctypes.c_void_p]
+libdc.simd_width.restype = ctypes.c_int
+
+# dechirp kernels: phasor table lookup for each sample, or
+# vectorized phasor recurrence
+kernels = {"table": 0,
+           "recurrence": 1}
+
+# decimation filters: windowed sinc at the full sample rate, or
+# cic + compensating fir (multistage)
+filters = ["sinc", "multistage"]
+# order of the cic filter, fixed in chirp_downconvert.c
+cic_order = 6
+# multistage filter designs, one for each (dec, filter_len)
+designs = {}
+
+# long lived worker pools, one for each (n_threads, first_cpu)
+pools = {}
+
+
+def get_pool(n_threads, first_cpu=-1):
+    """
+    Worker threads that are reused by all downconversions of this process.
+    first_cpu >= 0 pins the threads to cpus first_cpu ... first_cpu+n_threads-1
+    """
+    key = (n_threads, first_cpu)
+    if key not in pools:
+        pools[key] = libdc.pool_init(n_threads, first_cpu)
+    return (pools[key])
+
+
+def destroy_pools():
+    for key in list(pools.keys()):
+        libdc.pool_destroy(pools.pop(key))
+
+
+atexit.register(destroy_pools)
+
+
+def design_multistage(wfun, dec, filter_len=2, n_grid=32):
+    """
+    Design a cic decimator followed by a short fir filter at the cic output
+    rate that together approximate the windowed sinc filter wfun.
+    The fir minimizes the largest deviation from |wfun| in the output band
+    (|f| < fs_out/2), with the combined response at all other frequencies
+    kept below the envelope of the sidelobes of wfun, so the multistage
+    filter attenuates at least as much as the sinc filter (linear program).
+    Returns (cic_dec, fir, offset), or None if there is no such design.
+    offset is the input sample index of the first cic output used,
+    chosen so that the outputs are aligned with the sinc filter outputs.
+    """
+    key = (dec, filter_len)
+    if key in designs:
+        return (designs[key])
+    from scipy.optimize import linprog
+    from scipy.ndimage import maximum_filter1d
+    N = cic_order
+    # cic decimation: the largest divisor of dec that leaves 24 bits
+    # (float precision) for the input in the 64 bit integrators, and at
+    # least 20 for the fir
+    Rs = [R for R in range(2, dec // 20 + 1) if dec % R == 0 and R**N <= 2**36]
+    if len(Rs) == 0:
+        designs[key] = None
+        return (None)
+    R = Rs[-1]
+    d2 = dec // R
+    dec2 = filter_len * dec
+
+    # longest fir that fits in the same input span as the sinc filter
+    fir_len = 0
+    for L2 in range(2 * filter_len * d2, 1, -1):
+        offset = int(n.round(dec + N * (R - 1) / 2.0 - (L2 - 1) * R / 2.0))
+        if offset >= N * R - 1 and offset + (L2 - 1) * R <= dec2 - 1:
+            fir_len = L2
+            break
+    if fir_len == 0:
+        designs[key] = None
+        return (None)
+
+    # frequency grid in cycles per input sample, n_grid points per fs_out.
+    # the fir response F(f*R) is even and periodic in 1/R, so frequency f
+    # folds onto the low rate frequency phi[fold] in [0, 1/(2R)]
+    M = n_grid * d2 // 2
+    n_fft = 2 * M * R
+    f = n.arange(n_fft // 2 + 1) / n_fft
+    fold = n.arange(len(f)) % (2 * M)
+    fold = n.minimum(fold, 2 * M - fold)
+    phi = n.arange(M + 1) / n_fft
+    W = n.abs(n.fft.rfft(n.array(wfun, dtype=n.float64), n_fft))
+    # sidelobe envelope of the sinc filter (+/- fs_out/4). in the stopband
+    # 1 dB below it, to allow for the response between the grid points and
+    # the float32 taps
+    env = maximum_filter1d(W, size=2 * (n_grid // 4) + 1)
+    env[f >= 1.5 / dec] *= 0.89
+    with n.errstate(divide="ignore", invalid="ignore"):
+        A_cic = n.abs(n.where(f == 0, 1.0, n.sin(n.pi * f * R) /
+                              (R * n.sin(n.pi * f)))**N)
+        # bound on |F(phi)| from all frequencies that fold onto phi
+        bound = n.full(M + 1, n.inf)
+        n.minimum.at(bound, fold, env / A_cic)
+
+    # symmetric fir: variables are the taps from the center out
+    j = n.arange(fir_len) - (fir_len - 1) / 2.0
+    jh = j[j >= 0]
+    B = (n.where(jh == 0, 1.0, 2.0)[None, :] *
+         n.cos(2.0 * n.pi * phi[:, None] * R * jh[None, :]))
+    passband = f <= 0.5 / dec
+    B_pass = A_cic[passband, None] * B[fold[passband]]
+    # the bands that alias onto the passband are only attenuated by the cic,
+    # if that isn't enough the program is infeasible
+    stop = n.isfinite(bound)
+    B_stop = B[stop] / bound[stop, None]
+    # minimize delta, |B_pass x - W| <= delta, |B_stop x| <= 1
+    ones = n.ones((B_pass.shape[0], 1))
+    zeros = n.zeros((B_stop.shape[0], 1))
+    A_ub = n.vstack([n.hstack([B_pass, -ones]), n.hstack([-B_pass, -ones]),
+                     n.hstack([B_stop, zeros]), n.hstack([-B_stop, zeros])])
+    b_ub = n.concatenate([W[passband], -W[passband],
+                          n.ones(B_stop.shape[0]), n.ones(B_stop.shape[0])])
+    c = n.zeros(len(jh) + 1)
+    c[-1] = 1.0
+    res = linprog(c, A_ub=A_ub, b_ub=b_ub, bounds=[(None, None)] * len(c),
+                  method="highs")
+    if res.status != 0:
+        designs[key] = None
+        return (None)
+    x = res.x[:-1]
+    if fir_len % 2 == 1:
+        fir = n.concatenate([x[::-1], x[1:]])
+    else:
+        fir = n.concatenate([x[::-1], x])
+    designs[key] = (R, n.array(fir, dtype=n.float32), offset)
+    return (designs[key])
 
 
 class chirp_downconvert:
@@ -31,7 +206,10 @@ class chirp_downconvert:
                  dec=2500,
                  filter_len=2,
                  n_threads=4,
-                 dt=1.0 / 25e6):
+                 dt=1.0 / 25e6,
+                 first_cpu=-1,
+                 kernel="recurrence",
+                 filter="sinc"):
 
         # let's add a windowed low pass filter to make this nearly perfect.
 
@@ -42,6 +220,7 @@ class chirp_downconvert:
         self.dec2 = filter_len * dec
         self.m = n.array(n.arange(filter_len * dec) - dec, dtype=n.float32)
         # windowed low pass filter
+        import scipy.signal as ss
         self.wfun = n.array(ss.hann(len(self.m)) * n.sin(self.om0 *
                             (self.m + 1e-6)) / (n.pi * (self.m + 1e-6)), dtype=n.float32)
         # the window function could be twice the decimation rate
@@ -55,6 +234,18 @@ class chirp_downconvert:
         self.dec = dec
         self.dt = dt
         self.filter_len = filter_len
+        self.pool = get_pool(n_threads, first_cpu)
+        self.kernel = kernels[kernel]
+        if filter not in filters:
+            raise ValueError("unknown decimation filter %s" % (filter))
+        self.filter = filter
+        if filter == "multistage":
+            design = design_multistage(self.wfun, dec, filter_len)
+            if design is None:
+                print("can't factor decimation %d, using sinc filter" % (dec))
+                self.filter = "sinc"
+            else:
+                self.cic_dec, self.fir, self.offset = design
 
     def consume(self,
                 z_in,
@@ -64,19 +255,36 @@ class chirp_downconvert:
         if (len(z_in) - self.dec2) / self.dec < n_out:
             print("not enough input samples %d %d %d %d" %
                   (len(z_in), self.dec2, self.dec, n_out))
-        libdc.consume(self.chirpt,
-                      self.dt,
-                      self.sintab,
-                      self.tab_len,
-                      z_in,
-                      z_out,
-                      n_out,
-                      self.dec,
-                      self.dec2,
-                      self.f0,
-                      self.rate,
-                      self.wfun,
-                      self.n_threads)
+        if self.filter == "multistage":
+            libdc.pool_submit_multistage(self.pool,
+                                         self.chirpt,
+                                         self.dt,
+                                         z_in,
+                                         z_out,
+                                         n_out,
+                                         self.dec,
+                                         self.f0,
+                                         self.rate,
+                                         self.cic_dec,
+                                         self.fir,
+                                         len(self.fir),
+                                         self.offset)
+            self.chirpt += float(n_out * self.dec) * self.dt
+            return
+        libdc.pool_submit(self.pool,
+                          self.chirpt,
+                          self.dt,
+                          self.sintab,
+                          self.tab_len,
+                          z_in,
+                          z_out,
+                          n_out,
+                          self.dec,
+                          self.dec2,
+                          self.f0,
+                          self.rate,
+                          self.wfun,
+                          self.kernel)
 
         self.chirpt += float(n_out * self.dec) * self.dt
     def advance_time(self,
@@ -84,6 +292,94 @@ class chirp_downconvert:
         self.chirpt += float(n_samples) * self.dt
 
 
+class chirp_downconvert_multi:
+    def __init__(self,
+                 dec=2500,
+                 filter_len=2,
+                 n_threads=4,
+                 dt=1.0 / 25e6,
+                 first_cpu=-1,
+                 kernel="recurrence",
+                 filter="sinc"):
+        """
+        Downconvert several chirps (targets) from the same input samples.
+        All targets share the decimation and the low pass filter.
+        """
+        self.dec = dec
+        self.filter_len = filter_len
+        self.dec2 = filter_len * dec
+        self.n_threads = n_threads
+        self.dt = dt
+        self.first_cpu = first_cpu
+        self.kernel = kernel
+        self.filter = filter
+        self.targets = []
+
+    def add_target(self, f0, rate):
+        """
+        Add a chirp. Returns its chirp_downconvert, which holds the chirp time.
+        """
+        cdc = chirp_downconvert(f0=f0,
+                                rate=rate,
+                                dec=self.dec,
+                                filter_len=self.filter_len,
+                                n_threads=self.n_threads,
+                                dt=self.dt,
+                                first_cpu=self.first_cpu,
+                                kernel=self.kernel,
+                                filter=self.filter)
+        self.targets.append(cdc)
+        return (cdc)
+
+    def consume(self,
+                z_in,
+                offsets,
+                z_outs,
+                n_outs):
+        """
+        Downconvert n_outs[t] samples of each target t into z_outs[t],
+        starting at input sample offsets[t] of z_in.
+        Targets with n_outs[t]=0 are left out.
+        """
+        active = [t for t in range(len(self.targets)) if n_outs[t] > 0]
+        if len(active) == 0:
+            return
+        for t in active:
+            if offsets[t] + (n_outs[t] - 1) * self.dec + self.dec2 > len(z_in):
+                print("not enough input samples for target %d %d %d %d" %
+                      (t, len(z_in), offsets[t], n_outs[t]))
+
+        # the multi-target kernel only exists for the vectorized sinc filter
+        if self.filter != "sinc" or self.kernel != "recurrence":
+            for t in active:
+                self.targets[t].consume(z_in[offsets[t]:len(z_in)],
+                                        z_outs[t],
+                                        n_outs[t])
+            return
+
+        targets = [self.targets[t] for t in active]
+        n_out_a = n.array([n_outs[t] for t in active], dtype=n.int32)
+        out_offsets = n.array(n.cumsum(n_out_a) - n_out_a, dtype=n.int64)
+        z_out = n.zeros(n.sum(n_out_a), dtype=n.complex64)
+        libdc.pool_submit_multi(targets[0].pool,
+                                len(targets),
+                                n.array([c.chirpt for c in targets], dtype=n.float64),
+                                self.dt,
+                                z_in,
+                                n.array([offsets[t] for t in active], dtype=n.int64),
+                                z_out,
+                                out_offsets,
+                                n_out_a,
+                                self.dec,
+                                self.dec2,
+                                n.array([c.f0 for c in targets], dtype=n.float64),
+                                n.array([c.rate for c in targets], dtype=n.float64),
+                                targets[0].wfun)
+        for i, t in enumerate(active):
+            z_outs[t][0:n_outs[t]] = z_out[out_offsets[i]:(out_offsets[i] + n_outs[t])]
+            self.targets[t].advance_time(n_outs[t] * self.dec)
+
+
 def chirp(L, f0=-12.5e6, cr=100e3, sr=25e6):
     """
     Generate a chirp.
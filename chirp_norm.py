@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#
+# Noise normalization of ionograms, shared by the plotting, cropping and
+# ionogram calculation programs.
+#
+# The noise floor of each frequency is the median power over range. The
+# medians of all frequencies are found at once by sorting the whole
+# array along the range axis in float32 (nan sorts last), instead of one
+# nanmedian call per frequency. method="subsample" uses at most
+# max_samples evenly spaced range gates of each frequency, which is
+# faster and close to the exact median for noise-like data.
+#
+import numpy as n
+
+methods = ["exact", "subsample"]
+
+
+def noise_floor(S, axis=1, method="exact", max_samples=256):
+    """
+    Median of S along axis, ignoring nan. With the default axis=1, the
+    median of each row (frequency) of an ionogram S (frequency x range).
+    nan if all values are nan.
+    """
+    if method not in methods:
+        raise ValueError("unknown median method %s" % (method))
+    S = n.moveaxis(n.asarray(S, dtype=n.float32), axis, -1)
+    if method == "subsample" and S.shape[-1] > max_samples:
+        stride = int(n.ceil(S.shape[-1] / float(max_samples)))
+        S = S[..., ::stride]
+    S = n.sort(S, axis=-1)
+    n_valid = n.sum(~n.isnan(S), axis=-1)
+    lo = n.maximum(0, (n_valid - 1) // 2)
+    hi = n.maximum(0, n_valid // 2)
+    med = 0.5 * (n.take_along_axis(S, lo[..., None], axis=-1)[..., 0] +
+                 n.take_along_axis(S, hi[..., None], axis=-1)[..., 0])
+    med[n_valid == 0] = n.nan
+    return (med)
+
+
+def normalize(S, axis=1, method="exact", floor=1e-3, max_samples=256):
+    """
+    Signal to noise ratio (S - noise)/noise of a power ionogram S, with
+    the noise floor along axis (see noise_floor). Values at or below zero
+    are set to floor, unless floor is None. Returns a new float32 array.
+    """
+    S = n.array(S, dtype=n.float32)
+    noise = n.expand_dims(noise_floor(S, axis=axis, method=method,
+                                      max_samples=max_samples), axis)
+    with n.errstate(divide="ignore", invalid="ignore"):
+        S -= noise
+        S /= noise
+    if floor is not None:
+        S[S <= 0.0] = floor
+    return (S)
+
+
+def to_dB(S):
+    """
+    10*log10(S) in float32, zero where it isn't finite.
+    """
+    with n.errstate(divide="ignore", invalid="ignore"):
+        dB = 10.0 * n.log10(n.asarray(S, dtype=n.float32))
+    dB[~n.isfinite(dB)] = 0.0
+    return (dB)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+# Read-ahead of raw voltage windows from a digital rf recording.
+#
+# A reader thread reads the next windows into a ring of preallocated
+# buffers while the previous ones are being processed. When consecutive
+# windows overlap, the overlapping tail is kept in memory instead of
+# being read again.
+#
+# Call close() (or use the reader in a with statement) when done, also when
+# not all windows were read, to stop the reader thread.
+#
+import queue
+import threading
+import time
+
+import numpy as n
+
+
+class window_reader:
+    def __init__(self,
+                 data,
+                 ch,
+                 i_reads,
+                 read_len,
+                 n_buffers=3,
+                 realtime=False,
+                 sample_rate=25e6):
+        """
+        Read windows of read_len samples starting at the sample indices
+        i_reads (in this order) from channel ch of the digital rf reader data.
+        In realtime mode, wait until the data is at least one second old.
+        """
+        self.data = data
+        self.ch = ch
+        self.i_reads = i_reads
+        self.read_len = read_len
+        self.realtime = realtime
+        self.sample_rate = sample_rate
+        self.sleep_time = 0.0
+        self.n_full_reads = 0
+        self.n_tail_reads = 0
+
+        n_buffers = max(2, n_buffers)
+        self.buffers = [n.zeros(read_len, dtype=n.complex64)
+                        for i in range(n_buffers)]
+        self.free = queue.Queue()
+        for bi in range(n_buffers):
+            self.free.put(bi)
+        self.full = queue.Queue()
+        self.buffer_idx = None
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.reader, daemon=True)
+        self.thread.start()
+
+    def wait_for_data(self, i1):
+        bounds = self.data.get_bounds(self.ch)
+        while (i1 + int(self.sample_rate)) > bounds[1] and not self.stopped:
+            # wait for more data to be acquired
+            # as the tail of the buffer doesn't have he data we
+            # need yet
+            time.sleep(1.0)
+            self.sleep_time += 1.0
+            bounds = self.data.get_bounds(self.ch)
+
+    def reader(self):
+        # samples at the end of the previous window that begin the next one
+        tail = None
+        for ri, i_read in enumerate(self.i_reads):
+            bi = self.free.get()
+            # None is pushed by close()
+            if bi is None or self.stopped:
+                return
+            z = self.buffers[bi]
+            missing = False
+            try:
+                if self.realtime:
+                    self.wait_for_data(i_read + self.read_len)
+
+                if tail is not None:
+                    # only read the part that we don't already have
+                    z[0:len(tail)] = tail
+                    z[len(tail):self.read_len] = self.data.read_vector_c81d(
+                        i_read + len(tail), self.read_len - len(tail), self.ch)
+                    self.n_tail_reads += 1
+                else:
+                    z[:] = self.data.read_vector_c81d(
+                        i_read, self.read_len, self.ch)
+                    self.n_full_reads += 1
+            except:
+                missing = True
+
+            # after a missing window, the next window needs a full read
+            tail = None
+            if not missing and ri + 1 < len(self.i_reads):
+                i_next = self.i_reads[ri + 1]
+                if i_next > i_read and i_next < i_read + self.read_len:
+                    tail = n.copy(z[(i_next - i_read):self.read_len])
+            self.full.put((bi, missing))
+
+    def get(self):
+        """
+        The next window as (z, missing). z is valid until the next call.
+        """
+        if self.buffer_idx is not None:
+            self.free.put(self.buffer_idx)
+        self.buffer_idx, missing = self.full.get()
+        return (self.buffers[self.buffer_idx], missing)
+
+    def close(self):
+        """
+        Stop the reader thread.
+        """
+        self.stopped = True
+        self.free.put(None)
+        self.thread.join()
+
+    def __enter__(self):
+        return (self)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#
+# Fast quicklook images of ionograms.
+#
+# The dB values are mapped to colors with a precomputed lookup table and
+# resampled (nearest neighbour) onto the pixels of the plot, so that
+# matplotlib only copies an RGB image. The figure with the axes, labels
+# and colorbar is made once and reused for every ionogram. Thumbnails
+# are made without matplotlib.
+#
+# Images are saved with PIL if it is installed (PNG or WebP), otherwise
+# with matplotlib (PNG). pyplot is only imported for the figures and
+# the matplotlib image files.
+#
+import matplotlib
+matplotlib.use("Agg")
+import numpy as n
+
+pil = False
+try:
+    from PIL import Image
+    pil = True
+except:
+    pil = False
+
+# color lookup tables by colormap name
+luts = {}
+# figure templates by size and labels
+templates = {}
+# PIL encoder settings, fast rather than small
+save_args = {"png": {"compress_level": 1},
+             "webp": {"quality": 80, "method": 2}}
+
+
+def colormap_lut(cmap="inferno", n_colors=256):
+    """
+    RGB (uint8) colors of the colormap, n_colors x 3.
+    """
+    key = (cmap, n_colors)
+    if key not in luts:
+        c = matplotlib.colormaps[cmap](n.linspace(0, 1, n_colors))
+        luts[key] = n.array(n.round(255 * c[:, 0:3]), dtype=n.uint8)
+    return (luts[key])
+
+
+def to_rgb(dB, vmin, vmax, lut, fill=None):
+    """
+    Colors of the values in dB (any shape) between vmin and vmax.
+    nan is drawn with fill (the lowest color by default).
+    """
+    n_colors = lut.shape[0]
+    idx = (n.asarray(dB, dtype=n.float32) - vmin) * ((n_colors - 1) / float(vmax - vmin))
+    bad = ~n.isfinite(idx)
+    idx[bad] = 0
+    rgb = lut[n.array(n.clip(idx + 0.5, 0, n_colors - 1), dtype=n.int32)]
+    if fill is not None:
+        rgb[bad] = fill
+    return (rgb)
+
+
+def grid_index(x, lim, n_pix):
+    """
+    Nearest sample of the regular grid x at each of n_pix pixel centers
+    spanning lim. -1 where the pixel is outside x.
+    """
+    xp = lim[0] + (n.arange(n_pix) + 0.5) * (lim[1] - lim[0]) / float(n_pix)
+    if len(x) == 0:
+        return (n.zeros(n_pix, dtype=n.int64) - 1)
+    dx = (x[-1] - x[0]) / float(max(1, len(x) - 1))
+    if dx == 0:
+        dx = 1.0
+    idx = n.array(n.round((xp - x[0]) / dx), dtype=n.int64)
+    idx[(idx < 0) | (idx >= len(x))] = -1
+    return (idx)
+
+
+def regrid(dB, x, y, xlim, ylim, width, height):
+    """
+    Nearest neighbour resampling of dB (len(y) x len(x), on regular
+    grids x and y) onto an image of height x width pixels covering xlim
+    and ylim, with the first row at the top (ylim[1]). nan outside the data.
+    """
+    xi = grid_index(x, xlim, width)
+    yi = grid_index(y, ylim, height)[::-1]
+    img = n.full((height, width), n.nan, dtype=n.float32)
+    xg = xi >= 0
+    yg = yi >= 0
+    if n.sum(xg) > 0 and n.sum(yg) > 0:
+        img[n.ix_(yg, xg)] = dB[n.ix_(yi[yg], xi[xg])]
+    return (img)
+
+
+def save_image(rgb, fname):
+    """
+    Save an RGB (uint8) image. The format is given by the file name.
+    """
+    if pil:
+        ext = fname.split(".")[-1].lower()
+        Image.fromarray(rgb).save(fname, **save_args.get(ext, {}))
+    elif fname.lower().endswith(".png"):
+        import matplotlib.pyplot as plt
+        plt.imsave(fname, rgb)
+    else:
+        raise ValueError("saving %s needs PIL" % (fname))
+
+
+def load_image(fname):
+    """
+    An RGB (uint8) image saved with save_image.
+    """
+    if pil:
+        return (n.array(Image.open(fname).convert("RGB")))
+    import matplotlib.pyplot as plt
+    img = plt.imread(fname)
+    if img.dtype != n.uint8:
+        img = n.array(n.round(255 * img), dtype=n.uint8)
+    return (n.ascontiguousarray(img[:, :, 0:3]))
+
+
+def thumbnail(dB, x, y, xlim, ylim, size, fname, vmin=-3.0, vmax=30.0, cmap="inferno"):
+    """
+    Small image (size = (width, height) pixels) of dB without axes.
+    """
+    img = regrid(dB, x, y, xlim, ylim, size[0], size[1])
+    save_image(to_rgb(img, vmin, vmax, colormap_lut(cmap)), fname)
+
+
+class figure_template:
+    def __init__(self, width, height, vmin=-3.0, vmax=30.0, cmap="inferno",
+                 clabel="SNR (dB)", xlabel="", ylabel="", dpi=100):
+        """
+        Figure of width x height pixels with the axes, labels and colorbar,
+        reused for every image.
+        """
+        import matplotlib.pyplot as plt
+        self.vmin = vmin
+        self.vmax = vmax
+        self.lut = colormap_lut(cmap)
+        self.fig = plt.figure(figsize=(width / float(dpi), height / float(dpi)), dpi=dpi)
+        self.ax = self.fig.add_subplot(111)
+        self.im = self.ax.imshow(n.zeros((2, 2, 3), dtype=n.uint8), aspect="auto",
+                                 interpolation="nearest", extent=[0, 1, 0, 1])
+        sm = matplotlib.cm.ScalarMappable(norm=matplotlib.colors.Normalize(vmin, vmax), cmap=cmap)
+        cb = self.fig.colorbar(sm, ax=self.ax)
+        cb.set_label(clabel)
+        self.ax.set_xlabel(xlabel)
+        self.ax.set_ylabel(ylabel)
+        self.title = self.ax.set_title("")
+        # size of the axes in pixels, after the layout of the first image
+        self.ax_width = None
+        self.ax_height = None
+
+    def render(self, dB, x, y, xlim, ylim, title, fname):
+        """
+        Draw dB (len(y) x len(x) on regular grids x and y) and save it to fname.
+        """
+        self.im.set_extent([xlim[0], xlim[1], ylim[0], ylim[1]])
+        self.ax.set_xlim(xlim)
+        self.ax.set_ylim(ylim)
+        self.title.set_text(title)
+        if self.ax_width is None:
+            # lay out once, the tick labels and titles are similar for all images
+            self.fig.tight_layout()
+            self.fig.canvas.draw()
+            bb = self.ax.get_window_extent()
+            self.ax_width = max(1, int(round(bb.width)))
+            self.ax_height = max(1, int(round(bb.height)))
+        img = regrid(dB, x, y, xlim, ylim, self.ax_width, self.ax_height)
+        self.im.set_data(to_rgb(img, self.vmin, self.vmax, self.lut, fill=255))
+        if pil:
+            self.fig.canvas.draw()
+            rgba = n.asarray(self.fig.canvas.buffer_rgba())
+            save_image(n.ascontiguousarray(rgba[:, :, 0:3]), fname)
+        else:
+            self.fig.savefig(fname)
+
+
+def get_template(width, height, **kwargs):
+    """
+    The figure template with these arguments, made when first needed.
+    """
+    key = (width, height, tuple(sorted(kwargs.items())))
+    if key not in templates:
+        templates[key] = figure_template(width, height, **kwargs)
+    return (templates[key])
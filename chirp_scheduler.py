@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#
+# Earliest deadline first scheduler for realtime ionogram calculation.
+#
+# All upcoming soundings of all sounders are known from the sounder
+# timings. A sounding can be calculated until its data is evicted from
+# the ringbuffer. Soundings are dispatched to any free worker, earliest
+# deadline first. If the workers cannot keep up with all soundings, the
+# ones with the lowest priority are skipped.
+#
+import numpy as n
+
+
+class sounding_schedule:
+    def __init__(self,
+                 sounders,
+                 sample_rate,
+                 min_analysis_freq,
+                 max_analysis_freq,
+                 n_workers,
+                 max_group_size=1,
+                 dispatch_ahead=10.0,
+                 lag=5.0,
+                 speed=1.0):
+        """
+        sounders is a list of sounder timings (dicts with chirp-rate, rep,
+        chirpt, id and optionally priority, larger is more important).
+        Soundings are dispatched dispatch_ahead seconds before they enter
+        the analysis band. lag is the initial estimate of how long a worker
+        is busy after the end of the sounding, and speed of how much faster
+        than realtime a worker catches up with a sounding that has already started.
+        """
+        self.sounders = sounders
+        self.sample_rate = sample_rate
+        self.min_analysis_freq = min_analysis_freq
+        self.max_analysis_freq = max_analysis_freq
+        self.n_workers = n_workers
+        self.max_group_size = max(1, max_group_size)
+        self.dispatch_ahead = dispatch_ahead
+        self.lag = lag
+        self.speed = speed
+
+        # start time of the next sweep of each sounder that isn't pending yet
+        self.next_t0 = [None] * len(sounders)
+        self.pending = []
+        # None for a free worker, otherwise the soundings it is calculating
+        self.jobs = [None] * n_workers
+        # estimated time when each busy worker is done
+        self.busy_until = [0.0] * n_workers
+        self.dispatch_time = [0.0] * n_workers
+        self.n_dispatched = 0
+        self.n_skipped = 0
+
+        self.horizon = dispatch_ahead
+        for s in sounders:
+            self.horizon = max(self.horizon,
+                               dispatch_ahead + s["rep"] + self.duration(s["chirp-rate"]))
+
+    def duration(self, rate):
+        return ((self.max_analysis_freq - self.min_analysis_freq) / rate)
+
+    def sounding(self, s_idx, t0, buffer_len):
+        s = self.sounders[s_idx]
+        rate = s["chirp-rate"]
+        band_t0 = t0 + self.min_analysis_freq / rate
+        return ({"t0": t0,
+                 "i0": int(t0 * self.sample_rate),
+                 "rate": rate,
+                 "id": s["id"],
+                 "priority": s.get("priority", 0),
+                 "realtime_req": self.duration(rate),
+                 "band_t0": band_t0,
+                 "band_t1": band_t0 + self.duration(rate),
+                 # the start of the sweep has to be read before it is evicted
+                 "deadline": band_t0 + buffer_len - 1.0})
+
+    def skip(self, s, reason):
+        self.n_skipped += 1
+        print("Skipping chirp id %d chirp-rate %1.2f kHz/s t0 %1.2f priority %d: %s" %
+              (s["id"], s["rate"] / 1e3, s["t0"], s["priority"], reason))
+
+    def update(self, now, buffer_t0, buffer_t1):
+        """
+        Add the upcoming soundings and skip the ones that can no longer
+        be calculated, or that would make more important ones miss their deadline.
+        buffer_t0 and buffer_t1 are the start and end of the ringbuffer (unix seconds).
+        """
+        buffer_len = buffer_t1 - buffer_t0
+        for s_idx, s in enumerate(self.sounders):
+            rep = float(s["rep"])
+            band_dt = self.min_analysis_freq / s["chirp-rate"]
+            t0 = self.next_t0[s_idx]
+            if t0 is None:
+                t0 = rep * n.floor(buffer_t0 / rep) + s["chirpt"]
+            while t0 + band_dt < buffer_t0:
+                t0 += rep
+            while t0 + band_dt < now + self.horizon:
+                self.pending.append(self.sounding(s_idx, t0, buffer_len))
+                t0 += rep
+            self.next_t0[s_idx] = t0
+
+        self.pending.sort(key=lambda s: s["deadline"])
+        for s in [s for s in self.pending if s["deadline"] < now]:
+            self.pending.remove(s)
+            self.skip(s, "evicted from the ringbuffer before a worker was free")
+
+        # shed load until the remaining soundings can all meet their deadline
+        while True:
+            missed = self.first_missed(now)
+            if missed is None:
+                break
+            # the least important of the soundings up to the one that is missed
+            victim = min(self.pending[0:(missed + 1)],
+                         key=lambda s: (s["priority"], -s["deadline"]))
+            self.pending.remove(victim)
+            self.skip(victim, "not enough workers")
+
+    def groups(self, soundings):
+        """
+        Split soundings (sorted by deadline) into the groups that are
+        dispatched together, as the soundings that enter the analysis band
+        during the sweep of the first one.
+        """
+        groups = []
+        for s in soundings:
+            g = groups[-1] if len(groups) > 0 else None
+            if (g is not None and len(g) < self.max_group_size and
+                    s["band_t0"] < g[0]["band_t0"] + g[0]["realtime_req"]):
+                g.append(s)
+            else:
+                groups.append([s])
+        return (groups)
+
+    def job_end(self, start, group):
+        t0 = min([s["band_t0"] for s in group])
+        t1 = max([s["band_t1"] for s in group])
+        return (max(t1, start + (t1 - t0) / self.speed) + self.lag)
+
+    def first_missed(self, now):
+        """
+        Simulate dispatching the pending soundings earliest deadline first.
+        Returns the index of the first sounding that misses its deadline, or None.
+        """
+        free = [now if self.jobs[w] is None else max(now, self.busy_until[w])
+                for w in range(self.n_workers)]
+        i = 0
+        for g in self.groups(self.pending):
+            w = int(n.argmin(free))
+            start = max(free[w], g[0]["band_t0"] - self.dispatch_ahead)
+            for s in g:
+                if start > s["deadline"]:
+                    return (i)
+                i += 1
+            free[w] = self.job_end(start, g)
+        return (None)
+
+    def dispatch(self, now):
+        """
+        Assign the pending soundings that are about to enter the analysis band
+        to free workers. Returns a list of (worker, soundings).
+        """
+        out = []
+        for g in self.groups(self.pending):
+            if g[0]["band_t0"] - self.dispatch_ahead > now:
+                break
+            free = [w for w in range(self.n_workers) if self.jobs[w] is None]
+            if len(free) == 0:
+                break
+            w = free[0]
+            for s in g:
+                self.pending.remove(s)
+            self.jobs[w] = g
+            self.busy_until[w] = self.job_end(now, g)
+            self.dispatch_time[w] = now
+            self.n_dispatched += len(g)
+            out.append((w, g))
+        return (out)
+
+    def done(self, w, now):
+        """
+        Worker w is done. Updates the estimate of how long the calculation
+        continues after the end of a sounding that was followed in realtime
+        from its start, or of the speed when catching up with a sounding.
+        """
+        g = self.jobs[w]
+        if g is not None:
+            t0 = min([s["band_t0"] for s in g])
+            t1 = max([s["band_t1"] for s in g])
+            if self.dispatch_time[w] <= t0:
+                lag = max(0.0, now - t1)
+                self.lag = 0.8 * self.lag + 0.2 * lag
+            elif now - self.lag > t1:
+                speed = (t1 - t0) / max(1e-3, now - self.lag - self.dispatch_time[w])
+                self.speed = 0.8 * self.speed + 0.2 * speed
+        self.jobs[w] = None
+
+    def status(self):
+        return ("%d pending %d busy workers %d dispatched %d skipped lag %1.1f s speed %1.1f" %
+                (len(self.pending), len([j for j in self.jobs if j is not None]),
+                 self.n_dispatched, self.n_skipped, self.lag, self.speed))
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+#
+# Spectrogram of the chirp downconverted signal, i.e., the ionogram.
+#
+# All windows are transformed with one batched (multi-threaded) FFT in
+# single precision, instead of one FFT per frequency step.
+#
+# spectrogram_stream forms the rows incrementally as samples arrive,
+# keeping only the samples of the next window in memory.
+#
+# If only the frequency bins near zero (the range gates closest to the
+# transmitter) are needed, the signal is low pass filtered and the
+# windows are decimated before the FFT (zoom FFT), so that the cost and
+# the output size scale with the range extent.
+#
+import numpy as n
+
+# pyfftw is tried on the first fft (see use_fftw)
+fftw = None
+
+
+def use_fftw():
+    """
+    True if pyfftw can be used, imported when first needed.
+    """
+    global fftw, pyfftw
+    if fftw is None:
+        try:
+            import pyfftw
+            fftw = True
+        except:
+            fftw = False
+    return (fftw)
+
+# windows transformed at once, limits the memory used
+max_batch_samples = 4 * 1024 * 1024
+
+
+def batch_fft(X, n_workers=1):
+    """
+    FFT of each row of X, in place if possible.
+    """
+    if use_fftw():
+        return (pyfftw.interfaces.numpy_fft.fft(X, axis=1, threads=n_workers))
+    import scipy.fft
+    return (scipy.fft.fft(X, axis=1, workers=n_workers, overwrite_x=True))
+
+
+def zoom_band(window, bins):
+    """
+    Center (relative to zero frequency) and half width of the fftshifted
+    frequency bins (indices 0...window-1), in bins.
+    """
+    k = n.array(bins) - window // 2
+    center = int(n.round((n.min(k) + n.max(k)) / 2.0))
+    half_width = int(n.max(n.abs(k - center))) + 1
+    return (center, half_width)
+
+
+def zoom_decimation(window, half_width, oversampling=1.25):
+    """
+    Largest decimation of the windows that keeps a band of +/- half_width
+    bins alias free with the requested oversampling.
+    The decimation divides window.
+    """
+    max_dec = int(window / (2.0 * oversampling * half_width))
+    for D in range(max_dec, 1, -1):
+        if window % D == 0:
+            return (D)
+    return (1)
+
+
+def zoom_filter(window, D, half_width, attenuation=80.0):
+    """
+    Low pass filter for decimating the windows by D. The passband covers
+    +/- half_width bins, and the stopband starts where aliases would fold
+    into it.
+    """
+    import scipy.signal as ss
+    # cycles per sample
+    f_pass = half_width / float(window)
+    f_stop = 1.0 / D - f_pass
+    numtaps, beta = ss.kaiserord(attenuation, 2.0 * (f_stop - f_pass))
+    numtaps = numtaps | 1
+    h = ss.firwin(numtaps, 0.5 / D, window=("kaiser", beta), fs=1.0)
+    return (n.array(h, dtype=n.float32))
+
+
+def spectrogram(x, window=1024, step=512, wf=None, output="power", n_workers=1, bins=None):
+    """
+    Spectrogram of x with windows of length window, every step samples.
+    wf is the window function (hann by default).
+    output is "power" (float32 |X|^2), "complex" (complex64),
+    or "both", which returns (power, complex).
+    The frequency axis is fftshifted.
+    bins selects fftshifted frequency bins. The spectrum is then only
+    computed near these bins, with a zoom FFT.
+    """
+    if output not in ["power", "complex", "both"]:
+        raise ValueError("unknown spectrogram output %s" % (output))
+    import scipy.signal as ss
+    if wf is None:
+        wf = ss.hann(window)
+    wf = n.array(wf, dtype=n.float32)
+    x = n.asarray(x, dtype=n.complex64)
+    n_spec = max(0, int((len(x) - window) / step))
+
+    D = 1
+    center = 0
+    if bins is not None:
+        bins = n.array(bins, dtype=n.int64)
+        center, half_width = zoom_band(window, bins)
+        D = zoom_decimation(window, half_width)
+    # input sample spacing of the windows and of consecutive windows
+    w_stride = 1
+    s_stride = step
+    if D > 1:
+        # shift the band to zero frequency, low pass filter and decimate
+        # each window by D. the bins stay the same, X[k] = D*X_D[k]
+        h = zoom_filter(window, D, half_width)
+        c = (len(h) - 1) // 2
+        if center != 0:
+            # shift the passband of the filter instead of the signal,
+            # only the filtered samples that are used are shifted back
+            h = n.array(h * n.exp(2j * n.pi * center * (n.arange(len(h)) - c) / window),
+                        dtype=n.complex64)
+        if step % D == 0:
+            # all windows start on the same grid of every D:th sample,
+            # only filter these samples
+            n_dec = (len(x) + D - 1) // D
+            x_p = n.zeros((n_dec - 1) * D + len(h), dtype=n.complex64)
+            x_p[(len(h) - 1 - c):(len(h) - 1 - c + len(x))] = x
+            # row k holds the input samples of filtered sample k*D
+            X = n.lib.stride_tricks.as_strided(x_p,
+                                               shape=(n_dec, len(h)),
+                                               strides=(D * x_p.strides[0], x_p.strides[0]),
+                                               writeable=False)
+            x = n.dot(X, n.array(h[::-1], dtype=n.complex64))
+            ts = n.arange(len(x)) * D
+            s_stride = step // D
+        else:
+            x = n.array(ss.oaconvolve(x, h, mode="same"), dtype=n.complex64)
+            ts = n.arange(len(x))
+            w_stride = D
+        if center != 0:
+            x = x * n.array(n.exp(-2j * n.pi * ((center * ts) % window) / window),
+                            dtype=n.complex64)
+        wf = D * wf[::D]
+    else:
+        center = 0
+    M = window // D
+
+    if bins is None:
+        # all bins
+        cols = n.arange(M)
+    else:
+        # bins of the (decimated and shifted) fftshifted spectrum
+        cols = bins - window // 2 - center + M // 2
+
+    if output != "complex":
+        P = n.zeros([n_spec, len(cols)], dtype=n.float32)
+    if output != "power":
+        C = n.zeros([n_spec, len(cols)], dtype=n.complex64)
+
+    # view of all (decimated) windows without copying
+    windows = n.lib.stride_tricks.as_strided(x,
+                                             shape=(n_spec, M),
+                                             strides=(s_stride * x.strides[0], w_stride * x.strides[0]),
+                                             writeable=False)
+    batch = max(1, int(max_batch_samples / M))
+    for i0 in range(0, n_spec, batch):
+        i1 = min(n_spec, i0 + batch)
+        X = n.fft.fftshift(batch_fft(windows[i0:i1, :] * wf[None, :],
+                                     n_workers=n_workers), axes=1)
+        if bins is not None:
+            X = X[:, cols]
+        if center != 0 and output != "power":
+            # undo the phase of the frequency shift at the start of each window
+            X = X * n.array(n.exp(2j * n.pi * center * step * n.arange(i0, i1) / window),
+                            dtype=n.complex64)[:, None]
+        if output != "complex":
+            P[i0:i1, :] = X.real**2.0 + X.imag**2.0
+        if output != "power":
+            C[i0:i1, :] = X
+
+    if output == "power":
+        return (P)
+    elif output == "complex":
+        return (C)
+    return (P, C)
+
+
+class spectrogram_stream:
+    def __init__(self, window=1024, step=512, wf=None, output="power", n_workers=1, bins=None):
+        """
+        Spectrogram formed incrementally as the samples arrive.
+        The rows are the same as those of spectrogram() of all the samples.
+        With bins, the zoom filter doesn't see across pushes, which only
+        affects the tails of the window function.
+        """
+        self.window = window
+        self.step = step
+        self.wf = wf
+        self.output = output
+        self.n_workers = n_workers
+        self.bins = bins
+        self.n_rows = 0
+        # samples from the start of the next window on
+        self.x = n.zeros(0, dtype=n.complex64)
+
+    def push(self, x):
+        """
+        Add samples. Returns the rows of the windows that are now complete,
+        or None if there are none.
+        """
+        self.x = n.concatenate((self.x, n.asarray(x, dtype=n.complex64)))
+        # as in spectrogram(), a window is used when it is followed by a step of samples
+        n_spec = max(0, int((len(self.x) - self.window) / self.step))
+        if n_spec == 0:
+            return (None)
+        rows = spectrogram(self.x[0:(n_spec * self.step + self.window)],
+                           window=self.window,
+                           step=self.step,
+                           wf=self.wf,
+                           output=self.output,
+                           n_workers=self.n_workers,
+                           bins=self.bins)
+        self.x = n.copy(self.x[(n_spec * self.step):len(self.x)])
+        self.n_rows += n_spec
+        return (rows)
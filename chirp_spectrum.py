@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+#
+# Long term spectrum of the recording, a by-product of chirp detection.
+#
+# The detector already computes the FFT of every block it analyzes (to
+# whiten it). With spectrum_summary=true, that spectrum is averaged into
+# spectrum_summary_bins frequency bins and over spectrum_summary_interval
+# seconds, and appended to a daily summary file:
+#
+#   output_dir/<day>/spectrum_summary.h5
+#     t       start of each interval (unix time)
+#     n_avg   number of blocks averaged
+#     S       mean power (n_intervals x n_bins, float32)
+#     freqs   center frequency of each bin (Hz)
+#
+# Each mpi rank averages its own blocks, so an interval can have one row
+# per rank. read_summary() combines them. Writers are serialized with
+# flock on a lock file next to the summary, as in chirp_daily.
+#
+# Waterfalls are plotted from the summaries with plot_spectrum_summary.py.
+#
+import calendar
+import fcntl
+import glob
+import os
+import time
+
+import h5py
+import numpy as n
+
+import chirp_storage as cst
+import chirp_util as cu
+
+
+def summary_fname(conf, t):
+    return ("%s/%s/spectrum_summary.h5" % (conf.output_dir, cu.unix2dirname(t)))
+
+
+def bin_edges(n_samples, n_bins):
+    """
+    First FFT bin (fftshifted) of each summary bin, and the end of the last one.
+    """
+    return (n.array(n.round(n.linspace(0, n_samples, n_bins + 1)), dtype=n.int64))
+
+
+def reduce_spectrum(Z, n_bins):
+    """
+    Mean power of the spectrum Z (not fftshifted) in n_bins frequency bins,
+    lowest frequency first.
+    """
+    P = n.fft.fftshift(n.array(Z.real**2.0 + Z.imag**2.0, dtype=n.float32))
+    edges = bin_edges(len(P), n_bins)
+    return (n.add.reduceat(P, edges[0:n_bins]) / n.diff(edges))
+
+
+def bin_frequencies(n_samples, n_bins, sample_rate, center_freq):
+    """
+    Center frequency (Hz) of each bin of reduce_spectrum.
+    """
+    edges = bin_edges(n_samples, n_bins)
+    df = float(sample_rate) / float(n_samples)
+    mid = 0.5 * (edges[0:n_bins] + edges[1:] - 1)
+    return (center_freq - sample_rate / 2.0 + mid * df)
+
+
+class spectrum_summary:
+    def __init__(self, conf):
+        """
+        Average the spectra of the detector and append them to the daily
+        summary files.
+        """
+        self.conf = conf
+        self.n_bins = conf.spectrum_summary_bins
+        self.interval = conf.spectrum_summary_interval
+        self.freqs = bin_frequencies(conf.n_samples_per_block, self.n_bins,
+                                     conf.sample_rate, conf.center_freq)
+        # interval being averaged
+        self.t = None
+        self.S = n.zeros(self.n_bins, dtype=n.float64)
+        self.n_avg = 0
+
+    def add(self, t, Z):
+        """
+        Add the spectrum Z (FFT of the windowed block starting at unix time t).
+        """
+        ti = n.floor(t / self.interval) * self.interval
+        if self.t is not None and ti != self.t:
+            self.flush()
+        self.t = ti
+        self.S += reduce_spectrum(Z, self.n_bins)
+        self.n_avg += 1
+
+    def flush(self):
+        """
+        Append the average of the current interval to the summary file.
+        """
+        if self.n_avg == 0:
+            return
+        fname = summary_fname(self.conf, self.t)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with open("%s.lock" % (fname), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with h5py.File(fname, "a") as h:
+                    if "t" not in h.keys():
+                        self.create(h)
+                    i = h["t"].shape[0]
+                    for k in ["t", "n_avg", "S"]:
+                        h[k].resize((i + 1,) + h[k].shape[1:])
+                    h["t"][i] = self.t
+                    h["n_avg"][i] = self.n_avg
+                    h["S"][i, :] = self.S / self.n_avg
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self.t = None
+        self.S[:] = 0.0
+        self.n_avg = 0
+
+    def create(self, h):
+        chunk_len = 64
+        args = cst.filter_args(self.conf.compression, (chunk_len, self.n_bins), chunk_len)
+        args["chunks"] = (chunk_len, self.n_bins)
+        h.create_dataset("S", shape=(0, self.n_bins), maxshape=(None, self.n_bins),
+                         dtype=n.float32, **args)
+        h.create_dataset("t", shape=(0,), maxshape=(None,), dtype=n.float64, chunks=(1024,))
+        h.create_dataset("n_avg", shape=(0,), maxshape=(None,), dtype=n.int64, chunks=(1024,))
+        h["freqs"] = self.freqs
+        h.attrs["interval"] = self.interval
+        h.attrs["sample_rate"] = self.conf.sample_rate
+        h.attrs["center_freq"] = self.conf.center_freq
+
+
+def read_summary(conf, t0=None, t1=None):
+    """
+    Spectrum summary between t0 and t1 (unix time, None for no limit).
+    Returns times (n_t), frequencies (n_bins) and mean power (n_t x n_bins),
+    with the rows of the same interval combined, or None if there is none.
+    """
+    ts = []
+    Ss = []
+    ws = []
+    freqs = None
+    for fname in sorted(glob.glob("%s/*/spectrum_summary.h5" % (conf.output_dir))):
+        day = os.path.basename(os.path.dirname(fname))
+        try:
+            t_day = calendar.timegm(time.strptime(day, "%Y-%m-%d"))
+        except ValueError:
+            continue
+        if (t0 is not None and t_day + 24 * 3600 <= t0) or (t1 is not None and t_day > t1):
+            continue
+        with open("%s.lock" % (fname), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            try:
+                with h5py.File(fname, "r") as h:
+                    f = n.copy(h["freqs"])
+                    if freqs is None:
+                        freqs = f
+                    elif len(f) != len(freqs) or not n.allclose(f, freqs):
+                        print("%s has different frequency bins. Skipping" % (fname))
+                        continue
+                    t = n.copy(h["t"])
+                    idx = n.ones(len(t), dtype=bool)
+                    if t0 is not None:
+                        idx &= t >= t0
+                    if t1 is not None:
+                        idx &= t < t1
+                    idx = n.where(idx)[0]
+                    ts.append(t[idx])
+                    ws.append(n.copy(h["n_avg"])[idx])
+                    Ss.append(h["S"][()][idx, :])
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    if freqs is None or sum(len(t) for t in ts) == 0:
+        return (None)
+    t = n.concatenate(ts)
+    w = n.array(n.concatenate(ws), dtype=n.float64)
+    S = n.concatenate(Ss)
+    # mean of the ranks, weighted by the number of blocks
+    tu, ti = n.unique(t, return_inverse=True)
+    Su = n.zeros((len(tu), len(freqs)))
+    wu = n.zeros(len(tu))
+    n.add.at(Su, ti, w[:, None] * S)
+    n.add.at(wu, ti, w)
+    return (tu, freqs, n.array(Su / wu[:, None], dtype=n.float32))
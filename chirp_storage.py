@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#
+# Compact storage of ionograms (S) and raw voltage (z) in hdf5 files.
+#
+# S can be stored as float16, or as log scaled 8 or 16 bit integers, and z
+# as 16 bit integer I/Q, both with chunking and compression. The encoding
+# is stored in the attributes of the dataset, and read() restores the
+# original array from any file, including files written before this.
+#
+import os
+
+import h5py
+import numpy as n
+
+ionogram_formats = ["float32", "float16", "log_uint16", "log_uint8"]
+raw_voltage_formats = ["complex64", "int16"]
+compressions = [None, "lzf", "gzip"]
+
+# range of powers that the log scaled formats cover
+log_dynamic_range = {"log_uint8": 100.0, "log_uint16": 200.0}
+
+
+def filter_args(compression, shape, chunk_len):
+    """
+    hdf5 chunking and compression arguments for create_dataset.
+    """
+    if compression not in compressions:
+        raise ValueError("unknown compression %s" % (compression))
+    if compression is None or n.prod(shape) == 0:
+        return ({})
+    chunks = (min(shape[0], chunk_len),) + tuple(shape[1:])
+    if compression == "lzf":
+        return ({"chunks": chunks, "compression": "lzf", "shuffle": True})
+    return ({"chunks": chunks, "compression": "gzip", "compression_opts": 1, "shuffle": True})
+
+
+def encode_S(S, fmt="float32"):
+    """
+    Encode the ionogram S (real power or complex) in format fmt.
+    Returns (array, format, attributes).
+    """
+    if fmt not in ionogram_formats:
+        raise ValueError("unknown ionogram format %s" % (fmt))
+    S = n.asarray(S)
+    attrs = {}
+    if fmt == "float32":
+        if n.iscomplexobj(S):
+            D = n.array(S, dtype=n.complex64)
+        else:
+            D = n.array(S, dtype=n.float32)
+    elif fmt == "float16":
+        # scale the peak to 5e4, the range of float16 is +/- 65504
+        peak = n.nanmax(n.abs(S)) if S.size > 0 else 0.0
+        scale = peak / 5e4 if n.isfinite(peak) and peak > 0 else 1.0
+        attrs["scale"] = scale
+        if n.iscomplexobj(S):
+            # real and imaginary parts in the last axis
+            D = n.array(n.stack((S.real, S.imag), axis=-1) / scale, dtype=n.float16)
+            fmt = "complex_float16"
+        else:
+            D = n.array(S / scale, dtype=n.float16)
+    else:
+        if n.iscomplexobj(S):
+            raise ValueError("%s needs a real valued ionogram" % (fmt))
+        bits = 8 if fmt == "log_uint8" else 16
+        max_q = 2**bits - 1
+        valid = n.isfinite(S) & (S > 0)
+        offset = 0.0
+        scale = 1.0
+        if n.sum(valid) > 0:
+            dB = 10.0 * n.log10(S[valid])
+            top = n.max(dB)
+            offset = max(n.min(dB), top - log_dynamic_range[fmt])
+            if top > offset:
+                scale = (top - offset) / (max_q - 1)
+        # 0 is reserved for zero or invalid power
+        D = n.zeros(S.shape, dtype=n.uint8 if bits == 8 else n.uint16)
+        if n.sum(valid) > 0:
+            D[valid] = n.clip(1 + n.round((dB - offset) / scale), 1, max_q)
+        attrs["offset"] = offset
+        attrs["scale"] = scale
+    return (D, fmt, attrs)
+
+
+def write_S(ho, S, fmt="float32", compression=None, name="S"):
+    """
+    Store the ionogram S (real power or complex) in format fmt.
+    """
+    D, fmt, attrs = encode_S(S, fmt)
+    ds = ho.create_dataset(name, data=D, **filter_args(compression, D.shape, 64))
+    ds.attrs["format"] = fmt
+    for k in attrs.keys():
+        ds.attrs[k] = attrs[k]
+
+
+def write_z(ho, z, fmt="complex64", compression=None, name="z"):
+    """
+    Store the raw (chirp downconverted) voltage z in format fmt.
+    """
+    if fmt not in raw_voltage_formats:
+        raise ValueError("unknown raw voltage format %s" % (fmt))
+    z = n.asarray(z)
+    if fmt == "complex64":
+        D = n.array(z, dtype=n.complex64)
+        scale = None
+    else:
+        peak = max(n.max(n.abs(z.real)), n.max(n.abs(z.imag))) if z.size > 0 else 0.0
+        scale = peak / 32767.0 if peak > 0 else 1.0
+        D = n.zeros((len(z), 2), dtype=n.int16)
+        D[:, 0] = n.round(z.real / scale)
+        D[:, 1] = n.round(z.imag / scale)
+    ds = ho.create_dataset(name, data=D, **filter_args(compression, D.shape, 65536))
+    ds.attrs["format"] = fmt
+    if scale is not None:
+        ds.attrs["scale"] = scale
+
+
+def decode(D, fmt, attrs):
+    """
+    Restore an array stored in format fmt with attributes attrs.
+    """
+    if isinstance(fmt, bytes):
+        fmt = fmt.decode()
+    if fmt == "float16":
+        return (n.array(D, dtype=n.float32) * n.float32(attrs["scale"]))
+    if fmt == "complex_float16":
+        scale = n.float32(attrs["scale"])
+        return (n.array(D[..., 0] * scale + 1j * D[..., 1] * scale, dtype=n.complex64))
+    if fmt in ["log_uint8", "log_uint16"]:
+        dB = attrs["offset"] + (n.array(D, dtype=n.float32) - 1.0) * attrs["scale"]
+        return (n.array(n.where(D > 0, 10.0**(dB / 10.0), 0.0), dtype=n.float32))
+    if fmt == "int16":
+        scale = n.float32(attrs["scale"])
+        return (n.array(D[:, 0] * scale + 1j * D[:, 1] * scale, dtype=n.complex64))
+    return (D)
+
+
+def read(h, name):
+    """
+    Read dataset name of an ionogram file, restoring the stored format.
+    """
+    ds = h[name]
+    D = n.copy(ds)
+    if "format" not in ds.attrs.keys():
+        return (D)
+    return (decode(D, ds.attrs["format"], ds.attrs))
+
+
+def compact(fname, ionogram_format="float32", raw_voltage_format="complex64", compression=None):
+    """
+    Rewrite the ionogram file fname with S and z in the given formats.
+    The file is replaced atomically.
+    """
+    tmp = "%s.tmp%d" % (fname, os.getpid())
+    try:
+        with h5py.File(fname, "r") as h, h5py.File(tmp, "w") as ho:
+            for k in h.keys():
+                if k in ["S", "S_norm"]:
+                    write_S(ho, read(h, k), ionogram_format, compression, name=k)
+                elif k == "z":
+                    write_z(ho, read(h, k), raw_voltage_format, compression)
+                else:
+                    h.copy(k, ho)
+        os.replace(tmp, fname)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+#
+# Tile pyramid of the ionograms for browsing the archive as static files,
+# in output_dir/tiles/<day>/:
+#
+#   day-<id>.<fmt>            the whole day of one sounder, one row per hour
+#                             and one small image per slot (slot seconds)
+#   hour-<id>-<HH>.<fmt>      one hour of one sounder, one thumbnail per slot
+#   <ionogram>/<row>-<col>.<fmt>
+#                             full resolution tiles of each ionogram
+#                             (tile_size pixels, row 0 at the top)
+#   index.json                the ionograms in the pyramid, with their slot,
+#                             tiles and extent, the frequency band of the
+#                             day and hour images, and the ionograms that
+#                             were skipped
+#
+# The full resolution tiles cover the frequencies stored in each
+# ionogram. The thumbnails in the day and hour images cover the band in
+# index.json, which is the band stored in the first ionogram of the day.
+# Ionograms of the day with another band (e.g., after a change of the
+# analysis band) are skipped, like in crop_ionograms.py, so that the
+# thumbnails of a day are comparable.
+#
+# The pyramid is updated incrementally: only ionograms that are not in
+# index.json are added. The day and hour images are kept as raw arrays
+# (.npy next to each image), updated, and encoded once per update, so
+# that lossy formats (webp) don't lose quality with every update.
+#
+#   python chirp_tiles.py config.ini
+#
+# keeps updating the pyramid if realtime=true in the configuration.
+#
+import argparse
+import fnmatch
+import glob
+import json
+import os
+import sys
+import time
+import traceback
+
+import h5py
+import numpy as n
+import scipy.constants as c
+
+import chirp_config as cc
+import chirp_norm as cn
+import chirp_render as crd
+import chirp_storage as cst
+
+
+def write_json(fname, d):
+    tmp = "%s.tmp%d" % (fname, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(d, f)
+    os.replace(tmp, fname)
+
+
+class tile_pyramid:
+    def __init__(self,
+                 conf,
+                 tile_size=256,
+                 thumbnail_size=(96, 72),
+                 slot=60.0,
+                 max_pixels=4096,
+                 vmin=-3.0,
+                 vmax=30.0,
+                 cmap="inferno"):
+        """
+        Ionograms are placed in the slot (of slot seconds) of their start time.
+        Full resolution tiles have one pixel per frequency step and range gate,
+        at most max_pixels in each direction.
+        """
+        self.conf = conf
+        self.fmt = conf.plot_format
+        self.tile_size = tile_size
+        self.thumbnail_size = tuple(thumbnail_size)
+        self.day_size = (max(1, thumbnail_size[0] // 2), max(1, thumbnail_size[1] // 2))
+        self.slot = slot
+        self.n_slots = int(n.ceil(3600.0 / slot))
+        self.max_pixels = max_pixels
+        self.vmin = vmin
+        self.vmax = vmax
+        self.lut = crd.colormap_lut(cmap)
+        self.tile_dir = "%s/tiles" % (conf.output_dir)
+        # images being updated, written by flush()
+        self.images = {}
+
+    def image(self, fname, shape):
+        """
+        The image fname (height, width), read from its raw array if it
+        exists, otherwise empty.
+        """
+        if fname not in self.images:
+            img = None
+            raw_fname = "%s.npy" % (fname)
+            try:
+                if os.path.exists(raw_fname):
+                    img = n.load(raw_fname)
+                elif os.path.exists(fname):
+                    # made before the raw arrays were kept
+                    img = crd.load_image(fname)
+            except:
+                print("can't read %s, starting a new one" % (fname))
+            if img is not None and img.shape != (shape[0], shape[1], 3):
+                img = None
+            if img is None:
+                img = n.zeros((shape[0], shape[1], 3), dtype=n.uint8)
+            self.images[fname] = img
+        return (self.images[fname])
+
+    def flush(self):
+        for fname in self.images.keys():
+            # the raw array first, the image is encoded from it
+            tmp = "%s.tmp%d.npy" % (fname, os.getpid())
+            n.save(tmp, self.images[fname])
+            os.replace(tmp, "%s.npy" % (fname))
+            crd.save_image(self.images[fname], fname)
+        self.images = {}
+
+    def read_dB(self, fname):
+        """
+        Noise normalized ionogram (dB, range x frequency), frequencies (MHz)
+        and range gates (km) of an ionogram file, or None if it isn't complete.
+        """
+        with h5py.File(fname, "r", swmr=True) as h:
+            if "complete" in h.keys() and not bool(n.copy(h["complete"])):
+                return (None)
+            if "S_norm" in h.keys():
+                S = cst.read(h, "S_norm")
+            else:
+                S = cn.normalize(cst.read(h, "S"), axis=1, method=self.conf.noise_floor_method)
+            if n.iscomplexobj(S):
+                raise ValueError("two channel ionograms are not supported")
+            freqs = n.copy(h["freqs"])
+            ranges = n.copy(h["ranges"])
+            info = {"t0": float(n.copy(h["t0"])),
+                    "id": int(n.copy(h["id"])),
+                    "rate": float(n.copy(h["rate"]))}
+        n_rows = min(S.shape[0], len(freqs))
+        # the propagation time is anything added to a full second (see plot_ionograms)
+        dr = (info["t0"] - n.floor(info["t0"])) * c.c / 1e3
+        range_gates = dr + 2 * ranges / 1e3
+        info["ylim"] = [dr - self.conf.max_range_extent / 1e3, dr + self.conf.max_range_extent / 1e3]
+        return (n.transpose(cn.to_dB(S[0:n_rows, :])), freqs[0:n_rows] / 1e6, range_gates, info)
+
+    def add(self, fname, day_dir, index):
+        """
+        Add ionogram fname to the pyramid of the day in day_dir, or to the
+        skipped ionograms if its band isn't the band of the day.
+        Returns False if the ionogram isn't complete yet.
+        """
+        r = self.read_dB(fname)
+        if r is None:
+            return (False)
+        dB, freqs, range_gates, info = r
+        name = os.path.basename(fname)[0:-3]
+        if len(freqs) == 0:
+            index["skipped"].append(name)
+            return (True)
+        ylim = info["ylim"]
+        df = freqs[1] - freqs[0] if len(freqs) > 1 else self.conf.frequency_resolution / 1e6
+
+        # the band of the day is the band of its first ionogram
+        if index["band"] is None:
+            index["band"] = [float(freqs[0]), float(freqs[-1])]
+        band = index["band"]
+        if abs(freqs[0] - band[0]) > df / 2.0 or abs(freqs[-1] - band[1]) > df / 2.0:
+            print("%s has band %1.3f-%1.3f MHz, day %1.3f-%1.3f MHz. Skipping" %
+                  (fname, freqs[0], freqs[-1], band[0], band[1]))
+            index["skipped"].append(name)
+            return (True)
+
+        # full resolution tiles of the frequencies of this ionogram
+        dr = range_gates[1] - range_gates[0] if len(range_gates) > 1 else 1.0
+        xlim = [freqs[0] - df / 2.0, freqs[-1] + df / 2.0]
+        width = int(min(self.max_pixels, max(1, n.round((xlim[1] - xlim[0]) / df))))
+        height = int(min(self.max_pixels, max(1, n.round((ylim[1] - ylim[0]) / dr))))
+        rgb = crd.to_rgb(crd.regrid(dB, freqs, range_gates, xlim, ylim, width, height),
+                         self.vmin, self.vmax, self.lut, fill=0)
+        ts = self.tile_size
+        n_rows = int(n.ceil(height / float(ts)))
+        n_cols = int(n.ceil(width / float(ts)))
+        dname = "%s/%s" % (day_dir, name)
+        os.makedirs(dname, exist_ok=True)
+        for ti in range(n_rows):
+            for tj in range(n_cols):
+                tile = n.zeros((ts, ts, 3), dtype=n.uint8)
+                part = rgb[(ti * ts):((ti + 1) * ts), (tj * ts):((tj + 1) * ts), :]
+                tile[0:part.shape[0], 0:part.shape[1], :] = part
+                crd.save_image(tile, "%s/%d-%d.%s" % (dname, ti, tj, self.fmt))
+
+        # thumbnail in the hour strip, and a smaller one in the day mosaic
+        t_day = info["t0"] % (24 * 3600.0)
+        hour = int(t_day // 3600)
+        si = min(self.n_slots - 1, int((t_day - hour * 3600.0) // self.slot))
+        # thumbnails of the band of the day
+        tw, th = self.thumbnail_size
+        thumb = crd.to_rgb(crd.regrid(dB, freqs, range_gates, band, ylim, tw, th),
+                           self.vmin, self.vmax, self.lut, fill=0)
+        strip = self.image("%s/hour-%03d-%02d.%s" % (day_dir, info["id"], hour, self.fmt),
+                           (th, tw * self.n_slots))
+        strip[:, (si * tw):((si + 1) * tw), :] = thumb
+        dw, dh = self.day_size
+        mosaic = self.image("%s/day-%03d.%s" % (day_dir, info["id"], self.fmt),
+                            (24 * dh, dw * self.n_slots))
+        mosaic[(hour * dh):((hour + 1) * dh), (si * dw):((si + 1) * dw), :] = \
+            crd.to_rgb(crd.regrid(dB, freqs, range_gates, band, ylim, dw, dh),
+                       self.vmin, self.vmax, self.lut, fill=0)
+
+        index["ionograms"][name] = {"t0": info["t0"],
+                                    "id": info["id"],
+                                    "rate": info["rate"],
+                                    "hour": hour,
+                                    "slot": si,
+                                    "tiles": [n_rows, n_cols],
+                                    "size": [height, width],
+                                    "extent": [xlim[0], xlim[1], ylim[0], ylim[1]]}
+        return (True)
+
+    def update_day(self, dname):
+        """
+        Add the new ionograms in the output directory dname of one day.
+        Returns the number of ionograms added.
+        """
+        day = os.path.basename(dname)
+        day_dir = "%s/%s" % (self.tile_dir, day)
+        os.makedirs(day_dir, exist_ok=True)
+        index_fname = "%s/index.json" % (day_dir)
+        index = {"tile_size": self.tile_size,
+                 "thumbnail_size": list(self.thumbnail_size),
+                 "day_size": list(self.day_size),
+                 "slot": self.slot,
+                 "format": self.fmt,
+                 # set by the first ionogram
+                 "band": None,
+                 "ionograms": {},
+                 "skipped": []}
+        if os.path.exists(index_fname):
+            with open(index_fname, "r") as f:
+                index = json.load(f)
+            if "band" not in index:
+                # pyramids made before the band was stored have the
+                # thumbnails of the analysis band
+                index["band"] = [f / 1e6 for f in self.conf.analysis_band()]
+            if "skipped" not in index:
+                index["skipped"] = []
+
+        n_ionograms = len(index["ionograms"])
+        n_skipped = len(index["skipped"])
+        skipped = set(index["skipped"])
+        for name in sorted(fnmatch.filter(os.listdir(dname), "lfm*.h5")):
+            if name[0:-3] in index["ionograms"] or name[0:-3] in skipped:
+                continue
+            try:
+                self.add("%s/%s" % (dname, name), day_dir, index)
+            except:
+                traceback.print_exc(file=sys.stdout)
+                print("error adding %s/%s to the tile pyramid" % (dname, name))
+        n_added = len(index["ionograms"]) - n_ionograms
+        if n_added > 0 or len(index["skipped"]) > n_skipped:
+            self.flush()
+            write_json(index_fname, index)
+        return (n_added)
+
+    def update(self, n_days=None):
+        """
+        Add new ionograms of all days, or of the n_days most recent days.
+        """
+        dnames = glob.glob("%s/*[0-9]" % (self.conf.output_dir))
+        dnames = [d for d in dnames if os.path.isdir(d)]
+        dnames.sort()
+        if n_days is not None:
+            dnames = dnames[max(0, len(dnames) - n_days):len(dnames)]
+        n_added = 0
+        for d in dnames:
+            n_added += self.update_day(d)
+        return (n_added)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(
+        description="Update the tile pyramid of the ionograms in output_dir/tiles")
+    p.add_argument("config", nargs="?", default=None)
+    p.add_argument("--tile-size", type=int, default=256)
+    p.add_argument("--slot", type=float, default=60.0,
+                   help="seconds of one thumbnail in the hour and day images")
+    args = p.parse_args()
+
+    conf = cc.chirp_config(args.config)
+    tp = tile_pyramid(conf, tile_size=args.tile_size, slot=args.slot)
+    print("added %d ionograms" % (tp.update()))
+    while conf.realtime:
+        time.sleep(10)
+        # only the latest days get new ionograms
+        n_added = tp.update(n_days=2)
+        if n_added > 0:
+            print("added %d ionograms" % (n_added))
+        sys.stdout.flush()
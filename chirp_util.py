@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+#
+# Helpers shared by the programs, with no heavy imports, so that
+# utilities start without loading mpi, matplotlib or the detector.
+#
+import datetime
+
+
+def unix2date(x):
+    # ATC bug-fix for python3
+    return datetime.datetime.utcfromtimestamp(float(x))
+
+
+def unix2datestr(x):
+    return (unix2date(x).strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def unix2dirname(x):
+    return (unix2date(x).strftime('%Y-%m-%d'))
+
+
+def unix2drfdirname(x):
+    return (unix2date(x).strftime('%Y-%m-%dT%H-00-00'))
+
+
+def get_metadata(data, channel):
+    # pull SR and centerfreq from file to avoid errors
+    meta = data.get_digital_metadata(channel).read()
+    meta = meta[next(iter(meta.keys()))]
+    sample_rate = meta['receiver']['samp_rate']
+    center_freq = meta['receiver']['center_freq']
+    return sample_rate, center_freq
@@ -1,76 +1,276 @@
-import numpy as n
-import glob
-import matplotlib.pyplot as plt
-import h5py
-import imageio
-import chirp_config as cc
+#!/usr/bin/env python
+#
+# Export cropped, noise normalized ionograms as a dataset for machine
+# learning (scaling of ionograms).
+#
+# Each ionogram is resampled onto a fixed grid of range gates (n_ranges
+# gates from range_offset km up) and frequencies (those of the first
+# ionogram file, when the dataset is created), clipped to 0...30 dB and
+# scaled to uint8, with the farthest range gate in the first row. The
+# images are written into shards, memory mappable .npy files of
+# shard_size images:
+#
+#   dl_dataset/shard-00000.npy   uint8 (shard_size, n_ranges, n_freqs)
+#   dl_dataset/manifest.jsonl    one line per image: shard, index, t0, id,
+#                                rate, band (first and last frequency of
+#                                the ionogram, MHz) and source file
+#   dl_dataset/lut.h5            range (img_rgs, km) and frequency
+#                                (img_freqs, MHz) of the rows and columns
+#
+# The ionograms are read and resampled by a pool of processes. Running
+# the program again only adds the ionograms that are not in the manifest,
+# continuing the last shard. Ionograms with a frequency band different
+# from that of the dataset (lut.h5) are skipped.
+#
+#   python crop_ionograms.py config.ini --processes 8
+#
+import argparse
+import json
+import multiprocessing as mp
+import os
 import sys
+import traceback
+
+import h5py
+import numpy as n
 import scipy.constants as c
-import os
+
+import chirp_config as cc
+import chirp_index as ci
+import chirp_norm as cn
+import chirp_render as crd
+import chirp_storage as cst
+
+max_dB = 30.0
+min_dB = 0.0
+
+# configuration of the worker processes
+worker_conf = None
+worker_grid = None
+
+
+def init_worker(conf, grid):
+    global worker_conf, worker_grid
+    worker_conf = conf
+    worker_grid = grid
+
+
+def ionogram_freqs(f):
+    """
+    Frequencies (Hz) of ionogram file f, None if it isn't complete.
+    """
+    with h5py.File(f, "r") as h:
+        if "complete" in h.keys() and not bool(n.copy(h["complete"])):
+            return (None)
+        return (n.copy(h["freqs"]))
+
+
+def dataset_grid(conf, freqs, range_offset=300.0, n_ranges=200):
+    """
+    Range gates (km, top row first) and frequencies (MHz) of the images,
+    with the frequencies freqs (Hz) of an ionogram.
+    """
+    img_freqs = freqs / 1e6
+    # range gates of the ionogram are 2*range_resolution apart (see plot_ionograms)
+    dr = 2.0 * conf.range_resolution / 1e3
+    img_rgs = (range_offset + n.arange(n_ranges) * dr)[::-1]
+    return ({"img_rgs": img_rgs, "img_freqs": img_freqs})
+
+
+def crop_ionogram(f):
+    """
+    Resample ionogram file f onto the dataset grid.
+    Returns (metadata, uint8 image), or None.
+    """
+    conf = worker_conf
+    img_rgs = worker_grid["img_rgs"]
+    img_freqs = worker_grid["img_freqs"]
+    try:
+        with h5py.File(f, "r") as h:
+            if "complete" in h.keys() and not bool(n.copy(h["complete"])):
+                return (None)
+            if "S_norm" in h.keys():
+                S = cst.read(h, "S_norm")
+            else:
+                S = cn.normalize(cst.read(h, "S"), axis=1,
+                                 method=conf.noise_floor_method, floor=None)
+            ranges = n.copy(h["ranges"])
+            freqs = n.copy(h["freqs"])
+            meta = {"t0": float(n.copy(h["t0"])),
+                    "id": int(n.copy(h["id"])),
+                    "rate": float(n.copy(h["rate"])),
+                    "band": [float(freqs[0] / 1e6), float(freqs[-1] / 1e6)],
+                    "source": os.path.basename(f)}
+        n_rows = min(S.shape[0], len(freqs))
+        d_f = img_freqs[1] - img_freqs[0] if len(img_freqs) > 1 else 1.0
+        # the ionogram has to cover the band of the dataset
+        if (abs(meta["band"][0] - img_freqs[0]) > d_f / 2.0 or
+                abs(meta["band"][1] - img_freqs[-1]) > d_f / 2.0):
+            print("%s has band %1.3f-%1.3f MHz, dataset %1.3f-%1.3f MHz. Skipping" %
+                  (f, meta["band"][0], meta["band"][1], img_freqs[0], img_freqs[-1]))
+            return (None)
+        dB = n.transpose(cn.to_dB(S[0:n_rows, :]))
+        dB = n.clip(dB, min_dB, max_dB)
+
+        # the propagation time is anything added to a full second
+        t0 = meta["t0"]
+        range_gates = (t0 - n.floor(t0)) * c.c / 1e3 + 2 * ranges / 1e3
+        d_r = img_rgs[0] - img_rgs[1] if len(img_rgs) > 1 else 1.0
+        img = crd.regrid(dB, freqs[0:n_rows] / 1e6, range_gates,
+                         [img_freqs[0] - d_f / 2.0, img_freqs[-1] + d_f / 2.0],
+                         [img_rgs[-1] - d_r / 2.0, img_rgs[0] + d_r / 2.0],
+                         len(img_freqs), len(img_rgs))
+        img[n.isnan(img)] = min_dB
+        return ((meta, n.array(255.0 * img / max_dB, dtype=n.uint8)))
+    except:
+        traceback.print_exc(file=sys.stdout)
+        print("error cropping %s" % (f))
+        return (None)
+
+
+class shard_writer:
+    def __init__(self, dname, shape, shard_size=1024):
+        """
+        Images of shape (n_ranges, n_freqs) in shards of shard_size images,
+        continuing the dataset in dname.
+        """
+        self.dname = dname
+        self.shape = tuple(shape)
+        self.shard_size = shard_size
+        self.manifest_fname = "%s/manifest.jsonl" % (dname)
+        self.sources = set()
+        self.shard = 0
+        self.idx = 0
+        if os.path.exists(self.manifest_fname):
+            with open(self.manifest_fname, "r") as fm:
+                for line in fm:
+                    m = json.loads(line)
+                    self.sources.add(m["source"])
+                    if (m["shard"], m["index"]) >= (self.shard, self.idx):
+                        self.shard = m["shard"]
+                        self.idx = m["index"] + 1
+        self.mm = None
+        self.manifest = open(self.manifest_fname, "a")
+
+    def shard_fname(self, k):
+        return ("%s/shard-%05d.npy" % (self.dname, k))
+
+    def open_shard(self):
+        fname = self.shard_fname(self.shard)
+        if os.path.exists(fname):
+            self.mm = n.lib.format.open_memmap(fname, mode="r+")
+            if self.mm.shape != (self.shard_size,) + self.shape:
+                raise ValueError("%s has shape %s, expected %s" %
+                                 (fname, str(self.mm.shape), str((self.shard_size,) + self.shape)))
+        else:
+            self.mm = n.lib.format.open_memmap(fname, mode="w+", dtype=n.uint8,
+                                               shape=(self.shard_size,) + self.shape)
+
+    def append(self, meta, img):
+        if self.idx >= self.shard_size:
+            self.close_shard()
+            self.shard += 1
+            self.idx = 0
+        if self.mm is None:
+            self.open_shard()
+        self.mm[self.idx, :, :] = img
+        meta = dict(meta)
+        meta["shard"] = self.shard
+        meta["index"] = self.idx
+        # the image is in the shard before it is in the manifest
+        self.mm.flush()
+        self.manifest.write("%s\n" % (json.dumps(meta)))
+        self.manifest.flush()
+        self.sources.add(meta["source"])
+        self.idx += 1
+
+    def close_shard(self):
+        if self.mm is not None:
+            self.mm.flush()
+            del self.mm
+            self.mm = None
+
+    def close(self):
+        self.close_shard()
+        self.manifest.close()
 
 
 def create_cropped_ionograms(conf,
-                             range_offset=300.0):
+                             range_offset=300.0,
+                             n_ranges=200,
+                             output_dir="dl_dataset",
+                             shard_size=1024,
+                             n_processes=1):
     """
-    the purpose of this hacked together script is to convert ionograms into format
-    suitable for scaling
+    Add the ionograms in output_dir of conf, that aren't in the dataset yet,
+    to the dataset in output_dir.
     """
     print(conf.output_dir)
-    fl = glob.glob("%s/*/lfm*.h5" % (conf.output_dir))
-    fl.sort()
-
-    max_dB = 30.0
-    min_dB = 0.0
-    for f in fl:
-        print(f)
-        h = h5py.File(f, "r")
-        ranges = n.copy(h["ranges"])
-        freqs = n.copy(h["freqs"])
-
-        t0 = h["t0"].value
-        img_fname = "dl_dataset/iono-%d.png" % (t0)
-        if os.path.exists(img_fname):
-            print("already exists %s. skipping" % (img_fname))
-            h.close()
-            continue
-
-        dt = (t0 - n.floor(t0))
-        dr = dt * c.c / 1e3
-        range_gates = dr + 2 * ranges / 1e3
-        print(dr)
-        ri0 = n.argmin(n.abs(range_gates - range_offset))
-        S = n.transpose(n.copy(h["S"].value))
-        for fi in range(S.shape[1]):
-            noise_floor = n.nanmedian(S[:, fi])
-            S[:, fi] = (S[:, fi] - noise_floor) / noise_floor
-
-        #        plt.pcolormesh(freqs,range_gates[ri0:(ri0+200)],10.0*n.log10(S[ri0:(ri0+200)]),vmin=0,vmax=30,cmap="plasma")
-        #       plt.show()
-        #      if False:
-        #         print(h["S"].value.shape)
-        #        print(h.keys())
-        dB = 10.0 * n.log10(S)
-        dB[dB > max_dB] = max_dB
-        dB[dB < min_dB] = min_dB
-        dB[n.isnan(dB)] = min_dB
-
-        img = dB[(ri0):(ri0 + 200), :]
-
-        img_rgs = ranges[(ri0):(ri0 + 200)][::-1] / 1e3 + range_offset
-        ho = h5py.File("dl_dataset/lut.h5", "w")
-        ho["img_rgs"] = img_rgs
-        ho["img_freqs"] = freqs / 1e6
-        ho.close()
-        img = img[::-1, :]
-        img = n.array(255.0 * img / max_dB, dtype=n.uint8)
-        imageio.imwrite(img_fname, img)
-        h.close()
+    os.makedirs(output_dir, exist_ok=True)
+    all_files = ci.find_files(conf, "ionogram")
+    lut_fname = "%s/lut.h5" % (output_dir)
+    if os.path.exists(lut_fname):
+        # the band of the dataset is stored in the lut
+        with h5py.File(lut_fname, "r") as h:
+            img_freqs = n.copy(h["img_freqs"])
+            grid = dataset_grid(conf, img_freqs * 1e6, range_offset, n_ranges)
+            if (len(h["img_rgs"]) != len(grid["img_rgs"]) or
+                    not n.allclose(n.copy(h["img_rgs"]), grid["img_rgs"])):
+                raise ValueError("%s has different range gates, use another output directory" % (lut_fname))
+    else:
+        # the band of the first complete ionogram
+        freqs = None
+        for f in all_files:
+            freqs = ionogram_freqs(f)
+            if freqs is not None:
+                break
+        if freqs is None:
+            print("no complete ionograms in %s" % (conf.output_dir))
+            return (0)
+        grid = dataset_grid(conf, freqs, range_offset, n_ranges)
+        with h5py.File(lut_fname, "w") as ho:
+            ho["img_rgs"] = grid["img_rgs"]
+            ho["img_freqs"] = grid["img_freqs"]
+    print("band %1.3f-%1.3f MHz" % (grid["img_freqs"][0], grid["img_freqs"][-1]))
+
+    sw = shard_writer(output_dir, (len(grid["img_rgs"]), len(grid["img_freqs"])), shard_size)
+    fl = [f for f in all_files if os.path.basename(f) not in sw.sources]
+    print("%d ionograms to add" % (len(fl)))
+    n_added = 0
+    pool = mp.Pool(n_processes, initializer=init_worker, initargs=(conf, grid))
+    try:
+        # in time order, a few files ahead of the writer
+        for r in pool.imap(crop_ionogram, fl, chunksize=4):
+            if r is None:
+                continue
+            sw.append(r[0], r[1])
+            n_added += 1
+    finally:
+        pool.close()
+        pool.join()
+        sw.close()
+    print("added %d ionograms" % (n_added))
+    return (n_added)
 
 
 if __name__ == "__main__":
-    print(sys.argv[1])
-    if len(sys.argv) == 2:
-        conf = cc.chirp_config(sys.argv[1])
-    else:
-        conf = cc.chirp_config()
-    create_cropped_ionograms(conf)
+    p = argparse.ArgumentParser(
+        description="Export cropped ionograms as sharded arrays for machine learning")
+    p.add_argument("config", nargs="?", default=None)
+    p.add_argument("--output-dir", default="dl_dataset")
+    p.add_argument("--processes", type=int, default=mp.cpu_count())
+    p.add_argument("--shard-size", type=int, default=1024,
+                   help="images per shard")
+    p.add_argument("--range-offset", type=float, default=300.0,
+                   help="lowest range gate (km)")
+    p.add_argument("--n-ranges", type=int, default=200,
+                   help="number of range gates")
+    args = p.parse_args()
+
+    conf = cc.chirp_config(args.config)
+    create_cropped_ionograms(conf,
+                             range_offset=args.range_offset,
+                             n_ranges=args.n_ranges,
+                             output_dir=args.output_dir,
+                             shard_size=args.shard_size,
+                             n_processes=args.processes)
@@ -5,6 +5,7 @@
 import numpy as n
 import chirp_det as cd
 import chirp_config as cc
+from chirp_util import get_metadata
 import digital_rf as drf
 from mpi4py import MPI
 import time
@@ -16,23 +17,35 @@ size = comm.Get_size()
 rank = comm.Get_rank()
 
 
-def scan_for_chirps(conf, cfb, block0=None):
+def scan_for_chirps(conf, cfb, block0=None, agg=None):
+    """
+    Scan through the recording in rounds of one block per rank.
+    If agg (a detection_aggregator) is given, the detections of all ranks
+    are gathered to rank 0 after each round, merged and written by rank 0.
+    Otherwise each rank writes its own detections.
+    """
     data = drf.DigitalRFReader(conf.data_dir)
 
     sample_rate, center_freq = get_metadata(data, conf.channel)
-    bounds = data.get_bounds(conf.channel)
 
-    if block0 == None:
-        block0 = int(
-            n.ceil(bounds[0] / (conf.n_samples_per_block * conf.step)))
+    if rank == 0:
+        bounds = data.get_bounds(conf.channel)
+        if block0 == None:
+            block0 = int(
+                n.ceil(bounds[0] / (conf.n_samples_per_block * conf.step)))
 
-    block1 = int(n.floor(bounds[1] / (conf.n_samples_per_block * conf.step)))
+        block1 = int(n.floor(bounds[1] / (conf.n_samples_per_block * conf.step)))
+    else:
+        block1 = None
+    # all ranks need to go through the same rounds
+    block0, block1 = comm.bcast((block0, block1), root=0)
 
     # mpi scan through dataset
-    for block_idx in range(block0, block1):
-        #print('block_idx: %i' % block_idx)
-        if block_idx % size == rank:
-            # this is my block!
+    for round0 in range(block0, block1, size):
+        # this is my block!
+        block_idx = round0 + rank
+        detections = []
+        if block_idx < block1:
             try:
                 cput0 = time.time()
                 # we may skip over data (step > 1) to speed up detection
@@ -41,7 +54,10 @@ def scan_for_chirps(conf, cfb, block0=None):
                 # read vector from recording
                 z = data.read_vector_c81d(
                     i0, conf.n_samples_per_block, conf.channel)
-                snrs, chirp_rates, f0s = cfb.seek(z, i0)
+                if agg is None:
+                    cfb.seek(z, i0)
+                else:
+                    detections = cfb.detect(z, i0)
                 cput1 = time.time()
                 analysis_time = (conf.n_samples_per_block *
                                  conf.step) / sample_rate
@@ -52,16 +68,18 @@ def scan_for_chirps(conf, cfb, block0=None):
             except:
                 print("error")
                 traceback.print_exc()
-    return (block1)
 
-
-def get_metadata(data, channel):
-    # pull SR and centerfreq from file to avoid errors
-    meta = data.get_digital_metadata(channel).read()
-    meta = meta[next(iter(meta.keys()))]
-    sample_rate = meta['receiver']['samp_rate']
-    center_freq = meta['receiver']['center_freq']
-    return sample_rate, center_freq
+        if agg is not None:
+            detections = comm.gather(detections, root=0)
+            if rank == 0:
+                for rank_detections in detections:
+                    for det in rank_detections:
+                        agg.add(det)
+                # data time at the end of this round
+                t_now = (round0 + size) * conf.n_samples_per_block * \
+                    conf.step / conf.sample_rate
+                agg.flush(t_now)
+    return (block1)
 
 
 if __name__ == "__main__":
@@ -69,13 +87,21 @@ if __name__ == "__main__":
         conf = cc.chirp_config(sys.argv[1])
     else:
         conf = cc.chirp_config()
+    conf.make_output_dir()
 
     cfb = cd.chirp_matched_filter_bank(conf)
 
+    agg = None
+    if conf.merge_detections:
+        agg = cd.detection_aggregator(conf)
+
     if not conf.realtime:
-        scan_for_chirps(conf, cfb)
+        scan_for_chirps(conf, cfb, agg=agg)
+        if agg is not None and rank == 0:
+            agg.flush()
+        cfb.close()
     else:
         block1 = None
         while True:
-            block1 = scan_for_chirps(conf, cfb, block1)
+            block1 = scan_for_chirps(conf, cfb, block1, agg=agg)
             time.sleep(0.001)
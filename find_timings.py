@@ -3,26 +3,37 @@
 # given predetections, find chirp timings
 #
 import numpy as n
-import matplotlib.pyplot as plt
 import glob
 import h5py
 import chirp_config as cc
 import sys
-import chirp_det as cd
+import chirp_index as ci
+import chirp_util as cu
 import os
 import time
-from detect_chirps import get_metadata
-import digital_rf as drf
 
 
-def cluster_times(t, dt=0.1, dt2=0.02, min_det=2):
+def cluster_times(t, dt=0.1, dt2=0.02, min_det=2, t_std=None, min_det_refined=None, dt_refined=0.005, n_hits=None):
+    """
+    Cluster chirp times into soundings. A sounding needs min_det detections.
+    If the timing uncertainties t_std of the detections are known, a sounding is
+    also accepted with min_det_refined detections that agree within dt_refined.
+    n_hits is the number of merged detections in each detection record.
+    """
+    if n_hits is None:
+        n_hits = n.ones(len(t), dtype=n.int64)
+    refined = t_std is not None and min_det_refined is not None
+    min_cand = min_det
+    if refined:
+        min_cand = min(min_det, min_det_refined)
+
     t0s = dt * n.array(n.unique(n.array(n.round(t / dt),
                                         dtype=n.int64)), dtype=n.float64)
     ct0s = []
 
     for t0 in t0s:
         tidx = n.where(n.abs(t - t0) < dt)[0]
-        if len(tidx) >= min_det:
+        if n.sum(n_hits[tidx]) >= min_cand:
             ct0s.append(n.mean(t[tidx]))
 
     t0s = n.unique(ct0s)
@@ -30,15 +41,30 @@ def cluster_times(t, dt=0.1, dt2=0.02, min_det=2):
     num_dets = []
     for t0 in t0s:
         tidx = n.where(n.abs(t - t0) < dt2)[0]
-        if len(tidx) >= min_det:
+        if n.sum(n_hits[tidx]) >= min_det:
             meant = n.mean(t[tidx])
-            good = True
-            for ct in ct0s:
-                if n.abs(meant - ct) < dt:  # dupe
-                    good = False
-            if good:
-                ct0s.append(meant)
-                num_dets.append(len(tidx))
+        elif refined:
+            # precise detections consistent with each other
+            ridx = tidx[n.where(n.isfinite(t_std[tidx]) &
+                                (t_std[tidx] < dt_refined / 3.0))[0]]
+            if n.sum(n_hits[ridx]) < min_det_refined:
+                continue
+            # all within dt_refined of each other
+            ridx = ridx[n.where(n.abs(t[ridx] - n.median(t[ridx])) < dt_refined / 2.0)[0]]
+            if n.sum(n_hits[ridx]) < min_det_refined:
+                continue
+            w = 1.0 / t_std[ridx]**2.0
+            meant = n.sum(w * t[ridx]) / n.sum(w)
+            tidx = ridx
+        else:
+            continue
+        good = True
+        for ct in ct0s:
+            if n.abs(meant - ct) < dt:  # dupe
+                good = False
+        if good:
+            ct0s.append(meant)
+            num_dets.append(n.sum(n_hits[tidx]))
 
     return (ct0s, num_dets)
 
@@ -47,16 +73,19 @@ def scan_for_chirps(conf, dt=0.1):
     """
     go through data files and look for unique soundings
     """
+    import digital_rf as drf
+    if conf.plot_timings:
+        import matplotlib.pyplot as plt
     data_dir = conf.output_dir
     rf_data = drf.DigitalRFReader(conf.data_dir)
-    sample_rate, center_freq = get_metadata(rf_data, conf.channel)
-    max_analysis_freq = center_freq + sample_rate / 2
+    sample_rate, center_freq = cu.get_metadata(rf_data, conf.channel)
+    min_analysis_freq, max_analysis_freq = conf.analysis_band(sample_rate, center_freq)
 
     # detection files have names chirp*.h5
 
     if conf.realtime:
         this_day_dname = "%s/%s" % (conf.output_dir,
-                                    cd.unix2dirname(conf.output_dir_time))
+                                    cu.unix2dirname(conf.output_dir_time))
         # today
         fl = glob.glob("%s/chirp*.h5" % (this_day_dname))
         fl.sort()
@@ -70,12 +99,13 @@ def scan_for_chirps(conf, dt=0.1):
             return
     else:
         # look for all in batch mode
-        fl = glob.glob("%s/2*/chirp*.h5" % (data_dir))
-        fl.sort()
+        fl = ci.find_files(conf, "detection")
 
     chirp_rates = []
     f0 = []
     chirp_times = []
+    chirp_time_stds = []
+    n_hits = []
     snrs = []
     for f in fl:
         try:
@@ -87,6 +117,14 @@ def scan_for_chirps(conf, dt=0.1):
                 snrs.append(n.copy(h[("snr")]))
             else:
                 snrs.append(-1.0)
+            if "chirp_time_std" in h.keys():
+                chirp_time_stds.append(n.copy(h[("chirp_time_std")]))
+            else:
+                chirp_time_stds.append(n.nan)
+            if "n_hits" in h.keys():
+                n_hits.append(n.copy(h[("n_hits")]))
+            else:
+                n_hits.append(1)
             h.close()
         except:
             print("Couldn't open %s" % (f))
@@ -95,13 +133,19 @@ def scan_for_chirps(conf, dt=0.1):
     chirp_rates = n.array(chirp_rates)
     f0 = n.array(f0)
     snrs = n.array(snrs)
+    chirp_time_stds = n.array(chirp_time_stds)
+    n_hits = n.array(n_hits, dtype=n.int64)
 
     n_ionograms = 0
     crs = n.unique(chirp_rates)
     for c in crs:
         idx = n.where(chirp_rates == c)[0]
-        t0s, num_dets = cluster_times(
-            chirp_times[idx], dt, min_det=conf.min_detections)
+        t0s, num_dets = cluster_times(chirp_times[idx], dt,
+                                      min_det=conf.min_detections,
+                                      t_std=chirp_time_stds[idx],
+                                      min_det_refined=conf.min_refined_detections,
+                                      dt_refined=conf.refined_timing_window,
+                                      n_hits=n_hits[idx])
 
         for ti, t0 in enumerate(t0s):
 
@@ -113,7 +157,7 @@ def scan_for_chirps(conf, dt=0.1):
             if conf.plot_timings:
                 plt.axhline(t0, color="red")
 
-            dname = "%s/%s" % (data_dir, cd.unix2dirname(n.floor(t0)))
+            dname = "%s/%s" % (data_dir, cu.unix2dirname(n.floor(t0)))
             if not os.path.exists(dname):
                 os.mkdir(dname)
 
@@ -132,8 +176,12 @@ def scan_for_chirps(conf, dt=0.1):
                                     (n.abs(chirp_rates - c) < 0.1))[0]
                 ho["f0"] = f0[sweep_idx]
                 ho["t0s"] = chirp_times[sweep_idx]
+                ho["t0_stds"] = chirp_time_stds[sweep_idx]
                 ho["snrs"] = snrs[sweep_idx]
+                ho["n_hits"] = n_hits[sweep_idx]
                 ho.close()
+                ci.register(conf, "parameter", fname, t0=t0, chirp_rate=c,
+                            snr=n.max(snrs[sweep_idx]) if len(sweep_idx) > 0 else None)
 
         if conf.plot_timings:
             plt.plot(f0[idx] / 1e6, chirp_times[idx], ".")
@@ -141,7 +189,7 @@ def scan_for_chirps(conf, dt=0.1):
         if conf.plot_timings:
             plt.xlabel("Frequency (MHz)")
             plt.ylabel("Time (unix)")
-            plt.xlim([0, conf.maximum_analysis_frequency / 1e6])
+            plt.xlim([0, max_analysis_freq / 1e6])
             plt.title("Chirp-rate %1.2f kHz/s" % (c / 1e3))
             plt.show()
 
@@ -155,6 +203,7 @@ if __name__ == "__main__":
     else:
         print('No config provided - Using defaults')
         conf = cc.chirp_config()
+    conf.make_output_dir()
 
     if conf.realtime:
         print("Scanning for timings indefinitely")
@@ -1,52 +1,87 @@
 #!/usr/bin/env python
-from detect_chirps import get_metadata
-import digital_rf as drf
 import time
 import os
 import sys
-import chirp_det as cd
+import multiprocessing as mp
+import fnmatch
+import traceback
 import chirp_config as cc
+import chirp_index as ci
+import chirp_norm as cn
+import chirp_render as crd
+import chirp_storage as cst
+import chirp_util as cu
 import scipy.constants as c
 import h5py
 import glob
-import matplotlib.pyplot as plt
 import numpy as n
 import matplotlib
 matplotlib.use('Agg')
 
 
-def plot_ionogram(conf, f, normalize_by_frequency=True):
+def get_analysis_band(conf):
+    import digital_rf as drf
     data = drf.DigitalRFReader(conf.data_dir)
-    sample_rate, center_freq = get_metadata(data, conf.channel)
-    max_analysis_freq = center_freq + sample_rate / 2
-    min_analysis_freq = center_freq - sample_rate / 2
+    sample_rate, center_freq = cu.get_metadata(data, conf.channel)
+    return (conf.analysis_band(sample_rate, center_freq))
 
-    ho = h5py.File(f, "r")
-    t0 = float(n.copy(ho[("t0")]))
-    if not "id" in ho.keys():
-        return
-    cid = int(n.copy(ho[("id")]))  # ionosonde id
 
-    img_fname = "%s/%s/lfm_ionogram-%03d-%1.2f.png" % (
-        conf.output_dir, cd.unix2dirname(t0), cid, t0)
+def image_fnames(f, fmt="png"):
+    """
+    The plot, the partial plot and the thumbnail of ionogram file f.
+    """
+    base = f[0:-3] if f.endswith(".h5") else f
+    return ("%s.%s" % (base, fmt), "%s-partial.%s" % (base, fmt), "%s-thumb.%s" % (base, fmt))
 
+
+def plot_ionogram(conf, f, normalize_by_frequency=True, band=None):
+    """
+    Plot ionogram file f. band is the analysis band (from the recording
+    if None). Returns True if the final plot exists, and False if the
+    ionogram is still being written.
+    """
+    img_fname, partial_fname, thumb_fname = image_fnames(f, conf.plot_format)
     if os.path.exists(img_fname):
         #print("Ionogram plot %s already exists. Skipping"%(img_fname))
+        return (True)
+
+    if band is None:
+        band = get_analysis_band(conf)
+    min_analysis_freq, max_analysis_freq = band
+
+    # the ionogram may still be written (streaming_ionograms)
+    ho = h5py.File(f, "r", swmr=True)
+    t0 = float(n.copy(ho[("t0")]))
+    if not "id" in ho.keys():
         ho.close()
-        return
+        return (True)
+
+    complete = True
+    if "complete" in ho.keys():
+        complete = bool(n.copy(ho[("complete")]))
+    if not complete:
+        # plot the rows written so far, replotted until the ionogram is complete
+        img_fname = partial_fname
+        if ho["S"].shape[0] == 0:
+            ho.close()
+            return (False)
 
     print("Plotting %s rate %1.2f (kHz/s) t0 %1.5f (unix)" %
           (f, float(n.copy(ho[("rate")])) / 1e3, float(n.copy(ho[("t0")]))))
-    S = n.copy(ho[("S")])          # ionogram frequency-range
+    if normalize_by_frequency and "S_norm" in ho.keys():
+        # normalized when the ionogram was calculated
+        S = cst.read(ho, "S_norm")
+    else:
+        S = cst.read(ho, "S")      # ionogram frequency-range
+        if normalize_by_frequency:
+            S = cn.normalize(S, axis=1, method=conf.noise_floor_method)
     freqs = n.copy(ho[("freqs")])  # frequency bins
+    # rows and their frequencies are written separately
+    n_rows = min(S.shape[0], len(freqs))
+    S = S[0:n_rows, :]
+    freqs = freqs[0:n_rows]
     ranges = n.copy(ho[("ranges")])  # range gates
 
-    if normalize_by_frequency:
-        for i in range(S.shape[0]):
-            noise = n.nanmedian(S[i, :])
-            S[i, :] = (S[i, :] - noise) / noise
-        S[S <= 0.0] = 1e-3
-
     max_range_idx = n.argmax(n.max(S, axis=0))
 
     dB = n.transpose(10.0 * n.log10(S))
@@ -63,28 +98,205 @@ def plot_ionogram(conf, f, normalize_by_frequency=True):
     dr = dt * c.c / 1e3
     range_gates = dr + 2 * ranges / 1e3
     r0 = range_gates[max_range_idx]
-    fig = plt.figure(figsize=(1.5 * 8, 1.5 * 6))
-    plt.pcolormesh(freqs / 1e6, range_gates, dB,
-                   vmin=-3, vmax=30.0, cmap="inferno")
-    cb = plt.colorbar()
-    cb.set_label("SNR (dB)")
-    plt.title("Chirp-rate %1.2f kHz/s t0=%1.5f (unix s)\n%s (UTC)" %
-              (float(n.copy(ho[("rate")])) / 1e3, float(n.copy(ho[("t0")])), cd.unix2datestr(float(n.copy(ho[("t0")])))))
-    plt.xlabel("Frequency (MHz)")
-    plt.ylabel("One-way range offset (km)")
-    plt.ylim([dr - conf.max_range_extent / 1e3,
-             dr + conf.max_range_extent / 1e3])
-#    plt.ylim([dr-1000.0,dr+1000.0])
-    plt.xlim([min_analysis_freq / 1e6, max_analysis_freq / 1e6])
-    plt.tight_layout()
-    plt.savefig(img_fname)
-    fig.clf()
-    plt.clf()
-    plt.close("all")
-    import gc
-    gc.collect()
+    title = ("Chirp-rate %1.2f kHz/s t0=%1.5f (unix s)\n%s (UTC)" %
+             (float(n.copy(ho[("rate")])) / 1e3, float(n.copy(ho[("t0")])), cu.unix2datestr(float(n.copy(ho[("t0")])))))
+    ylim = [dr - conf.max_range_extent / 1e3,
+            dr + conf.max_range_extent / 1e3]
+#    ylim = [dr-1000.0,dr+1000.0]
+    xlim = [min_analysis_freq / 1e6, max_analysis_freq / 1e6]
+    if conf.plot_mode == "fast":
+        # color lookup table and a reused figure (see chirp_render)
+        ft = crd.get_template(conf.plot_size[0], conf.plot_size[1],
+                              vmin=-3.0, vmax=30.0, cmap="inferno",
+                              clabel="SNR (dB)",
+                              xlabel="Frequency (MHz)",
+                              ylabel="One-way range offset (km)")
+        ft.render(dB, freqs / 1e6, range_gates, xlim, ylim, title, img_fname)
+    else:
+        import matplotlib.pyplot as plt
+        fig = plt.figure(figsize=(conf.plot_size[0] / 100.0, conf.plot_size[1] / 100.0))
+        plt.pcolormesh(freqs / 1e6, range_gates, dB,
+                       vmin=-3, vmax=30.0, cmap="inferno")
+        cb = plt.colorbar()
+        cb.set_label("SNR (dB)")
+        plt.title(title)
+        plt.xlabel("Frequency (MHz)")
+        plt.ylabel("One-way range offset (km)")
+        plt.ylim(ylim)
+        plt.xlim(xlim)
+        plt.tight_layout()
+        plt.savefig(img_fname)
+        plt.close(fig)
+    if complete and conf.thumbnail_size is not None:
+        crd.thumbnail(dB, freqs / 1e6, range_gates, xlim, ylim, conf.thumbnail_size,
+                      thumb_fname, vmin=-3.0, vmax=30.0, cmap="inferno")
+    if complete and os.path.exists(partial_fname):
+        os.remove(partial_fname)
     ho.close()
     sys.stdout.flush()
+    return (complete)
+
+
+# configuration of the plotting processes
+worker_conf = None
+worker_band = None
+
+
+def init_worker(conf, band):
+    global worker_conf, worker_band
+    worker_conf = conf
+    worker_band = band
+
+
+def plot_worker(f):
+    """
+    Plot f in a plotting process. Returns (f, done, error).
+    """
+    try:
+        return ((f, plot_ionogram(worker_conf, f, band=worker_band), False))
+    except:
+        traceback.print_exc(file=sys.stdout)
+        print("error plotting %s" % (f))
+        sys.stdout.flush()
+        return ((f, False, True))
+
+
+def file_t0(f):
+    # lfm_ionogram-<id>-<t0>.h5
+    try:
+        return (float(os.path.basename(f)[0:-3].split("-")[-1]))
+    except ValueError:
+        return (0.0)
+
+
+class plot_service:
+    def __init__(self, conf, n_processes=1, realtime=True, poll_interval=10.0, max_errors=3,
+                 max_idle=600.0):
+        """
+        Plot new ionograms with a pool of plotting processes, which keep
+        matplotlib loaded. Files with a final plot are remembered, so
+        that only the day directories that can still get new ionograms
+        are listed after the first scan. In realtime mode, ionograms that
+        are still being written are replotted every poll_interval seconds,
+        until they are complete, or until their file hasn't changed for
+        max_idle seconds (the writer has stopped) or is removed.
+        """
+        self.conf = conf
+        self.n_processes = n_processes
+        self.realtime = realtime
+        self.poll_interval = poll_interval
+        self.max_errors = max_errors
+        self.max_idle = max_idle
+        # files with a final plot, or that can't be plotted
+        self.done = set()
+        # files without a final plot, and their t0
+        self.todo = {}
+        # earliest time to plot an incomplete ionogram again
+        self.retry_at = {}
+        self.in_flight = {}
+        self.n_errors = {}
+        self.pool = mp.Pool(n_processes, initializer=init_worker,
+                            initargs=(conf, get_analysis_band(conf)),
+                            maxtasksperchild=500)
+
+    def add(self, fl):
+        for f in fl:
+            if f not in self.done:
+                self.todo[f] = file_t0(f)
+
+    def scan(self, dnames):
+        """
+        Find the ionogram files in dnames without a final plot,
+        with one directory listing each instead of one check per file.
+        """
+        for dname in dnames:
+            try:
+                names = set(os.listdir(dname))
+            except OSError:
+                continue
+            for name in fnmatch.filter(names, "lfm*.h5"):
+                f = "%s/%s" % (dname, name)
+                if f in self.done or f in self.todo:
+                    continue
+                if "%s.%s" % (name[0:-3], self.conf.plot_format) in names:
+                    self.done.add(f)
+                else:
+                    self.todo[f] = file_t0(f)
+
+    def scan_recent(self, n_days=2):
+        dnames = glob.glob("%s/*[0-9]" % (self.conf.output_dir))
+        dnames.sort()
+        self.scan(dnames[max(0, len(dnames) - n_days):len(dnames)])
+
+    def reap(self):
+        for f in list(self.in_flight.keys()):
+            r = self.in_flight[f]
+            if not r.ready():
+                continue
+            del self.in_flight[f]
+            f, done, error = r.get()
+            if error:
+                self.n_errors[f] = self.n_errors.get(f, 0) + 1
+                if self.n_errors[f] >= self.max_errors:
+                    print("giving up on %s" % (f))
+                    done = True
+            if not done and self.realtime:
+                try:
+                    idle = time.time() - os.path.getmtime(f)
+                except OSError:
+                    idle = None
+                if idle is None or idle > self.max_idle:
+                    print("giving up on incomplete %s" % (f))
+                    done = True
+            if done or not self.realtime:
+                self.done.add(f)
+                del self.todo[f]
+                self.retry_at.pop(f, None)
+                self.n_errors.pop(f, None)
+            else:
+                self.retry_at[f] = time.time() + self.poll_interval
+
+    def queue(self):
+        """
+        Files that can be plotted now, newest first, so that a backlog
+        doesn't delay the realtime plots.
+        """
+        now = time.time()
+        q = [f for f in self.todo.keys()
+             if f not in self.in_flight and self.retry_at.get(f, 0.0) <= now]
+        q.sort(key=lambda f: self.todo[f], reverse=True)
+        return (q)
+
+    def submit(self):
+        """
+        Queue a few files per process at a time.
+        """
+        n_free = 2 * self.n_processes - len(self.in_flight)
+        for f in self.queue()[0:max(0, n_free)]:
+            self.in_flight[f] = self.pool.apply_async(plot_worker, (f,))
+
+    def run(self, fl=None):
+        """
+        Plot the files in fl, or all unplotted ionograms in output_dir.
+        In realtime mode, keep plotting new ionograms.
+        """
+        if fl is None:
+            self.scan(glob.glob("%s/*[0-9]" % (self.conf.output_dir)))
+        else:
+            self.add(fl)
+        print("%d ionograms to plot" % (len(self.todo)))
+        t_scan = time.time()
+        try:
+            while self.realtime or len(self.todo) > 0:
+                self.reap()
+                if self.realtime and time.time() - t_scan > self.poll_interval:
+                    self.scan_recent()
+                    t_scan = time.time()
+                self.submit()
+                time.sleep(0.1)
+        finally:
+            self.pool.close()
+            self.pool.join()
 
 
 if __name__ == "__main__":
@@ -93,14 +305,9 @@ if __name__ == "__main__":
     else:
         conf = cc.chirp_config()
 
+    ps = plot_service(conf, n_processes=conf.n_plot_processes, realtime=conf.realtime)
     if conf.realtime:
-        while True:
-            fl = glob.glob("%s/*[0-9]/lfm*.h5" % (conf.output_dir))
-            fl.sort()
-            for f in fl:
-                plot_ionogram(conf, f)
-            time.sleep(10)
+        ps.run()
     else:
-        fl = glob.glob("%s/*/lfm*.h5" % (conf.output_dir))
-        for f in fl:
-            plot_ionogram(conf, f)
+        ps.run(fl=[f for f in ci.find_files(conf, "ionogram")
+                   if not os.path.exists(image_fnames(f, conf.plot_format)[0])])
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# Waterfall plot of the long term spectrum, from the spectrum summaries
+# written by detect_chirps.py (spectrum_summary=true, see chirp_spectrum).
+# The raw recording is not read.
+#
+#   python plot_spectrum_summary.py config.ini --start 2021-05-04 --end 2021-05-06
+#
+import argparse
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as n
+
+import chirp_config as cc
+import chirp_index as ci
+import chirp_spectrum as csp
+import chirp_util as cu
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(
+        description="Plot a waterfall of the spectrum summaries of the detector")
+    p.add_argument("config", nargs="?", default=None)
+    p.add_argument("--start", default=None,
+                   help="YYYY-mm-dd[THH:MM:SS] UTC or unix time")
+    p.add_argument("--end", default=None,
+                   help="YYYY-mm-dd[THH:MM:SS] UTC or unix time")
+    p.add_argument("--output", default=None,
+                   help="image file (default output_dir/spectrum_summary.png)")
+    p.add_argument("--vmin", type=float, default=-10.0,
+                   help="dB relative to the median")
+    p.add_argument("--vmax", type=float, default=50.0,
+                   help="dB relative to the median")
+    args = p.parse_args()
+
+    conf = cc.chirp_config(args.config)
+    t0 = None
+    t1 = None
+    if args.start is not None:
+        t0 = ci.parse_date(args.start)
+    if args.end is not None:
+        t1 = ci.parse_date(args.end)
+
+    r = csp.read_summary(conf, t0, t1)
+    if r is None:
+        print("no spectrum summaries in %s" % (conf.output_dir))
+        exit(0)
+    t, freqs, S = r
+
+    with n.errstate(divide="ignore"):
+        dB = 10.0 * n.log10(S)
+    dB = dB - n.nanmedian(dB[n.isfinite(dB)])
+    # hours since the start of the first day
+    t_start = n.floor(t[0] / (24 * 3600.0)) * 24 * 3600.0
+    hours = (t - t_start) / 3600.0
+
+    plt.figure(figsize=(12, 8))
+    plt.pcolormesh(hours, freqs / 1e6, n.transpose(dB), vmin=args.vmin, vmax=args.vmax,
+                   cmap="plasma", shading="nearest")
+    cb = plt.colorbar()
+    cb.set_label("dB")
+    plt.title("%s - %s" % (cu.unix2datestr(t[0]), cu.unix2datestr(t[-1])))
+    plt.xlabel("Hours since %s UTC" % (cu.unix2datestr(t_start)))
+    plt.ylabel("Frequency (MHz)")
+    plt.tight_layout()
+    ofname = args.output
+    if ofname is None:
+        ofname = "%s/spectrum_summary.png" % (conf.output_dir)
+    print("saving %s" % (ofname))
+    plt.savefig(ofname)
+    plt.close()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#
+# Recalculate ionograms from the chirp downconverted voltage (z) that is
+# stored in the ionogram files with save_raw_voltage=true, e.g., after
+# changing range_resolution, frequency_resolution, max_range_extent,
+# min_range or the storage format. The raw recording is not read.
+#
+# The files are processed in parallel with a pool of processes and each
+# file is replaced atomically when its new ionogram is complete:
+#   python reprocess_ionograms.py config.ini
+# or written to another directory, keeping the original files:
+#   python reprocess_ionograms.py config.ini --output-dir ./reprocessed
+#
+import argparse
+import copy
+import multiprocessing as mp
+import os
+import sys
+import time
+import traceback
+
+import h5py
+import numpy as n
+
+import calc_ionograms
+import chirp_config as cc
+import chirp_index as ci
+import chirp_storage as cst
+
+# configuration of the worker processes
+worker_conf = None
+worker_output_dir = None
+
+
+def init_worker(conf, output_dir):
+    global worker_conf, worker_output_dir
+    worker_conf = conf
+    worker_output_dir = output_dir
+
+
+def read_voltage(fname):
+    """
+    The stored chirp downconverted voltage and metadata of an ionogram file,
+    or None if the file doesn't have it.
+    """
+    with h5py.File(fname, "r") as h:
+        if "z" not in h.keys():
+            return (None)
+        if "complete" in h.keys() and not bool(n.copy(h["complete"])):
+            return (None)
+        info = {"z": cst.read(h, "z"),
+                "t0": float(n.copy(h["t0"])),
+                "rate": float(n.copy(h["rate"])),
+                "id": int(n.copy(h["id"])),
+                "sr": float(n.copy(h["sr"])),
+                "ch": h["ch"][()],
+                # the two channel ionograms store the range indices
+                "twochan": "ridx" in h.keys()}
+        freqs = n.copy(h["freqs"])
+    if isinstance(info["ch"], bytes):
+        info["ch"] = info["ch"].decode()
+    # z starts k0 samples after the start of the sweep (see sweep_plan)
+    info["k0"] = 0
+    if len(freqs) > 0:
+        info["k0"] = int(n.round(freqs[0] * info["sr"] / info["rate"]))
+    return (info)
+
+
+def reprocess_file(fname):
+    """
+    Recalculate the ionogram of fname. Returns the new file name, or None.
+    """
+    conf = worker_conf
+    tmp = None
+    try:
+        info = read_voltage(fname)
+        if info is None:
+            print("%s has no stored voltage. Skipping" % (fname))
+            return (None)
+        if worker_output_dir is None:
+            ofname = fname
+        else:
+            dname = "%s/%s" % (worker_output_dir, os.path.basename(os.path.dirname(fname)))
+            os.makedirs(dname, exist_ok=True)
+            ofname = "%s/%s" % (dname, os.path.basename(fname))
+        tmp = "%s.tmp%d" % (ofname, os.getpid())
+
+        output = "complex" if info["twochan"] else "power"
+        # sr is the decimated sample rate, so the decimation is 1 here
+        iw = calc_ionograms.ionogram_writer(conf, info["t0"], info["rate"], info["sr"], 1,
+                                            info["id"], info["ch"], len(info["z"]),
+                                            k0=info["k0"], ofname=tmp, output=output)
+        iw.push(info["z"])
+        iw.close()
+        # the writer reports its errors, only replace with a complete ionogram
+        complete = False
+        if os.path.exists(tmp):
+            with h5py.File(tmp, "r") as h:
+                complete = bool(n.copy(h["complete"]))
+        if not complete:
+            print("error reprocessing %s" % (fname))
+            return (None)
+        os.replace(tmp, ofname)
+        return (ofname)
+    except:
+        traceback.print_exc(file=sys.stdout)
+        print("error reprocessing %s" % (fname))
+        return (None)
+    finally:
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def reprocess(conf, fl, n_processes=1, output_dir=None):
+    """
+    Recalculate the ionograms of the files in fl with n_processes processes.
+    """
+    wconf = copy.copy(conf)
+    # the parent indexes the new files, and the daily archive keeps the old ionograms
+    wconf.use_index = False
+    wconf.daily_archive = False
+    wconf.save_raw_voltage = True
+    if n_processes > 1:
+        wconf.n_downconversion_threads = 1
+
+    if output_dir is not None:
+        # create the index of the new directory while it is empty
+        os.makedirs(output_dir, exist_ok=True)
+        ci.get_index(conf)
+
+    t_start = time.time()
+    n_done = 0
+    pool = mp.Pool(n_processes, initializer=init_worker, initargs=(wconf, output_dir))
+    try:
+        for ofname in pool.imap_unordered(reprocess_file, fl):
+            if ofname is None:
+                continue
+            n_done += 1
+            if output_dir is not None:
+                with h5py.File(ofname, "r") as h:
+                    ci.register(conf, "ionogram", ofname, t0=float(n.copy(h["t0"])),
+                                chirp_rate=float(n.copy(h["rate"])), cid=int(n.copy(h["id"])))
+    finally:
+        pool.close()
+        pool.join()
+    print("reprocessed %d/%d ionograms in %1.1f s" % (n_done, len(fl), time.time() - t_start))
+    return (n_done)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(
+        description="Recalculate ionograms from the stored chirp downconverted voltage")
+    p.add_argument("config", nargs="?", default=None)
+    p.add_argument("--output-dir", default=None,
+                   help="write the new ionograms here instead of replacing the files in output_dir")
+    p.add_argument("--processes", type=int, default=mp.cpu_count(),
+                   help="number of worker processes")
+    p.add_argument("--id", type=int, default=None, help="sounder id")
+    p.add_argument("--start", default=None,
+                   help="YYYY-mm-dd[THH:MM:SS] UTC or unix time")
+    p.add_argument("--end", default=None,
+                   help="YYYY-mm-dd[THH:MM:SS] UTC or unix time")
+    args = p.parse_args()
+
+    conf = cc.chirp_config(args.config)
+    t0 = None
+    t1 = None
+    if args.start is not None:
+        t0 = ci.parse_date(args.start)
+    if args.end is not None:
+        t1 = ci.parse_date(args.end)
+    fl = ci.find_files(conf, "ionogram", t0=t0, t1=t1, cid=args.id)
+
+    if args.output_dir is not None:
+        conf.output_dir = args.output_dir
+        conf.index_file = ""
+    reprocess(conf, fl, n_processes=args.processes, output_dir=args.output_dir)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# Startup time of the programs and modules: the time to import each one
+# in a new python process, and which of the heavy dependencies it loads.
+# Each import is timed in a new process, repeat times, and the best time
+# is shown.
+#
+#   python startup_benchmark.py
+#   python startup_benchmark.py --repeat 10 chirp_det plot_ionograms
+#
+# Importing detect_chirps initializes mpi.
+#
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+modules = ["chirp_util",
+           "chirp_config",
+           "chirp_index",
+           "chirp_storage",
+           "chirp_det",
+           "chirp_daily",
+           "chirp_spectrum",
+           "chirp_render",
+           "chirp_tiles",
+           "find_timings",
+           "plot_ionograms",
+           "plot_spectrum_summary",
+           "crop_ionograms",
+           "calc_ionograms",
+           "reprocess_ionograms"]
+
+heavy = ["matplotlib.pyplot", "scipy.signal", "scipy.fft", "h5py",
+         "digital_rf", "mpi4py", "pyfftw"]
+
+child = """
+import sys, time, json
+t0 = time.time()
+import %s
+t1 = time.time()
+import chirp_config
+c = chirp_config.chirp_config()
+t2 = time.time()
+print(json.dumps({"import": t1 - t0, "config": t2 - t1,
+                  "loaded": [m for m in %s if m in sys.modules]}))
+"""
+
+
+def time_import(module, repeat=3):
+    """
+    Best import time (s), best chirp_config() time (s), best total time
+    of the process (s) and the heavy modules loaded.
+    """
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        out = subprocess.run([sys.executable, "-c", child % (module, repr(heavy))],
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             universal_newlines=True)
+        t_total = time.time() - t0
+        if out.returncode != 0:
+            return (None)
+        r = json.loads(out.stdout.strip().split("\n")[-1])
+        r["total"] = t_total
+        if best is None or r["total"] < best["total"]:
+            best = r
+    return (best)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(
+        description="Time the startup (import) of the programs and modules")
+    p.add_argument("modules", nargs="*", default=modules)
+    p.add_argument("--repeat", type=int, default=3)
+    args = p.parse_args()
+
+    print("%-24s %8s %8s %8s  %s" % ("module", "import", "config", "process", "heavy modules loaded"))
+    for m in args.modules:
+        r = time_import(m, args.repeat)
+        if r is None:
+            print("%-24s can't be imported here" % (m))
+            continue
+        print("%-24s %7.3fs %7.3fs %7.3fs  %s" % (m, r["import"], r["config"], r["total"],
+                                                 ", ".join(r["loaded"])))
+        sys.stdout.flush()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#
+# Chirp-time uncertainty of the detector, and merging of repeated detections
+# of a chirp (chirp_det.detection_aggregator).
+#
+#   python -m pytest test_chirp_det.py
+# or
+#   python test_chirp_det.py
+#
+import glob
+import shutil
+import tempfile
+
+import h5py
+import numpy as n
+
+import chirp_config as cc
+import chirp_det as cd
+
+
+def sweep_detections(conf, t0, chirp_time, rate, duration, gaps=[]):
+    """
+    One detection per block of a sweep that is seen from t0 for duration s,
+    except in the gaps ((start, end) s after t0).
+    """
+    rng = n.random.default_rng(3)
+    block = conf.n_samples_per_block / conf.sample_rate
+    dets = []
+    for t in n.arange(t0, t0 + duration, block):
+        if any(g0 <= t - t0 < g1 for g0, g1 in gaps):
+            continue
+        dets.append({"f0": (t - chirp_time) * rate,
+                     "f0_std": 1e3,
+                     "i0": int(t * conf.sample_rate),
+                     "n_samples": conf.n_samples_per_block,
+                     "chirp_time": chirp_time + rng.normal(0, 1e-4),
+                     "chirp_time_std": 1e-4,
+                     "chirp_rate": rate,
+                     "snr": rng.uniform(15, 30),
+                     "n_hits": 1})
+    return (dets)
+
+
+def run(conf, dets):
+    """
+    Add the detections block by block, as detect_chirps.py does.
+    Returns the number of records written before the end of the data
+    and the records written.
+    """
+    agg = cd.detection_aggregator(conf)
+    block = conf.n_samples_per_block / conf.sample_rate
+    n_early = 0
+    for det in sorted(dets, key=lambda d: d["i0"]):
+        agg.add(det)
+        n_early += agg.flush(det["i0"] / conf.sample_rate + block)
+    agg.flush()
+    records = []
+    for f in sorted(glob.glob("%s/*/chirp*.h5" % (conf.output_dir))):
+        with h5py.File(f, "r") as h:
+            records.append({k: float(n.copy(h[k])) for k in ["chirp_time", "chirp_rate", "n_hits"]})
+    return (n_early, records)
+
+
+def small_conf():
+    """
+    A short block (0.1 s) and a chirp-rate grid of 100 Hz/s, the chirp-rate
+    resolution of the block.
+    """
+    conf = cc.chirp_config()
+    conf.sample_rate = 1e6
+    conf.center_freq = 5e5
+    conf.n_samples_per_block = 100000
+    conf.df = conf.sample_rate / conf.n_samples_per_block
+    conf.mfsi = int(conf.minimum_frequency_spacing / conf.df)
+    conf.chirp_rates = [99.9e3, 100e3, 100.1e3]
+    conf.chirp_rate_step = 100.0
+    return (conf)
+
+
+def chirp_block(conf, rate, offset, rng, noise=3.0):
+    """
+    Block of a chirp that started offset s before the block.
+    """
+    tv = n.arange(conf.n_samples_per_block) / conf.sample_rate
+    tau = offset + tv
+    z = n.exp(1j * (n.pi * rate * tau**2.0 - 2.0 * n.pi * conf.center_freq * tv))
+    z = z + noise * (rng.normal(size=len(tv)) + 1j * rng.normal(size=len(tv)))
+    return (n.array(z, dtype=n.complex64))
+
+
+def make_conf():
+    conf = cc.chirp_config()
+    conf.output_dir = tempfile.mkdtemp()
+    conf.use_index = False
+    return (conf)
+
+
+def test_long_sweep_one_record():
+    """
+    A sweep that lasts much longer than the merge horizon, with gaps shorter
+    than it, is one record.
+    """
+    conf = make_conf()
+    try:
+        t0 = 1.6e9
+        dets = sweep_detections(conf, t0, t0 - 10.0, 100e3, 300.0, gaps=[(100.0, 103.0)])
+        assert 300.0 > 10 * conf.detection_merge_horizon
+        n_early, records = run(conf, dets)
+        assert len(records) == 1
+        assert records[0]["n_hits"] == len(dets)
+        assert abs(records[0]["chirp_time"] - (t0 - 10.0)) < 1e-4
+    finally:
+        shutil.rmtree(conf.output_dir)
+
+
+def test_sounders_separate_records():
+    """
+    Two sounders with different chirp-rates, and two soundings of one
+    sounder, give separate records.
+    """
+    conf = make_conf()
+    try:
+        t0 = 1.6e9
+        dets = (sweep_detections(conf, t0, t0 - 10.0, 100e3, 60.0) +
+                sweep_detections(conf, t0, t0 - 5.0, 125e3, 30.0) +
+                sweep_detections(conf, t0 + 120.0, t0 + 110.0, 100e3, 60.0))
+        n_early, records = run(conf, dets)
+        assert len(records) == 3
+        assert n.sum([r["n_hits"] for r in records]) == len(dets)
+        # the first soundings are written while the data is still being scanned
+        assert n_early >= 2
+    finally:
+        shutil.rmtree(conf.output_dir)
+
+
+def test_chirp_time_std_covers_scatter():
+    """
+    Chirps with rates between the filters: the chirp-time error is mostly
+    due to the chirp-rate mismatch, and chirp_time_std accounts for it.
+    """
+    conf = small_conf()
+    cd.debug_out1 = False
+    cfb = cd.chirp_matched_filter_bank(conf)
+    rng = n.random.default_rng(5)
+    t0 = 1000.0
+    err = []
+    std = []
+    for k in range(40):
+        rate = 100e3 + rng.uniform(-50.0, 50.0)
+        offset = rng.uniform(1.0, 8.0)
+        dets = cfb.detect(chirp_block(conf, rate, offset, rng), int(t0 * conf.sample_rate))
+        det = dets[n.argmax([d["snr"] for d in dets])]
+        err.append(det["chirp_time"] - (t0 - offset))
+        std.append(det["chirp_time_std"])
+    err = n.array(err)
+    std = n.array(std)
+    # the errors are much larger than the frequency interpolation error alone
+    assert n.sqrt(n.mean(err**2.0)) > 1e-3
+    # within the uncertainty, which isn't much larger than the scatter
+    assert n.all(n.abs(err) < 2.0 * std)
+    assert 0.3 < n.sqrt(n.mean(err**2.0)) / n.sqrt(n.mean(std**2.0)) < 1.0
+
+
+def test_merged_std_covers_error():
+    """
+    The chirp-rate error is the same for all blocks of a sweep, so merging
+    the hits doesn't make the chirp-time more accurate than a single hit.
+    """
+    conf = small_conf()
+    conf.output_dir = tempfile.mkdtemp()
+    conf.use_index = False
+    cd.debug_out1 = False
+    try:
+        cfb = cd.chirp_matched_filter_bank(conf)
+        rng = n.random.default_rng(6)
+        block = conf.n_samples_per_block / conf.sample_rate
+        t_chirp = 1000.0
+        rate = 100e3 + 40.0
+        dets = []
+        for k in range(20):
+            offset = 2.0 + k * block
+            d = cfb.detect(chirp_block(conf, rate, offset, rng),
+                           int((t_chirp + offset) * conf.sample_rate))
+            dets.append(d[n.argmax([x["snr"] for x in d])])
+        run(conf, dets)
+        # one record for each filter that detected the chirp
+        fl = glob.glob("%s/*/chirp*.h5" % (conf.output_dir))
+        assert len(fl) <= 2
+        for f in fl:
+            with h5py.File(f, "r") as h:
+                err = float(n.copy(h["chirp_time"])) - t_chirp
+                t_std = float(n.copy(h["chirp_time_std"]))
+                assert int(n.copy(h["n_hits"])) > 5
+            assert abs(err) > 5e-4
+            assert abs(err) < 2.0 * t_std
+    finally:
+        shutil.rmtree(conf.output_dir)
+
+
+if __name__ == "__main__":
+    test_long_sweep_one_record()
+    test_sounders_separate_records()
+    test_chirp_time_std_covers_scatter()
+    test_merged_std_covers_error()
+    print("ok")
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# Multistage decimation filter (chirp_lib.design_multistage) compared with
+# the windowed sinc filter it replaces. Needs libdownconvert.so (make).
+#
+#   python -m pytest test_chirp_lib.py
+# or
+#   python test_chirp_lib.py
+#
+import numpy as n
+from scipy.ndimage import maximum_filter1d
+
+import chirp_lib as cl
+
+
+def responses(dec, filter_len=2, n_per_fs_out=400, f_max=25.0):
+    """
+    Amplitude responses of the sinc filter and of the multistage filter,
+    from 0 to f_max*fs_out (f in units of fs_out).
+    """
+    cdc = cl.chirp_downconvert(dec=dec, filter_len=filter_len, n_threads=1,
+                               filter="multistage")
+    assert cdc.filter == "multistage"
+    n_fft = n_per_fs_out * dec
+    n_f = int(f_max * n_per_fs_out) + 1
+    f = n.arange(n_f) / n_fft
+    W = n.abs(n.fft.rfft(n.array(cdc.wfun, dtype=n.float64), n_fft))[0:n_f]
+    R = cdc.cic_dec
+    with n.errstate(divide="ignore", invalid="ignore"):
+        A = n.where(f == 0, 1.0, n.sin(n.pi * f * R) / (R * n.sin(n.pi * f)))**cl.cic_order
+    j = n.arange(len(cdc.fir)) - (len(cdc.fir) - 1) / 2.0
+    H = n.abs(A * n.dot(n.cos(2.0 * n.pi * f[:, None] * R * j[None, :]),
+                        n.array(cdc.fir, dtype=n.float64)))
+    return (f * dec, W, H)
+
+
+def test_multistage_stopband():
+    """
+    At least as much attenuation as the sinc filter at multiples of fs_out,
+    and below the sidelobe envelope of the sinc filter (largest response
+    within +/- fs_out/4) beyond 2 fs_out.
+    """
+    for dec in [2500, 1000, 250]:
+        f, W, H = responses(dec)
+        for k in [2, 3, 5, 10, 20]:
+            i = n.argmin(n.abs(f - k))
+            assert H[i] <= W[i]
+        env = maximum_filter1d(W, size=201)
+        assert n.all(H[f >= 2.0] <= env[f >= 2.0])
+
+
+def test_multistage_passband():
+    """
+    Same response as the sinc filter in the output band.
+    """
+    for dec in [2500, 1000, 250]:
+        f, W, H = responses(dec, f_max=0.5)
+        assert n.max(n.abs(H - W)) < 2e-3 * W[0]
+
+
+def test_multistage_outputs():
+    """
+    A chirp downconverted with both filters. The multistage outputs are
+    as accurate as the sinc outputs when compared with the exact result of
+    the same filter, and close to the sinc outputs.
+    """
+    dec = 2500
+    filter_len = 2
+    n_out = 100
+    sr = 25e6
+    f0 = -3e6
+    rate = 100e3
+    tv = n.arange(n_out * dec + filter_len * dec) / sr
+    z = n.array(n.exp(1j * (n.pi * rate * tv**2 + 2.0 * n.pi * (f0 + 1e3) * tv)), dtype=n.complex64)
+    d = z * n.exp(-1j * (2.0 * n.pi * f0 * tv + n.pi * rate * tv**2))
+    out = {}
+    for filt in ["sinc", "multistage"]:
+        cdc = cl.chirp_downconvert(dec=dec, filter_len=filter_len, n_threads=2,
+                                   f0=f0, rate=rate, dt=1.0 / sr, filter=filt)
+        z_out = n.zeros(n_out, dtype=n.complex64)
+        cdc.consume(z, z_out, n_out)
+        out[filt] = z_out
+    # exact sinc filter
+    w = n.array(cdc.wfun, dtype=n.float64)
+    sinc = n.array([n.sum(d[(o * dec):(o * dec + filter_len * dec)] * w) for o in range(n_out)])
+    # exact cic + fir
+    R = cdc.cic_dec
+    h = n.ones(1)
+    for k in range(cl.cic_order):
+        h = n.convolve(h, n.ones(R))
+    c = n.convolve(d, h / float(R)**cl.cic_order)
+    fir = n.array(cdc.fir, dtype=n.float64)
+    ms = n.array([n.sum(fir * c[cdc.offset + (o * (dec // R) + n.arange(len(fir))) * R]) for o in range(n_out)])
+    scale = n.max(n.abs(sinc))
+    assert n.max(n.abs(out["sinc"] - sinc)) < 1e-4 * scale
+    assert n.max(n.abs(out["multistage"] - ms)) < 1e-4 * scale
+    assert n.max(n.abs(out["multistage"] - sinc)) < 2e-3 * scale
+
+
+if __name__ == "__main__":
+    test_multistage_stopband()
+    test_multistage_passband()
+    test_multistage_outputs()
+    print("ok")
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Clustering of synthetic detections into soundings (find_timings.cluster_times).
+#
+#   python -m pytest test_find_timings.py
+# or
+#   python test_find_timings.py
+#
+import numpy as n
+
+import chirp_config as cc
+import chirp_det as cd
+import find_timings as ft
+
+
+def cluster(conf, t, t_std):
+    t = n.array(t, dtype=n.float64)
+    return (ft.cluster_times(t, 0.1,
+                             min_det=conf.min_detections,
+                             t_std=n.array(t_std, dtype=n.float64),
+                             min_det_refined=conf.min_refined_detections,
+                             dt_refined=conf.refined_timing_window))
+
+
+def detector_std(conf, f0, rate):
+    """
+    Chirp-time uncertainty of a detection at f0 (Hz) due to the chirp-rate
+    mismatch (see chirp_det.chirp_matched_filter_bank.chirp_time_std).
+    """
+    return (cd.chirp_rate_error(conf) * (f0 / rate) / rate)
+
+
+def test_imprecise_pairs_rejected():
+    """
+    Pairs of single false detections at the frequencies of most of the
+    band, with the timing uncertainty the detector gives them, are not
+    accepted as soundings, even if they agree closely.
+    """
+    conf = cc.chirp_config()
+    rng = n.random.default_rng(1)
+    for i in range(100):
+        t0 = 1e9 + 1000.0 * i
+        t = [t0, t0 + rng.uniform(-1e-3, 1e-3)]
+        t_std = [detector_std(conf, rng.uniform(3e6, 25e6), 100e3) for k in range(2)]
+        t0s, num_dets = cluster(conf, t, t_std)
+        assert len(t0s) == 0
+
+
+def test_noise_pairs_rejected():
+    """
+    Pairs of precise detections that don't agree within the refined timing
+    window are rejected.
+    """
+    conf = cc.chirp_config()
+    rng = n.random.default_rng(2)
+    for i in range(100):
+        t0 = 1e9 + 1000.0 * i
+        dt = rng.uniform(conf.refined_timing_window, 0.05) * rng.choice([-1, 1])
+        t0s, num_dets = cluster(conf, [t0, t0 + dt], [2e-5, 2e-5])
+        assert len(t0s) == 0
+
+
+def test_precise_pair_accepted():
+    """
+    Two detections of a fast sounder agree within their uncertainty, and
+    confirm it with the defaults.
+    """
+    conf = cc.chirp_config()
+    t0 = 1e9
+    t_std = [detector_std(conf, f0, 500e3) for f0 in [5e6, 12e6]]
+    assert max(t_std) < conf.refined_timing_window / 3.0
+    t0s, num_dets = cluster(conf, [t0, t0 + t_std[1] - t_std[0]], t_std)
+    assert len(t0s) == 1
+    assert num_dets[0] == 2
+
+
+def test_sounding_accepted():
+    conf = cc.chirp_config()
+    t0 = 1e9
+    t0s, num_dets = cluster(conf, [t0, t0 + 1e-4, t0 - 1e-4], [2e-5, 2e-5, 2e-5])
+    assert len(t0s) == 1
+    assert num_dets[0] == 3
+    assert abs(t0s[0] - t0) < 1e-3
+
+
+if __name__ == "__main__":
+    test_imprecise_pairs_rejected()
+    test_noise_pairs_rejected()
+    test_precise_pair_accepted()
+    test_sounding_accepted()
+    print("ok")
@@ -1,15 +1,13 @@
 #!/usr/bin/env python
-from detect_chirps import get_metadata
-import digital_rf as drf
 import time
 import os
 import sys
-import chirp_det as cd
 import chirp_config as cc
+import chirp_storage as cst
+import chirp_util as cu
 import scipy.constants as c
 import h5py
 import glob
-import matplotlib.pyplot as plt
 import numpy as n
 import gc
 import matplotlib
@@ -17,20 +15,28 @@ matplotlib.use('Agg')
 
 
 def plot_ionogram(conf, f, f2, normalize_by_frequency=True):
+    import digital_rf as drf
+    import matplotlib.pyplot as plt
     data = drf.DigitalRFReader(conf.data_dir)
-    sample_rate, center_freq = get_metadata(data, conf.channel)
-    max_analysis_freq = center_freq + sample_rate / 2
-    min_analysis_freq = center_freq - sample_rate / 2
-
-    ho = h5py.File(f, "r")
-    h1 = h5py.File(f2, "r")
+    sample_rate, center_freq = cu.get_metadata(data, conf.channel)
+    min_analysis_freq, max_analysis_freq = conf.analysis_band(sample_rate, center_freq)
+
+    # the ionograms may still be written (streaming_ionograms)
+    ho = h5py.File(f, "r", swmr=True)
+    h1 = h5py.File(f2, "r", swmr=True)
+    for h in [ho, h1]:
+        if "complete" in h.keys() and not bool(n.copy(h[("complete")])):
+            print("Ionogram %s is not complete yet. Skipping" % (h.filename))
+            ho.close()
+            h1.close()
+            return
     t0 = float(n.copy(ho[("t0")]))
     if not "id" in ho.keys():
         return
     cid = int(n.copy(ho[("id")]))  # ionosonde id
 
     img_fname = "%s/%s/lfm_ionogram-%03d-%1.2f.png" % (
-        conf.output_dir, cd.unix2dirname(t0), cid, t0)
+        conf.output_dir, cu.unix2dirname(t0), cid, t0)
 
     if os.path.exists(img_fname):
         print("Ionogram plot %s already exists. Skipping" % (img_fname))
@@ -40,8 +46,8 @@ def plot_ionogram(conf, f, f2, normalize_by_frequency=True):
     print("Plotting %s rate %1.2f (kHz/s) t0 %1.5f (unix)" %
           (f, float(n.copy(ho[("rate")])) / 1e3, float(n.copy(ho[("t0")]))))
 
-    S1 = n.copy(ho[("S")])          # ionogram frequency-range
-    S2 = n.copy(h1[("S")])          # ionogram frequency-range
+    S1 = cst.read(ho, "S")          # ionogram frequency-range
+    S2 = cst.read(h1, "S")          # ionogram frequency-range
 
     """
     # Calculate power 
@@ -60,16 +66,9 @@ def plot_ionogram(conf, f, f2, normalize_by_frequency=True):
     freqs = n.copy(ho[("freqs")])  # frequency bins
     ranges = n.copy(ho[("ranges")])  # range gates
 
-    """
-    # normalize by frequency
-    for i in range(S1.shape[0]):
-        noise = n.nanmedian(S1[i, :])
-        S1[i, :] = (S1[i, :] - noise) / noise
-        S2[i, :] = (S2[i, :] - noise) / noise
-    S1[S1 <= 0.0] = 1e-3
-    S2[S2 <= 0.0] = 1e-3
+    # normalizing by frequency (chirp_norm.normalize of the power) doesn't
+    # change the phase that is plotted
 
-    """
     max_range_idx = n.argmax(n.max(S1, axis=0))
 
     """
@@ -104,7 +103,7 @@ def plot_ionogram(conf, f, f2, normalize_by_frequency=True):
     cb = plt.colorbar()
     cb.set_label("SNR (dB)")
     plt.title("Chirp-rate %1.2f kHz/s t0=%1.5f (unix s)\n%s (UTC)" %
-              (float(n.copy(ho[("rate")])) / 1e3, float(n.copy(ho[("t0")])), cd.unix2datestr(float(n.copy(ho[("t0")])))))
+              (float(n.copy(ho[("rate")])) / 1e3, float(n.copy(ho[("t0")])), cu.unix2datestr(float(n.copy(ho[("t0")])))))
     plt.xlabel("Frequency (MHz)")
     plt.ylabel("One-way range offset (km)")
     plt.ylim([dr - conf.max_range_extent / 1e3,